@@ -5,13 +5,39 @@ Basic interface to CERN ActiveMQ via stomp
 from __future__ import print_function
 from __future__ import division
 
-import json
+import os
+import zlib
+import fcntl
 import logging
+import contextlib
+import threading
 import time
 import uuid
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 import stomp
 
+import codec
+
+@contextlib.contextmanager
+def spool_lock(spool_file):
+    """
+    Hold the lock of a spool file. It is a separate file, so that it also
+    covers replacing the spool itself: appending to a spool opened before
+    it was moved away would lose the frames.
+    """
+    with open(spool_file + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
 class StompyListener(object):
     """
     Auxiliar listener class to fetch all possible states in the Stomp
@@ -50,6 +76,24 @@ class StompyListener(object):
         return (headers, body)
 
 
+def compress(data, encoding, level=6):
+    """Compress a frame body with 'gzip' or 'zlib'"""
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == 'zlib':
+        return zlib.compress(data, level)
+    raise ValueError('Unknown content-encoding %s' % encoding)
+
+
+def decompress(data, encoding):
+    if encoding == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if encoding == 'zlib':
+        return zlib.decompress(data)
+    raise ValueError('Unknown content-encoding %s' % encoding)
+
+
 class StompAMQ(object):
     """
     Class to generate and send notifications to a given Stomp broker
@@ -61,6 +105,27 @@ class StompAMQ(object):
     :param topic: The topic to be used on the broker
     :param host_and_ports: The hosts and ports list of the brokers.
         E.g.: [('agileinf-mb.cern.ch', 61213)]
+    :param spool_file: If given, append notifications that could not be
+        sent to this file (one json frame per line) instead of dropping
+        them. They can be sent again later with `replay`.
+    :param batch_size: Pack up to this many notifications into a single
+        frame (1 means one frame per notification).
+    :param batch_bytes: Maximum size of the body of a batched frame
+    :param batch_format: Body of batched frames, either 'json' (a json
+        array) or 'ndjson' (one json document per line). The format and
+        the number of documents are given in the 'batch-format' and
+        'batch-size' headers, see `unpack`.
+    :param compression: Compress frame bodies with 'gzip' or 'zlib'
+        (None to send them as plain json). The algorithm is given in the
+        'content-encoding' header.
+    :param compression_level: zlib compression level (1-9)
+    :param fan_out: Keep a connection to each of host_and_ports and spread
+        frames over them, either 'round_robin' or 'least_loaded' (by send
+        latency). None uses host_and_ports for failover only.
+    :param retry_after: With fan_out, retry a failed broker after this
+        many seconds.
+    :param persistent: Keep the connection open between calls of `send`
+        (until `close`), reconnecting when it was lost.
     """
 
     # Version number to be added in header
@@ -69,15 +134,55 @@ class StompAMQ(object):
     def __init__(self, username, password,
                  producer='CMS_WMCore_StompAMQ',
                  topic='/topic/cms.jobmon.wmagent',
-                 host_and_ports=None):
+                 host_and_ports=None,
+                 spool_file=None,
+                 batch_size=1,
+                 batch_bytes=512*1024,
+                 batch_format='json',
+                 compression=None,
+                 compression_level=6,
+                 fan_out=None,
+                 retry_after=60,
+                 persistent=False):
         self._host_and_ports = host_and_ports or [('agileinf-mb.cern.ch', 61213)]
         self._username = username
         self._password = password
         self._producer = producer
         self._topic = topic
+        self._spool_file = spool_file
+        self.n_spooled = 0
+        self._batch_size = batch_size
+        self._batch_bytes = batch_bytes
+        self._batch_format = batch_format
+        self._compression = compression
+        self._compression_level = compression_level
+        self._fan_out = fan_out
+        self._retry_after = retry_after
+        self._persistent = persistent
+        self._conn = None
+        self._pool = None
 
         self._logger = logging.getLogger(__name__)
 
+    def _connect(self, host_and_ports=None):
+        """
+        Return a connected stomp.Connection, or None in case of failure
+        """
+        host_and_ports = host_and_ports or self._host_and_ports
+        conn = stomp.Connection(host_and_ports=host_and_ports)
+        conn.set_listener('StompyListener', StompyListener())
+        try:
+            conn.start()
+            conn.connect(username=self._username, passcode=self._password, wait=True)
+        except stomp.exception.ConnectFailedException as exc:
+            self._logger.error("Connection to %s failed %s", repr(host_and_ports), str(exc))
+            return None
+        except stomp.exception.NotConnectedException as exc:
+            self._logger.error("Not connected: %s %s", repr(host_and_ports), str(exc))
+            return None
+
+        return conn
+
     def send(self, data):
         """
         Connect to the stomp host and send a single notification
@@ -88,35 +193,81 @@ class StompAMQ(object):
 
         :return: a list of successfully sent notification bodies
         """
-
-        conn = stomp.Connection(host_and_ports=self._host_and_ports)
-        conn.set_listener('StompyListener', StompyListener())
-        try:
-            conn.start()
-            conn.connect(username=self._username, passcode=self._password, wait=True)
-        except stomp.exception.ConnectFailedException as exc:
-            self._logger.error("Connection to %s failed %s", repr(self._host_and_ports), str(exc))
-            return []
-        except stomp.exception.ConnectFailedException as exc:
-            self._logger.error("Not connected: %s %s", repr(self._host_and_ports), str(exc))
-            return []
-
         # If only a single notification, put it in a list
         if isinstance(data, dict) and 'topic' in data:
             data = [data]
 
+        if self._fan_out and len(self._host_and_ports) > 1:
+            if self._pool is None:
+                self._pool = BrokerPool(self, policy=self._fan_out,
+                                        retry_after=self._retry_after)
+            if self._batch_size > 1:
+                data = self._make_batches(data)
+            return self._pool.send(data)
+
+        if self._persistent and self._conn is not None and self._conn.is_connected():
+            conn = self._conn
+        else:
+            conn = self._connect()
+        if conn is None:
+            for notification in data:
+                self._spool(notification.pop('topic'), notification, notification.pop('body'))
+            return []
+
+        if self._batch_size > 1:
+            data = self._make_batches(data)
+
         successfully_sent = []
         for notification in data:
             body = self._send_single(conn, notification)
             if body:
-                successfully_sent.append(body)
+                successfully_sent.extend(self.documents(notification, body))
 
-        if conn.is_connected():
+        if self._persistent:
+            self._conn = conn
+        elif conn.is_connected():
             conn.disconnect()
 
         self._logger.info('Sent %d docs to %s', len(successfully_sent), repr(self._host_and_ports))
         return successfully_sent
 
+    def frames(self, data, encode=True):
+        """
+        Yield the frames that `send` would send for data, without sending
+        them, as tuples of (destination, headers, body, payload). payload
+        is the encoded frame body, or None if encode is False.
+        """
+        if isinstance(data, dict) and 'topic' in data:
+            data = [data]
+
+        if self._batch_size > 1:
+            data = self._make_batches(data)
+
+        for notification in data:
+            body = notification.pop('body')
+            destination = notification.pop('topic')
+            serialized = notification.pop('_serialized', None)
+            headers, payload = notification, None
+            if encode:
+                headers, payload = self._encode(notification, body, serialized)
+            yield destination, headers, body, payload
+
+    def spool(self, data):
+        """
+        Append notifications to the spool file instead of sending them,
+        e.g. to prepare them offline and send them later with `replay`.
+
+        :return: the number of spooled documents
+        """
+        n_docs = 0
+        with spool_lock(self._spool_file):
+            with open(self._spool_file, 'a') as spool:
+                for destination, headers, body, _ in self.frames(data, encode=False):
+                    spool.write(codec.dumps({'topic': destination, 'headers': headers, 'body': body}))
+                    spool.write('\n')
+                    n_docs += len(self.documents(headers, body))
+        return n_docs
+
     def _send_single(self, conn, notification):
         """
         Send a single notification to `conn`
@@ -126,20 +277,202 @@ class StompAMQ(object):
 
         :return: The notification body in case of success, or else None
         """
+        body = notification.pop('body')
+        destination = notification.pop('topic')
+        serialized = notification.pop('_serialized', None)
         try:
-            body = notification.pop('body')
-            destination = notification.pop('topic')
+            headers, payload = self._encode(notification, body, serialized)
             conn.send(destination=destination,
-                      headers=notification,
-                      body=json.dumps(body),
+                      headers=headers,
+                      body=payload,
                       ack='auto')
             self._logger.debug('Notification %s sent', str(notification))
             return body
         except Exception as exc:
             self._logger.error('Notification: %s not send, error: %s',
                           str(notification), str(exc))
+            self._spool(destination, notification, body)
             return None
 
+    def _encode(self, notification, body, serialized=None):
+        """
+        Return the frame headers and the (possibly compressed) frame
+        body for a notification
+        """
+        headers = dict(notification)
+        payload = serialized or self._serialize(notification, body)
+        if self._compression:
+            headers['content-encoding'] = self._compression
+            payload = compress(payload, self._compression, self._compression_level)
+        return headers, payload
+
+    def close(self):
+        """Disconnect the persistent connections"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        if self._conn is not None:
+            if self._conn.is_connected():
+                self._conn.disconnect()
+            self._conn = None
+
+    def _spool(self, destination, headers, body):
+        """
+        Append a notification that could not be sent to the spool file
+        """
+        if not self._spool_file:
+            return
+
+        frame = codec.dumps({'topic': destination, 'headers': headers, 'body': body})
+        # Several processes may spool to the same file
+        with spool_lock(self._spool_file):
+            with open(self._spool_file, 'a') as spool:
+                spool.write(frame + '\n')
+        self.n_spooled += len(self.documents(headers, body))
+
+    @staticmethod
+    def documents(headers, body):
+        """List of the documents in a (possibly batched) notification body"""
+        if 'batch-format' in headers:
+            return body
+        return [body]
+
+    @staticmethod
+    def _serialize(headers, body):
+        batch_format = headers.get('batch-format')
+        if batch_format == 'json':
+            return '[' + ','.join(codec.dumps(b) for b in body) + ']'
+        if batch_format == 'ndjson':
+            return '\n'.join(codec.dumps(b) for b in body)
+        return codec.dumps(body)
+
+    @staticmethod
+    def unpack(headers, body):
+        """
+        Return the list of documents in a received frame body,
+        for plain as well as for batched and compressed frames.
+        """
+        if headers.get('content-encoding'):
+            body = decompress(body, headers['content-encoding'])
+        batch_format = headers.get('batch-format')
+        if batch_format == 'json':
+            return codec.loads(body)
+        if batch_format == 'ndjson':
+            return [codec.loads(line) for line in body.splitlines() if line]
+        return [codec.loads(body)]
+
+    def _make_batches(self, notifications):
+        """
+        Pack consecutive notifications with the same topic and headers
+        into batched notifications of at most batch_size documents and
+        batch_bytes bytes.
+        """
+        separator = ',' if self._batch_format == 'json' else '\n'
+        batch_key = None
+        bodies, parts, n_bytes = [], [], 0
+
+        def flush():
+            topic, headers = batch_key[0], dict(batch_key[1])
+            headers['batch-format'] = self._batch_format
+            headers['batch-size'] = str(len(bodies))
+            serialized = separator.join(parts)
+            if self._batch_format == 'json':
+                serialized = '[' + serialized + ']'
+            headers.update({'topic': topic, 'body': bodies, '_serialized': serialized})
+            return headers
+
+        for notification in notifications:
+            body = notification.pop('body')
+            topic = notification.pop('topic')
+            key = (topic, tuple(sorted(notification.items())))
+            part = codec.dumps(body)
+
+            if bodies and (key != batch_key or
+                           len(bodies) == self._batch_size or
+                           n_bytes + len(part) > self._batch_bytes):
+                yield flush()
+                bodies, parts, n_bytes = [], [], 0
+
+            batch_key = key
+            bodies.append(body)
+            parts.append(part)
+            n_bytes += len(part) + 1
+
+        if bodies:
+            yield flush()
+
+    def _spooled_documents(self, filename):
+        """Return the number of documents in a spool file"""
+        n_docs = 0
+        with open(filename, 'r') as spool:
+            for line in spool:
+                if line.strip():
+                    frame = codec.loads(line)
+                    n_docs += len(self.documents(frame['headers'], frame['body']))
+        return n_docs
+
+    def replay(self, spool_file=None, on_sent=None):
+        """
+        Send all notifications of a spool file over a single connection.
+        Notifications that fail again are kept in the spool file. The
+        spool is moved to `<spool_file>.replay` while it is sent; one
+        left there by an interrupted replay is sent first.
+
+        :param on_sent: Called with the list of documents of every
+            notification that was sent, e.g. to count them
+
+        :return: a tuple of the number of sent and of failed notifications
+            (all of them if no connection could be made)
+        """
+        spool_file = spool_file or self._spool_file
+        replay_file = spool_file + '.replay'
+        pending = [f for f in (replay_file, spool_file) if os.path.exists(f)]
+        if not pending:
+            self._logger.info('Nothing to replay in %s', spool_file)
+            return 0, 0
+
+        conn = self._connect()
+        if conn is None:
+            n_failed = sum(self._spooled_documents(f) for f in pending)
+            self._logger.error('Could not connect to replay %s, %d docs kept', spool_file, n_failed)
+            return 0, n_failed
+
+        saved_spool_file, self._spool_file = self._spool_file, spool_file
+        n_sent = n_failed = 0
+        try:
+            # Move the spool out of the way, new failures go to a fresh
+            # one. Add it to the leftovers of an interrupted replay.
+            with spool_lock(spool_file):
+                if os.path.exists(spool_file):
+                    with open(spool_file, 'r') as spool:
+                        with open(replay_file, 'a') as replay:
+                            for line in spool:
+                                replay.write(line)
+                    os.remove(spool_file)
+
+            with open(replay_file, 'r') as replay:
+                for line in replay:
+                    if not line.strip():
+                        continue
+                    frame = codec.loads(line)
+                    notification = frame['headers']
+                    notification['topic'] = frame['topic']
+                    notification['body'] = frame['body']
+                    docs = self.documents(notification, notification['body'])
+                    if self._send_single(conn, notification):
+                        n_sent += len(docs)
+                        if on_sent is not None:
+                            on_sent(docs)
+                    else:
+                        n_failed += len(docs)
+            os.remove(replay_file)
+        finally:
+            self._spool_file = saved_spool_file
+            if conn.is_connected():
+                conn.disconnect()
+
+        self._logger.info('Replayed %d docs from %s, %d failed', n_sent, spool_file, n_failed)
+        return n_sent, n_failed
 
     def make_notification(self, payload, id_, producer=None,
                           type_='cms_wmagent_info',
@@ -184,4 +517,167 @@ class StompAMQ(object):
         notification['body'] = body
 
         return notification
-    
+
+
+class Broker(object):
+    """Connection and health of a single broker in a BrokerPool"""
+    def __init__(self, host_and_port, queue_size=4):
+        self.host_and_port = host_and_port
+        self.conn = None
+        self.latency = 0.
+        self.down_until = 0
+        self.queue = queue.Queue(maxsize=queue_size)
+
+    def is_healthy(self, now=None):
+        return self.down_until <= (now or time.time())
+
+
+class BrokerPool(object):
+    """
+    Persistent connections to all brokers of a StompAMQ, each served by
+    its own sender thread, with frames spread over the brokers either
+    round-robin or to the broker with the lowest expected wait (send
+    latency times queued frames). A broker that fails is ejected, its
+    frames go to the other brokers, and it is retried after retry_after
+    seconds. Frames that no broker could take are spooled.
+    """
+    def __init__(self, amq, policy='round_robin', retry_after=60):
+        self._amq = amq
+        self._policy = policy
+        self._retry_after = retry_after
+        self._logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._next = 0
+        self._sent = []
+        self._failed = []
+
+        self.brokers = [Broker(hp) for hp in amq._host_and_ports]
+        self._threads = []
+        for broker in self.brokers:
+            thread = threading.Thread(target=self._sender, args=(broker,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _choose(self):
+        now = time.time()
+        healthy = [b for b in self.brokers if b.is_healthy(now)]
+        if not healthy:
+            return None
+
+        self._next = (self._next + 1) % len(healthy)
+        if self._policy == 'least_loaded':
+            # Ties (e.g. before any latency is known) go round-robin
+            healthy = healthy[self._next:] + healthy[:self._next]
+            return min(healthy, key=lambda b: (b.latency * (b.queue.qsize() + 1),
+                                               b.queue.qsize()))
+
+        return healthy[self._next]
+
+    def _eject(self, broker):
+        self._logger.warning('Ejecting broker %s for %d s', repr(broker.host_and_port),
+                             self._retry_after)
+        broker.down_until = time.time() + self._retry_after
+        if broker.conn is not None and broker.conn.is_connected():
+            try:
+                broker.conn.disconnect()
+            except Exception:
+                pass
+        broker.conn = None
+
+    def _fail(self, frame):
+        with self._lock:
+            self._failed.append(frame)
+
+    def _sender(self, broker):
+        while True:
+            frame = broker.queue.get()
+            try:
+                if frame is None:
+                    return
+                self._deliver(broker, frame)
+            except Exception as exc:
+                self._logger.error('Sender of %s failed: %s', repr(broker.host_and_port), str(exc))
+                self._eject(broker)
+                self._fail(frame)
+            finally:
+                broker.queue.task_done()
+
+    def _deliver(self, broker, frame):
+        destination, notification, body, serialized = frame
+        if not broker.is_healthy():
+            self._fail(frame)
+            return
+
+        if broker.conn is None or not broker.conn.is_connected():
+            broker.conn = self._amq._connect([broker.host_and_port])
+            if broker.conn is None:
+                self._eject(broker)
+                self._fail(frame)
+                return
+
+        starttime = time.time()
+        try:
+            headers, payload = self._amq._encode(notification, body, serialized)
+            broker.conn.send(destination=destination,
+                             headers=headers,
+                             body=payload,
+                             ack='auto')
+        except Exception as exc:
+            self._logger.error('Sending to %s failed: %s', repr(broker.host_and_port), str(exc))
+            self._eject(broker)
+            self._fail(frame)
+            return
+
+        broker.latency = 0.8 * broker.latency + 0.2 * (time.time() - starttime)
+        with self._lock:
+            self._sent.extend(StompAMQ.documents(notification, body))
+
+    def _dispatch(self, frames):
+        for frame in frames:
+            broker = self._choose()
+            if broker is None:
+                self._amq._spool(frame[0], frame[1], frame[2])
+                continue
+            broker.queue.put(frame)
+
+        for broker in self.brokers:
+            broker.queue.join()
+
+    def send(self, notifications):
+        """
+        Send notifications over all healthy brokers
+
+        :return: a list of successfully sent notification bodies
+        """
+        self._sent = []
+        self._failed = []
+
+        frames = ((n.pop('topic'), n, n.pop('body'), n.pop('_serialized', None))
+                  for n in notifications)
+        self._dispatch(frames)
+
+        # Frames of ejected brokers go to the remaining ones
+        for _ in range(len(self.brokers)):
+            if not self._failed:
+                break
+            frames, self._failed = self._failed, []
+            self._dispatch(frames)
+
+        for destination, notification, body, _ in self._failed:
+            self._amq._spool(destination, notification, body)
+
+        self._logger.info('Sent %d docs to %s', len(self._sent),
+                          repr([b.host_and_port for b in self.brokers if b.is_healthy()]))
+        return self._sent
+
+    def close(self):
+        """Stop the sender threads and disconnect"""
+        for broker in self.brokers:
+            broker.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        for broker in self.brokers:
+            if broker.conn is not None and broker.conn.is_connected():
+                broker.conn.disconnect()
+            broker.conn = None
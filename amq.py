@@ -1,46 +1,113 @@
+import os
 import time
+import socket
 import logging
 import multiprocessing
 from StompAMQ import StompAMQ
 StompAMQ._version = '0.1.2'
 
+_amq_options = {}
+def configure(**options):
+    """
+    Set extra StompAMQ options (e.g. spool_file, batch_size) for the
+    interface returned by get_amq_interface
+    """
+    global _amq_interface
+    _amq_options.update(options)
+    _amq_interface = None
+
+
+def resolve_brokers(host_and_ports):
+    """
+    Expand DNS aliases (like dashb-mb.cern.ch) into the
+    addresses of all the broker nodes behind them
+    """
+    resolved = []
+    for host, port in host_and_ports:
+        try:
+            addresses = socket.gethostbyname_ex(host)[2]
+        except socket.error:
+            addresses = [host]
+        resolved.extend((address, port) for address in sorted(addresses))
+    return resolved
+
+
+def make_amq_interface(username, password, **extra):
+    """A StompAMQ for the job monitoring topic, with the configured options"""
+    options = {'host_and_ports': [('dashb-mb.cern.ch', 61113)]}
+    options.update(_amq_options)
+    options.update(extra)
+    if options.get('fan_out'):
+        options['host_and_ports'] = resolve_brokers(options['host_and_ports'])
+
+    return StompAMQ(username=username,
+                    password=password,
+                    topic='/topic/cms.jobmon.condor',
+                    **options)
+
+
 _amq_interface = None
+_amq_pid = None
 def get_amq_interface():
-    global _amq_interface
-    if not _amq_interface:
+    """
+    The interface of this process. A forked child creates its own rather
+    than sharing the connections of its parent.
+    """
+    global _amq_interface, _amq_pid
+    if not _amq_interface or _amq_pid != os.getpid():
         try:
             username = open('username', 'r').read().strip()
             password = open('password', 'r').read().strip()
         except IOError:
             print "ERROR: Provide username/password for CERN AMQ"
             return []
-        _amq_interface = StompAMQ(username=username,
-                                    password=password,
-                                    topic='/topic/cms.jobmon.condor',
-                                    host_and_ports=[('dashb-mb.cern.ch', 61113)])
+        _amq_interface = make_amq_interface(username, password)
+        _amq_pid = os.getpid()
 
     return _amq_interface
 
 
-def post_ads(ads, dry_run=False):
-    # if not len(ads):
-    #     logging.warning("No new documents found")
-    #     return
+def close_amq_interface():
+    """
+    Close the interface of this process, if it made one (an inherited
+    one belongs to the parent)
+    """
+    global _amq_interface
+    if _amq_interface and _amq_pid == os.getpid():
+        _amq_interface.close()
+        _amq_interface = None
+
+
+def make_notifications(interface, ads):
+    """Generate the notifications for (id, ad) pairs"""
+    return (interface.make_notification(payload=ad,
+                                        id_=id_,
+                                        type_='htcondor_job_info',
+                                        timestamp=ad['RecordTime']) for id_, ad in ads)
+
+
+def count_sent(ledger, docs):
+    """Count sent docs in a ledger.SendLedger"""
+    # The docs have their RecordTime in milliseconds here
+    ledger.add(doc['RecordTime'] // 1000 for doc in docs)
+
 
+def post_ads(ads, dry_run=False, ledger=None):
+    """
+    Send (id, ad) pairs to AMQ and return the number of ads
+    that were either sent or spooled for a later replay.
+    The ads that were actually sent are counted in ledger.
+    """
     interface = get_amq_interface()
-    # list_data = []
-    # for id_, ad in ads:
-    #     list_data.append(interface.make_notification(payload=ad,
-    #                                                  id_=id_,
-    #                                                  type_='htcondor_job_info'))
-    list_data = (interface.make_notification(payload=ad,
-                                             id_=id_,
-                                             type_='htcondor_job_info',
-                                             timestamp=ad['RecordTime']) for id_, ad in ads)
+    list_data = make_notifications(interface, ads)
 
+    n_spooled = interface.n_spooled
     if not dry_run:
         sent_data = interface.send(list_data)
+        if ledger is not None:
+            count_sent(ledger, sent_data)
+            ledger.flush()
     else:
         sent_data = [a for a in list_data]
 
-    return len(sent_data)
+    return len(sent_data) + interface.n_spooled - n_spooled
@@ -0,0 +1,99 @@
+"""
+Automatic tuning of the number of parallel ES readers.
+
+A sliced scroll cannot change its number of slices once started, so in
+auto mode a day is split into short RecordTime units instead, which a
+varying number of reader processes ("slices") take one after the other.
+The readers report the docs they read and the time they spent waiting
+for ES and for the queue to the uploader. A controller starts with a
+number of slices derived from the shard layout and the doc count, and
+adds or retires slices between measurement intervals.
+"""
+import multiprocessing
+
+
+def initial_slices(shards, max_slices, docs_per_slice=250000):
+    """
+    Number of slices to start with for the (index, shard, n_docs) of
+    the target range: one per shard holding docs, but no more than one
+    per docs_per_slice docs
+    """
+    n_docs = sum(n for _, _, n in shards)
+    return max(min(len(shards), n_docs // docs_per_slice, max_slices), 1)
+
+
+class SliceStats(object):
+    """
+    Counters of the readers, shared across a fork. Every slot is only
+    written by the reader process that runs in it.
+    """
+    def __init__(self, max_slices):
+        self.max_slices = max_slices
+        self._values = multiprocessing.Array('d', 3*max_slices, lock=False)
+        self._retired = multiprocessing.Array('b', max_slices, lock=False)
+
+    def add(self, slot, n_docs, es_seconds, wait_seconds):
+        self._values[3*slot] += n_docs
+        self._values[3*slot+1] += es_seconds
+        self._values[3*slot+2] += wait_seconds
+
+    def totals(self):
+        """Return the (n_docs, es_seconds, wait_seconds) of all slots"""
+        return tuple(sum(self._values[3*slot+n] for slot in range(self.max_slices))
+                     for n in range(3))
+
+    def retire(self, slot):
+        self._retired[slot] = 1
+
+    def reuse(self, slot):
+        self._retired[slot] = 0
+
+    def is_retired(self, slot):
+        return self._retired[slot] == 1
+
+
+class SliceTuner(object):
+    """
+    Hill climbing on the number of slices.
+
+    A slice is added as long as the last one added raised the throughput
+    by at least min_gain, the readers are not held back by the queue to
+    the uploader for more than max_waiting of their time, and the ES time
+    per page stays below max_slowdown times the best seen so far. When ES
+    slows down beyond that, or an added slice did not pay off, a slice is
+    retired and the count is not raised above that again.
+    """
+    def __init__(self, n_slices, max_slices, min_gain=0.1, max_waiting=0.5, max_slowdown=2.0):
+        self.n_slices = n_slices
+        self.ceiling = max_slices
+        self.min_gain = min_gain
+        self.max_waiting = max_waiting
+        self.max_slowdown = max_slowdown
+        self.best_response = None
+        self.last_rate = None
+        self.last_change = 0
+
+    def update(self, rate, response, waiting):
+        """
+        Return the new number of slices, given the docs/s, the mean ES
+        time per page and the fraction of time the readers waited for the
+        queue during the last interval
+        """
+        change = 0
+        if response and (self.best_response is None or response < self.best_response):
+            self.best_response = response
+
+        if response and response > self.max_slowdown * self.best_response and self.n_slices > 1:
+            self.ceiling = self.n_slices - 1
+            change = -1
+        elif (self.last_change > 0 and self.last_rate and
+              rate < (1 + self.min_gain) * self.last_rate and self.n_slices > 1):
+            self.ceiling = self.n_slices - 1
+            change = -1
+        elif waiting < self.max_waiting and self.n_slices < self.ceiling:
+            change = 1
+
+        self.n_slices += change
+        self.last_change = change
+        self.last_rate = rate
+        return self.n_slices
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Benchmark the AMQ upload against a local fake broker with synthetic job ads.
+"""
+import json
+import time
+import random
+
+from argparse import ArgumentParser
+
+from StompAMQ import StompAMQ
+from StompAMQ import compress
+from StompAMQ import decompress
+from fake_broker import FakeBroker
+from transfer_helpers import convert_dates_to_millisecs
+
+
+_SITES = ['T1_US_FNAL', 'T2_CH_CERN', 'T2_DE_DESY', 'T2_US_Wisconsin', 'T1_IT_CNAF']
+
+
+def synthetic_ad(i, n_attributes=200):
+    """A job ad of realistic size and repetitiveness"""
+    rnd = random.Random(i)
+    record_time = 1500000000 + i
+    ad = {
+        'GlobalJobId': 'vocms0%d.cern.ch#%d.0#%d' % (rnd.randint(100, 999), i, record_time),
+        'RecordTime': record_time,
+        'CompletionDate': record_time,
+        'QDate': record_time - rnd.randint(0, 86400),
+        'Site': rnd.choice(_SITES),
+        'Status': rnd.choice(['Completed', 'Removed', 'Held']),
+        'CMS_JobType': rnd.choice(['Production', 'Analysis']),
+        'Workflow': 'pdmvserv_task_HIG-RunIIFall17wmLHEGS-%05d' % rnd.randint(0, 2000),
+        'CpuEff': rnd.random() * 100,
+        'CoreHr': rnd.random() * 24,
+        'RequestCpus': rnd.choice([1, 4, 8]),
+        'RequestMemory': rnd.choice([2000, 2500, 8000, 16000]),
+        'ExitCode': rnd.choice([0, 0, 0, 8001, 50660]),
+        'DESIRED_Sites': ','.join(rnd.sample(_SITES, 3)),
+    }
+    for n in range(n_attributes - len(ad)):
+        ad['Attribute%03d' % n] = rnd.choice([n, 'value_%d' % (n % 7), n*0.5, None, True])
+    return ad
+
+
+def synthetic_ads(n_docs, n_attributes=200):
+    return [synthetic_ad(i, n_attributes) for i in range(n_docs)]
+
+
+def bench_send(brokers, ads, validate=False, **options):
+    """
+    Send ads through StompAMQ and return docs/s and the number of
+    frames and bytes received. With validate, check that the brokers
+    unpacked exactly the ads that were sent.
+    """
+    host_and_ports = [hp for broker in brokers for hp in broker.host_and_ports()]
+    interface = StompAMQ('user', 'pass', host_and_ports=host_and_ports, **options)
+    for broker in brokers:
+        broker.reset()
+        broker.keep_messages = validate
+
+    starttime = time.time()
+    data = (interface.make_notification(payload=convert_dates_to_millisecs(dict(ad)),
+                                        id_=ad['GlobalJobId'],
+                                        type_='htcondor_job_info',
+                                        timestamp=ad['RecordTime']) for ad in ads)
+    n_sent = len(interface.send(data))
+    elapsed = time.time() - starttime
+    interface.close()
+
+    # Give the brokers a moment to process what is still in flight
+    deadline = time.time() + 10
+    while sum(b.n_docs for b in brokers) < n_sent and time.time() < deadline:
+        time.sleep(0.01)
+    assert(sum(b.n_docs for b in brokers) == n_sent == len(ads)), "Inconsistent count (fake broker)"
+
+    if validate:
+        received = dict((d['_id'], d) for b in brokers for _, docs in b.messages for d in docs)
+        for ad in ads:
+            doc = received[ad['GlobalJobId']]
+            assert(doc['Workflow'] == ad['Workflow'] and
+                   doc['RecordTime'] == 1000*ad['RecordTime']), "Inconsistent doc (fake broker)"
+
+    return (n_sent/elapsed,
+            sum(b.n_frames for b in brokers),
+            sum(b.n_bytes for b in brokers))
+
+
+def bench_compression(ads, batch_size, levels=(1, 6, 9)):
+    """Print the compression ratio and CPU cost per MB of json frame bodies"""
+    bodies = []
+    for start in range(0, len(ads), batch_size):
+        bodies.append(StompAMQ._serialize({'batch-format': 'ndjson'}, ads[start:start+batch_size])
+                      if batch_size > 1 else json.dumps(ads[start]))
+    n_bytes = sum(len(b) for b in bodies)
+
+    print "%-10s %-6s %-6s %8s %14s %14s" % ('batch', 'codec', 'level', 'ratio',
+                                             'comp ms/MB', 'decomp ms/MB')
+    for encoding in ('gzip', 'zlib'):
+        for level in levels:
+            starttime = time.time()
+            compressed = [compress(b, encoding, level) for b in bodies]
+            t_comp = time.time() - starttime
+
+            starttime = time.time()
+            for c in compressed:
+                decompress(c, encoding)
+            t_decomp = time.time() - starttime
+
+            ratio = n_bytes / float(sum(len(c) for c in compressed))
+            print "%-10d %-6s %-6d %8.1f %14.1f %14.1f" % (batch_size, encoding, level, ratio,
+                                                          1e3*t_comp/(n_bytes/1e6),
+                                                          1e3*t_decomp/(n_bytes/1e6))
+
+
+def main(args):
+    ads = synthetic_ads(args.n_docs, args.n_attributes)
+    brokers = [FakeBroker().start() for _ in range(args.n_brokers)]
+    fan_out = args.fan_out if args.n_brokers > 1 else None
+
+    print "%-10s %-8s %-6s %12s %10s %14s" % ('batch', 'format', 'codec',
+                                              'docs/s', 'frames', 'bytes')
+    try:
+        for batch_size in args.batch_sizes:
+            for batch_format in (['json', 'ndjson'] if batch_size > 1 else ['-']):
+                for compression in [None] + args.compression:
+                    options = {'batch_size': batch_size, 'compression': compression,
+                               'fan_out': fan_out}
+                    if batch_size > 1:
+                        options['batch_format'] = batch_format
+                    rate, n_frames, n_bytes = bench_send(brokers, ads, validate=args.validate,
+                                                         **options)
+                    print "%-10d %-8s %-6s %12.0f %10d %14d" % (batch_size, batch_format,
+                                                                compression or '-',
+                                                                rate, n_frames, n_bytes)
+    finally:
+        for broker in brokers:
+            broker.stop()
+
+    if args.compression:
+        print
+        for batch_size in args.batch_sizes:
+            bench_compression(ads, batch_size)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_docs", default=20000,
+                        type=int, dest="n_docs",
+                        help="Number of synthetic ads [default: %(default)s]")
+    parser.add_argument("--n_attributes", default=200,
+                        type=int, dest="n_attributes",
+                        help="Number of attributes per ad [default: %(default)s]")
+    parser.add_argument("--batch_sizes", default=[1, 10, 100, 500],
+                        type=int, nargs='+', dest="batch_sizes",
+                        help="Batch sizes to compare [default: %(default)s]")
+    parser.add_argument("--compression", default=[],
+                        choices=['gzip', 'zlib'], nargs='*', dest="compression",
+                        help="Also compare compressed bodies [default: %(default)s]")
+    parser.add_argument("--n_brokers", default=1,
+                        type=int, dest="n_brokers",
+                        help="Number of fake brokers to spread the load over [default: %(default)s]")
+    parser.add_argument("--fan_out", default='round_robin',
+                        choices=['round_robin', 'least_loaded'], dest="fan_out",
+                        help="Fan-out policy with several brokers [default: %(default)s]")
+    parser.add_argument("--validate", action='store_true',
+                        dest="validate",
+                        help="Check every doc received by the fake broker")
+    args = parser.parse_args()
+
+    main(args)
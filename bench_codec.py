@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Benchmark the available json backends of codec on synthetic job ads,
+as they appear in the dump files and in the AMQ notifications.
+"""
+import json
+import time
+
+from argparse import ArgumentParser
+
+import codec
+from bench_amq import synthetic_ads
+
+
+def bench_backend(dumps, loads, docs, lines, n_repeat=3):
+    """Return the best dumps and loads rates in MB/s"""
+    n_bytes = sum(len(l) for l in lines)
+    t_dumps = t_loads = float('inf')
+    for _ in range(n_repeat):
+        starttime = time.time()
+        for doc in docs:
+            dumps(doc)
+        t_dumps = min(t_dumps, time.time() - starttime)
+
+        starttime = time.time()
+        for line in lines:
+            loads(line)
+        t_loads = min(t_loads, time.time() - starttime)
+
+    return n_bytes/1e6/t_dumps, n_bytes/1e6/t_loads
+
+
+def main(args):
+    ads = synthetic_ads(args.n_docs, args.n_attributes)
+    docs = [{'_index': 'cms-2017-07-14', '_type': 'job', '_id': ad['GlobalJobId'],
+             '_score': None, '_source': ad} for ad in ads]
+    lines = [json.dumps(doc) for doc in docs]
+
+    print "Selected backend: %s" % codec.backend
+    print "%-10s %12s %12s %12s" % ('backend', 'dumps MB/s', 'loads MB/s', 'identical')
+    for name, dumps, loads in codec.available_backends():
+        rate_dumps, rate_loads = bench_backend(dumps, loads, docs, lines)
+        identical = all(dumps(doc) == line for doc, line in zip(docs[:100], lines[:100]))
+        print "%-10s %12.1f %12.1f %12s" % (name, rate_dumps, rate_loads, identical)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_docs", default=20000,
+                        type=int, dest="n_docs",
+                        help="Number of synthetic ads [default: %(default)s]")
+    parser.add_argument("--n_attributes", default=200,
+                        type=int, dest="n_attributes",
+                        help="Number of attributes per ad [default: %(default)s]")
+    args = parser.parse_args()
+
+    main(args)
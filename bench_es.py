@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Benchmark the ES scroll reads against a local fake ES, comparing the
+client options of get_es_handle (compression, pool) with the defaults.
+"""
+import time
+import multiprocessing
+
+from argparse import ArgumentParser
+
+import dump_es_bytimestamp
+
+from fake_es import FakeES
+from dump_es_bytimestamp import configure_es
+from dump_es_bytimestamp import get_es_handle
+from dump_es_bytimestamp import make_es_handle
+from dump_es_bytimestamp import make_query
+
+
+_CONFIGS = [
+    ('defaults', {'timeout': 20}), # plain Elasticsearch client
+    ('tuned', None), # options of get_es_handle
+]
+
+
+def bench_scroll(es, buffer_size=1000, options=None):
+    """
+    Scroll through all docs of es, with a client with options or else
+    the one of get_es_handle, and return the mean and maximum time per
+    page, the docs per second, the bytes on the wire and the number of
+    connections
+    """
+    es.reset()
+    if options is None:
+        configure_es(hosts=es.hosts())
+        handle = get_es_handle()
+    else:
+        handle = make_es_handle(es.hosts(), **options)
+
+    latencies = []
+    n_docs = 0
+    starttime = time.time()
+    resp = handle.search(index='cms-20*', doc_type='job', scroll='5m',
+                         size=buffer_size, body=make_query(1500000000))
+    latencies.append(time.time() - starttime)
+    while resp['hits']['hits']:
+        n_docs += len(resp['hits']['hits'])
+        pagetime = time.time()
+        resp = handle.scroll(resp['_scroll_id'], scroll='5m')
+        latencies.append(time.time() - pagetime)
+
+    total = time.time() - starttime
+    handle.transport.close()
+    return (sum(latencies)/len(latencies), max(latencies),
+            n_docs/total, es.n_bytes, len(es.connections))
+
+
+def _scan_worker(buffer_size):
+    n_docs = 0
+    for _ in dump_es_bytimestamp.get_es_scan(make_query(1500000000), buffer_size=buffer_size):
+        n_docs += 1
+    assert(n_docs > 0)
+
+
+def bench_forked(es, n_workers, buffer_size=1000):
+    """
+    Use the client in the parent, then scan from n_workers forked
+    children, and return the number of connections ES has seen
+    """
+    configure_es(hosts=es.hosts())
+    es.reset()
+    get_es_handle().count(index='cms-20*', doc_type='job', body=make_query(1500000000))
+
+    workers = [multiprocessing.Process(target=_scan_worker, args=(buffer_size,))
+               for _ in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert(all(w.exitcode == 0 for w in workers)), "Scan worker failed"
+    get_es_handle().transport.close()
+    return len(es.connections)
+
+
+def main(args):
+    print "Serving %d docs with %d attributes, %.0f ms latency, %s" % (
+        args.n_docs, args.n_attributes, args.latency*1000,
+        '%.0f MB/s' % (args.bandwidth/1e6) if args.bandwidth else 'no bandwidth limit')
+    es = FakeES(n_docs=args.n_docs, n_attributes=args.n_attributes,
+                latency=args.latency, bandwidth=args.bandwidth).start()
+
+    for name, options in _CONFIGS:
+        mean, worst, rate, n_bytes, n_conn = bench_scroll(es, args.buffer_size, options)
+        print ("%-10s %7.1f ms/page (max %7.1f)  %8.0f docs/s  %8.1f MB on the wire  "
+               "%d connection(s)" % (name, mean*1000, worst*1000, rate, n_bytes/1e6, n_conn))
+
+    n_conn = bench_forked(es, args.n_workers, args.buffer_size)
+    print "%d forked workers after use in the parent: %d connections" % (args.n_workers, n_conn)
+    es.stop()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_docs", default=20000,
+                        type=int, dest="n_docs",
+                        help="Number of docs to scroll [default: %(default)s]")
+    parser.add_argument("--n_attributes", default=200,
+                        type=int, dest="n_attributes",
+                        help="Number of attributes per doc [default: %(default)s]")
+    parser.add_argument("--buffer_size", default=1000,
+                        type=int, dest="buffer_size",
+                        help="Docs per scroll page [default: %(default)s]")
+    parser.add_argument("--latency", default=0.005,
+                        type=float, dest="latency",
+                        help="Delay of every response in seconds [default: %(default)s]")
+    parser.add_argument("--bandwidth", default=10e6,
+                        type=float, dest="bandwidth",
+                        help="Bandwidth of the fake ES in bytes per second (0: no limit) [default: %(default)s]")
+    parser.add_argument("--n_workers", default=4,
+                        type=int, dest="n_workers",
+                        help="Number of forked scan workers [default: %(default)s]")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,131 @@
+"""
+JSON encoding and decoding with the fastest available backend.
+
+At import, the installed backends among orjson, rapidjson, ujson and the
+standard library json that pass a round trip check on a representative
+job ad are timed on that ad, and the fastest one is selected (set
+ES_TRANSFER_JSON to force one of them).
+
+`dumps` and `loads` use the selected backend, and fall back to json for
+what it rejects (e.g. NaN, which json writes as NaN, or integers beyond
+64 bits). The output of `dumps` is valid json but its formatting
+(whitespace, escaping) depends on the backend. Where the exact bytes matter, use `dumps_compatible`, which is
+always byte-for-byte identical to json.dumps(obj).
+"""
+import os
+import json
+import time
+
+
+_SAMPLE = {
+    'GlobalJobId': u'vocms0123.cern.ch#123.0#1500000000',
+    'RecordTime': 1500000000,
+    'CpuEff': 0.1 + 0.2,
+    'CoreHr': 1.0/3,
+    'Large': 2**53 + 1,
+    'Negative': -17,
+    'Site': u'T2_CH_CERN',
+    'Unicode': u'caf\xe9 \u2603',
+    'Escapes': u'a/b "quoted" \\ \n\t',
+    'Empty': None,
+    'Flag': True,
+    'List': [1, 2.5, u'x', None, False],
+    'Nested': {'a': {'b': [{}]}},
+}
+
+
+def _stdlib_backend():
+    return 'json', json.dumps, json.loads
+
+
+def _orjson_backend():
+    import orjson
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+    return 'orjson', dumps, orjson.loads
+
+
+def _rapidjson_backend():
+    import rapidjson
+    return 'rapidjson', rapidjson.dumps, rapidjson.loads
+
+
+def _ujson_backend():
+    import ujson
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    return 'ujson', dumps, ujson.loads
+
+
+_BACKENDS = [
+    ('orjson', _orjson_backend),
+    ('rapidjson', _rapidjson_backend),
+    ('ujson', _ujson_backend),
+    ('json', _stdlib_backend),
+]
+
+
+def _round_trips(dumps, loads):
+    """Check that a backend reads what it and the stdlib write"""
+    try:
+        return (loads(dumps(_SAMPLE)) == _SAMPLE and
+                loads(json.dumps(_SAMPLE)) == _SAMPLE and
+                json.loads(dumps(_SAMPLE)) == _SAMPLE)
+    except Exception:
+        return False
+
+
+def available_backends():
+    """Return (name, dumps, loads) of all installed and working backends"""
+    backends = []
+    for _, make_backend in _BACKENDS:
+        try:
+            name, dumps, loads = make_backend()
+        except ImportError:
+            continue
+        if _round_trips(dumps, loads):
+            backends.append((name, dumps, loads))
+    return backends
+
+
+def _duration(dumps, loads, n_repeat=200):
+    """Time to write and read the sample ad n_repeat times"""
+    line = json.dumps(_SAMPLE)
+    starttime = time.time()
+    for _ in xrange(n_repeat):
+        dumps(_SAMPLE)
+        loads(line)
+    return time.time() - starttime
+
+
+def select_backend(name=None):
+    """Return the requested backend if it works, or else the fastest one"""
+    backends = available_backends()
+    for backend in backends:
+        if backend[0] == name:
+            return backend
+    return min(backends, key=lambda b: _duration(b[1], b[2]))
+
+
+backend, _dumps, _loads = select_backend(os.environ.get('ES_TRANSFER_JSON'))
+
+
+if backend == 'json':
+    dumps, loads = _dumps, _loads
+else:
+    def dumps(obj):
+        try:
+            return _dumps(obj)
+        except (OverflowError, ValueError):
+            return json.dumps(obj)
+
+    def loads(string):
+        try:
+            return _loads(string)
+        except ValueError:
+            return json.loads(string)
+
+
+def dumps_compatible(obj):
+    """Serialize exactly like json.dumps"""
+    return json.dumps(obj)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+Columnar format for local dumps.
+
+A dump is a sequence of record batches. Each batch starts with a json
+header line giving its number of docs, the minimum and maximum RecordTime
+of its docs, its size in bytes, and the location of each of its columns.
+The header is followed by the columns: one zlib-compressed json list of
+values per field (the _source attributes, plus _id, _index and _type of
+the hit). Fields missing in some docs are stored with the row numbers of
+the docs that have them.
+
+Readers only decompress and parse the columns of the fields they ask for.
+Dumps are written by dump_es_bytimestamp.py --columnar, or converted from
+json dumps with this script, which also lists the doc counts and RecordTime
+ranges of columnar dumps.
+"""
+import os
+import zlib
+
+from itertools import izip
+from argparse import ArgumentParser
+
+import codec
+
+
+MAGIC = 'ESCOLUMNAR1\n'
+META = ('_id', '_index', '_type')
+
+
+def is_columnar(filename):
+    with open(filename, 'rb') as dfile:
+        return dfile.read(len(MAGIC)) == MAGIC
+
+
+class ColumnarWriter(object):
+    """
+    Write ES hits into a columnar dump, in batches of batch_size docs
+    compressed with zlib at the given level
+    """
+    def __init__(self, filename, batch_size=10000, level=1):
+        self.batch_size = batch_size
+        self.level = level
+        self.n_docs = 0
+        self._batch = []
+        self._file = open(filename, 'wb')
+        self._file.write(MAGIC)
+
+    def write(self, hit):
+        self._batch.append(hit)
+        if len(self._batch) == self.batch_size:
+            self._flush()
+
+    @staticmethod
+    def _make_columns(records, names):
+        """
+        Return {name: (rows, values)} of the fields of records, where rows
+        is None if all records have the field
+        """
+        # Transpose with builtins, looping in python only for sparse fields
+        all_names = set(names)
+        sparse = set()
+        for record in records:
+            sparse.update(all_names.difference(record))
+
+        table = zip(*[map(record.get, names) for record in records])
+        columns = {}
+        for name, values in zip(names, table):
+            if name not in sparse:
+                columns[name] = (None, list(values))
+                continue
+            rows = [row for row, record in enumerate(records) if name in record]
+            if rows:
+                columns[name] = (rows, [values[row] for row in rows])
+        return columns
+
+    def _flush(self):
+        if not self._batch:
+            return
+
+        sources = [hit['_source'] for hit in self._batch]
+        names = set()
+        for source in sources:
+            names.update(source)
+
+        columns = self._make_columns(self._batch, list(META))
+        columns.update(self._make_columns(sources, list(names)))
+        record_times = [t for t in columns.get('RecordTime', (None, []))[1] if t is not None]
+
+        n_docs = len(self._batch)
+        blocks = []
+        locations = {}
+        offset = 0
+        for name, (rows, values) in sorted(columns.iteritems()):
+            dense = rows is None
+            block = zlib.compress(codec.dumps(values if dense else [rows, values]), self.level)
+            locations[name] = [offset, len(block), dense]
+            blocks.append(block)
+            offset += len(block)
+
+        header = {'n_docs': n_docs,
+                  'min_time': min(record_times) if record_times else None,
+                  'max_time': max(record_times) if record_times else None,
+                  'size': offset,
+                  'columns': locations}
+        self._file.write(codec.dumps(header) + '\n')
+        for block in blocks:
+            self._file.write(block)
+
+        self.n_docs += n_docs
+        self._batch = []
+
+    def close(self):
+        self._flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ColumnarReader(object):
+    """Read (projected) ES hits from a columnar dump"""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _batches(self, dfile):
+        """Yield (header, offset of the columns) of all batches"""
+        dfile.seek(len(MAGIC))
+        while True:
+            line = dfile.readline()
+            if not line:
+                break
+            header = codec.loads(line)
+            offset = dfile.tell()
+            yield header, offset
+            dfile.seek(offset + header['size'])
+
+    def batches(self):
+        with open(self.filename, 'rb') as dfile:
+            return [header for header, _ in self._batches(dfile)]
+
+    def count(self):
+        return sum(header['n_docs'] for header in self.batches())
+
+    def _column(self, dfile, offset, header, name):
+        """Return the (rows, values) of a column, rows is None if it is dense"""
+        start, length, dense = header['columns'][name]
+        dfile.seek(offset + start)
+        values = codec.loads(zlib.decompress(dfile.read(length)))
+        if dense:
+            return None, values
+        return values
+
+    def _rebuild(self, dfile, offset, header, fields=None):
+        """Return the hits of a batch, with only the given _source fields"""
+        n_docs = header['n_docs']
+        dense_names, dense_columns, sparse_columns = [], [], []
+        meta_columns = []
+        for name in header['columns']:
+            if fields is not None and name not in fields and name not in META:
+                continue
+            rows, values = self._column(dfile, offset, header, name)
+            if name in META:
+                meta_columns.append((name, rows, values))
+            elif rows is None:
+                dense_names.append(name)
+                dense_columns.append(values)
+            else:
+                sparse_columns.append((name, rows, values))
+
+        # Build the docs row by row from the dense columns
+        if dense_columns:
+            sources = [dict(izip(dense_names, values)) for values in izip(*dense_columns)]
+        else:
+            sources = [{} for _ in xrange(n_docs)]
+        for name, rows, values in sparse_columns:
+            for row, value in izip(rows, values):
+                sources[row][name] = value
+
+        hits = [{'_source': source} for source in sources]
+        for name, rows, values in meta_columns:
+            for row, value in izip(rows or xrange(n_docs), values):
+                hits[row][name] = value
+        return hits
+
+    def read(self, fields=None, batches=None):
+        """
+        Yield the hits with only the given _source fields (all if None).
+        With batches, only read the batches with these numbers.
+        """
+        with open(self.filename, 'rb') as dfile:
+            for n_batch, (header, offset) in enumerate(self._batches(dfile)):
+                if batches is not None and n_batch not in batches:
+                    continue
+                if header['n_docs'] == 0:
+                    continue
+                for hit in self._rebuild(dfile, offset, header, fields):
+                    yield hit
+
+
+def convert_lines(lines, columnar_filename, batch_size=10000):
+    """Write json hits, one per line (e.g. from a pipe), into a columnar dump"""
+    with ColumnarWriter(columnar_filename, batch_size=batch_size) as writer:
+        for line in lines:
+            if line.strip():
+                writer.write(codec.loads(line))
+    return writer.n_docs
+
+
+def convert(json_filename, columnar_filename, batch_size=10000):
+    """Convert a dump with one json hit per line into a columnar dump"""
+    with open(json_filename, 'r') as dumpfile:
+        return convert_lines(dumpfile, columnar_filename, batch_size=batch_size)
+
+
+def main(args):
+    for filename in args.dumpfiles:
+        if is_columnar(filename):
+            batches = ColumnarReader(filename).batches()
+            times = [t for b in batches for t in (b['min_time'], b['max_time']) if t is not None]
+            print "%s: %d docs in %d batches, RecordTime %s to %s" % (
+                filename, sum(b['n_docs'] for b in batches), len(batches),
+                min(times) if times else '-', max(times) if times else '-')
+            continue
+
+        columnar_filename = os.path.splitext(filename)[0] + '.col'
+        n_docs = convert(filename, columnar_filename, batch_size=args.batch_size)
+        print "Converted %d docs from %s into %s (%.1f MB to %.1f MB)" % (
+            n_docs, filename, columnar_filename,
+            os.path.getsize(filename)/1e6, os.path.getsize(columnar_filename)/1e6)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('dumpfiles', metavar='dumpfiles', type=str, nargs='+',
+                        help='Convert these json dumps to columnar ones, or describe columnar dumps')
+    parser.add_argument("--batch_size", default=10000,
+                        type=int, dest="batch_size",
+                        help="Number of docs per batch [default: %(default)s]")
+    args = parser.parse_args()
+
+    main(args)
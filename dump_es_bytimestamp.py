@@ -1,15 +1,25 @@
 #!/usr/bin/env python
 import os
 import json
+import time
+import Queue
+import logging
+import threading
+import multiprocessing
 from elasticsearch import helpers as es_helpers
 from elasticsearch import Elasticsearch
 
 from datetime import datetime
 from argparse import ArgumentParser
 
+import codec
+
+from columnar import ColumnarWriter
 from transfer_helpers import print_progress
 from transfer_helpers import read_es_config
 
+logger = logging.getLogger(__name__)
+
 def date_to_timestamp(year, month, day):
     try:
         dt = datetime(year, month, day)
@@ -26,17 +36,58 @@ def date_string_to_timestamp(date_string):
     return timestamp
 
 
-_es_handle = None
-def get_es_handle():
+_es_options = {
+    'timeout': 20,
+    'max_retries': 3,
+    'retry_on_timeout': True,
+    'http_compress': True,
+    'maxsize': 2,
+}
+def configure_es(**options):
+    """
+    Set options (e.g. timeout, max_retries, http_compress, maxsize, or
+    hosts instead of those in es.conf) for the clients of get_es_handle
+    """
     global _es_handle
-    if not _es_handle:
+    _es_options.update(options)
+    _es_handle = None
+
+
+def make_es_handle(hosts=None, **options):
+    """
+    A new Elasticsearch client for hosts, or else for the host in es.conf.
+    Failed requests are retried up to max_retries times, with increasing
+    delays of 1, 3, 7... seconds. With http_compress, ES sends gzipped
+    responses.
+    """
+    if options.pop('http_compress', False):
+        # Only ask for compressed responses: on python 2, elasticsearch-py
+        # 6.3.1 zlib-wraps the request bodies while declaring them as gzip
+        options['headers'] = {'accept-encoding': 'gzip,deflate'}
+
+    if hosts is None:
         es_conf = read_es_config("es.conf")
-        _es_handle = Elasticsearch([{"host": es_conf['host'],
-                                     "port":es_conf['port'], 
-                                     "http_auth": "{user}:{pass}".format(**es_conf)}],
-                                     verify_certs=True,
-                                     use_ssl=True,
-                                     ca_certs='/etc/pki/tls/certs/ca-bundle.trust.crt')
+        hosts = [{"host": es_conf['host'],
+                  "port":es_conf['port'],
+                  "http_auth": "{user}:{pass}".format(**es_conf)}]
+        options.update(verify_certs=True,
+                       use_ssl=True,
+                       ca_certs='/etc/pki/tls/certs/ca-bundle.trust.crt')
+
+    return Elasticsearch(hosts, **options)
+
+
+_es_handle = None
+_es_pid = None
+def get_es_handle():
+    """
+    The client of this process. A forked child creates its own rather
+    than sharing the connections of its parent.
+    """
+    global _es_handle, _es_pid
+    if not _es_handle or _es_pid != os.getpid():
+        _es_handle = make_es_handle(**_es_options)
+        _es_pid = os.getpid()
 
     return _es_handle
 
@@ -87,24 +138,67 @@ def get_es_scan(query, index='cms-20*', buffer_size=5000):
     es_scan = es_helpers.scan(
             _es_handle,
             query=query,
-            index='cms-20*',
+            index=index,
             doc_type='job',
-            request_timeout=20,
             size=buffer_size
         )
 
     return es_scan
 
 
-def get_es_scan_sliced(query, slice_id, max_slices=2,
-                       index='cms-20*', buffer_size=5000):
+def scroll_hits(body, index='cms-20*', buffer_size=5000,
+                raise_on_error=True, clear_scroll=True, **search_args):
+    """
+    Scroll through all hits of a search, like elasticsearch.helpers.scan,
+    passing extra arguments (e.g. preference) on to the initial search
+    """
     from elasticsearch.helpers import ScanError
 
-    raise_on_error=True
-    clear_scroll=True
-
     get_es_handle()
+    resp = _es_handle.search(body=body, scroll='5m', size=buffer_size,
+                             doc_type='job', index=index, **search_args)
+
+    scroll_id = resp.get('_scroll_id')
+    if scroll_id is None:
+        return
+
+
+    try:
+        first_run = True
+        while True:
+            # if we didn't set search_type to scan initial search contains data
+            if first_run:
+                first_run = False
+            else:
+                resp = _es_handle.scroll(scroll_id, scroll='5m')
+
+            for hit in resp['hits']['hits']:
+                yield hit
+
+            # check if we have any errrors
+            if resp["_shards"]["successful"] < resp["_shards"]["total"]:
+                logger.warning(
+                    'Scroll request has only succeeded on %d shards out of %d.',
+                    resp['_shards']['successful'], resp['_shards']['total']
+                )
+                if raise_on_error:
+                    raise ScanError(
+                        scroll_id,
+                        'Scroll request has only succeeded on %d shards out of %d.' %
+                            (resp['_shards']['successful'], resp['_shards']['total'])
+                    )
+
+            scroll_id = resp.get('_scroll_id')
+            # end of scroll
+            if scroll_id is None or not resp['hits']['hits']:
+                break
+    finally:
+        if scroll_id and clear_scroll:
+            _es_handle.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404, ))
 
+
+def get_es_scan_sliced(query, slice_id, max_slices=2,
+                       index='cms-20*', buffer_size=5000):
     body = {
         "slice": {
             "id": slice_id,
@@ -114,77 +208,297 @@ def get_es_scan_sliced(query, slice_id, max_slices=2,
     body.update(query)
 
     def es_scan():
-        resp = _es_handle.search(body=body, scroll='5m', size=buffer_size,
-                                 request_timeout=20, doc_type='job', index=index)
-
-        scroll_id = resp.get('_scroll_id')
-        if scroll_id is None:
-            return
-
-
-        try:
-            first_run = True
-            while True:
-                # if we didn't set search_type to scan initial search contains data
-                if first_run:
-                    first_run = False
-                else:
-                    resp = _es_handle.scroll(scroll_id, scroll='5m',
-                                             request_timeout=20)
-
-                for hit in resp['hits']['hits']:
-                    yield hit
-
-                # check if we have any errrors
-                if resp["_shards"]["successful"] < resp["_shards"]["total"]:
-                    logger.warning(
-                        'Scroll request has only succeeded on %d shards out of %d.',
-                        resp['_shards']['successful'], resp['_shards']['total']
-                    )
-                    if raise_on_error:
-                        raise ScanError(
-                            scroll_id,
-                            'Scroll request has only succeeded on %d shards out of %d.' %
-                                (resp['_shards']['successful'], resp['_shards']['total'])
-                        )
-
-                scroll_id = resp.get('_scroll_id')
-                # end of scroll
-                if scroll_id is None or not resp['hits']['hits']:
-                    break
-        finally:
-            if scroll_id and clear_scroll:
-                _es_handle.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404, ))
+        return scroll_hits(body, index=index, buffer_size=buffer_size)
 
     return es_scan
 
 
-def dump_to_file(data, n_docs, filename):
+def search_after_hits(query, sort, after=None, index='cms-20*', buffer_size=5000):
+    """
+    Page through all hits of a query in sort order with search_after,
+    starting after the sort values `after`. Unlike a scroll, this can be
+    resumed from the sort values of the last hit that was processed.
+    """
+    get_es_handle()
+    body = dict(query)
+    body['sort'] = sort
+    while True:
+        if after is not None:
+            body['search_after'] = after
+        resp = _es_handle.search(index=index, doc_type='job', size=buffer_size,
+                                 body=body)
+        hits = resp['hits']['hits']
+        for hit in hits:
+            yield hit
+
+        if len(hits) < buffer_size:
+            break
+        after = hits[-1]['sort']
+
+
+def get_target_shards(query, index='cms-20*'):
+    """
+    Return a list of (index, shard, n_docs) for all shards of the
+    concrete indices that hold docs matching the query
+    """
+    get_es_handle()
+    body = {"size": 0, "aggs": {"indices": {"terms": {"field": "_index", "size": 10000}}}}
+    body.update(query)
+    res = _es_handle.search(index=index, doc_type='job', request_timeout=60, body=body)
+    indices = [b['key'] for b in res['aggregations']['indices']['buckets']]
+
+    shards = []
+    for concrete_index in sorted(indices):
+        layout = _es_handle.search_shards(index=concrete_index)
+        for shard in sorted(set(s[0]['shard'] for s in layout['shards'])):
+            res = _es_handle.count(index=concrete_index, doc_type='job',
+                                   preference='_shards:%d' % shard,
+                                   request_timeout=60, body=codec.dumps(query))
+            if res['count']:
+                shards.append((concrete_index, shard, res['count']))
+
+    return shards
+
+
+def get_es_scan_shard(query, index, shard, buffer_size=5000):
+    """
+    Scan the docs matching the query in a single shard of a concrete
+    index, avoiding the per-document filter of a sliced scroll
+    """
+    return scroll_hits(query, index=index, buffer_size=buffer_size,
+                       preference='_shards:%d' % shard)
+
+
+class BackgroundWriter(object):
+    """
+    Write lines to a file in large chunks from a background thread, so
+    that reading from ES and writing to disk overlap. At most max_chunks
+    chunks of chunk_bytes are waiting to be written.
+    """
+    def __init__(self, filename, chunk_bytes=8*1024*1024, max_chunks=4):
+        self.chunk_bytes = chunk_bytes
+        self._file = open(filename, 'w')
+        self._queue = Queue.Queue(maxsize=max_chunks)
+        self._lines = []
+        self._n_bytes = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._write)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            if self._error is None:
+                try:
+                    self._file.write(chunk)
+                except IOError, e:
+                    self._error = e
+
+    def _flush(self):
+        if self._error is not None:
+            raise self._error
+        if self._lines:
+            self._queue.put(''.join(self._lines))
+            self._lines = []
+            self._n_bytes = 0
+
+    def write(self, line):
+        self._lines.append(line)
+        self._n_bytes += len(line)
+        if self._n_bytes >= self.chunk_bytes:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class JSONLinesWriter(BackgroundWriter):
+    """Write docs as one json document per line"""
+    def __init__(self, filename, compatible=False):
+        super(JSONLinesWriter, self).__init__(filename)
+        self._dumps = codec.dumps_compatible if compatible else codec.dumps
+
+    def write(self, doc):
+        super(JSONLinesWriter, self).write(self._dumps(doc) + '\n')
+
+
+def open_dump(filename, compatible=False, columnar=False):
+    """A writer of docs into a json (or columnar) dump"""
+    if columnar:
+        return ColumnarWriter(filename)
+    return JSONLinesWriter(filename, compatible=compatible)
+
+
+def dump_extension(columnar=False):
+    return '.col' if columnar else '.json'
+
+
+def dump_to_file(data, n_docs, filename, compatible=False, columnar=False):
+    """
+    Write docs to filename, one json document per line. With compatible,
+    the lines are byte-for-byte identical to the output of json.dump.
+    With columnar, write a columnar dump instead (see columnar.py).
+    """
     count = 0
     print_progress(count, n_docs)
-    with open(filename, 'w') as dfile:
+    with open_dump(filename, compatible=compatible, columnar=columnar) as writer:
         for doc in data:
-            json.dump(doc, dfile)
-            dfile.write('\n')
+            writer.write(doc)
             count += 1
-            if count % 100 == 0:
+            if count % 10000 == 0:
                 print_progress(count, n_docs)
 
     print ">>> Wrote %d/%d [100.0%%]" % (count, n_docs)
     print 'Dumped %d docs into %s' % (count, filename)
 
 
+def sharded_dump_dir(target, date_string):
+    """Directory of the shards of a day dumped with --slices"""
+    return os.path.join(target, 'es-cms-dump-%s' % date_string)
+
+
+def dump_slice(task):
+    """
+    Dump a slice of a day to <directory>/part-<slice_id>.json (or .col)
+    and return (date_string, slice_id, filename, n_docs). If the slice
+    fails, its partial file is removed and filename is None.
+    """
+    date_string, slice_id, n_slices, directory, compatible, columnar, buffer_size = task
+    timestamp = date_string_to_timestamp(date_string)
+    query = make_query(timestamp, timestamp + 24*60*60)
+    if n_slices > 1:
+        hits = get_es_scan_sliced(query, slice_id, max_slices=n_slices,
+                                  buffer_size=buffer_size)()
+    else:
+        hits = get_es_scan(query, buffer_size=buffer_size)
+
+    filename = os.path.join(directory, 'part-%03d%s' % (slice_id, dump_extension(columnar)))
+    count = 0
+    try:
+        with open_dump(filename + '.tmp', compatible=compatible, columnar=columnar) as writer:
+            for hit in hits:
+                writer.write(hit)
+                count += 1
+    except Exception, e:
+        print "&&& ERROR: %s: slice %d failed after %d docs: %s" % (date_string, slice_id, count, e)
+        if os.path.exists(filename + '.tmp'):
+            os.remove(filename + '.tmp')
+        return date_string, slice_id, None, count
+    os.rename(filename + '.tmp', filename)
+
+    return date_string, slice_id, os.path.basename(filename), count
+
+
+def write_manifest(directory, date_string, shards):
+    """List the shards of a day as [{'file': ..., 'n_docs': ...}]"""
+    manifest = {'date': date_string,
+                'n_docs': sum(s['n_docs'] for s in shards),
+                'shards': sorted(shards, key=lambda s: s['file'])}
+    tmpfile = os.path.join(directory, 'manifest.json.tmp')
+    with open(tmpfile, 'w') as mfile:
+        json.dump(manifest, mfile, indent=2, sort_keys=True)
+    os.rename(tmpfile, os.path.join(directory, 'manifest.json'))
+
+
+def read_manifest(directory):
+    """Return a list of (filename, n_docs) of the shards of a sharded dump"""
+    with open(os.path.join(directory, 'manifest.json'), 'r') as mfile:
+        manifest = json.load(mfile)
+    return [(os.path.join(directory, s['file']), s['n_docs']) for s in manifest['shards']]
+
+
+def dump_sharded(date_strings, target, n_slices, workers=4, compatible=False, columnar=False,
+                 buffer_size=5000):
+    """
+    Dump days in n_slices slices each, running up to workers slices of
+    any of the days at the same time. Each slice is written to its own
+    shard, and a manifest listing the shards is written once all slices
+    of a day are there and add up to the number of docs in ES. A failed
+    slice leaves its day without a manifest, the other days go on.
+    """
+    starttime = time.time()
+    expected = {}
+    tasks = []
+    for date_string in date_strings:
+        timestamp = date_string_to_timestamp(date_string)
+        if not timestamp:
+            continue
+
+        directory = sharded_dump_dir(target, date_string)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        expected[date_string] = get_total_hits(make_query(timestamp, timestamp+24*60*60))
+        tasks.extend((date_string, slice_id, n_slices, directory, compatible, columnar,
+                      buffer_size) for slice_id in range(n_slices))
+
+    shards = {date_string: [] for date_string in expected}
+    failed = {date_string: [] for date_string in expected}
+    pool = multiprocessing.Pool(workers)
+    try:
+        for date_string, slice_id, filename, count in pool.imap_unordered(dump_slice, tasks):
+            if filename is None:
+                failed[date_string].append(slice_id)
+            else:
+                shards[date_string].append({'file': filename, 'n_docs': count})
+                print ">>> %s: slice %d of %d done, %d docs, %.2f mins" % (
+                    date_string, slice_id+1, n_slices, count, (time.time()-starttime)/60.)
+            if len(shards[date_string]) + len(failed[date_string]) < n_slices:
+                continue
+
+            n_docs = sum(s['n_docs'] for s in shards[date_string])
+            directory = sharded_dump_dir(target, date_string)
+            if failed[date_string]:
+                print ">>> %s: failed slices %s, no manifest written" % (
+                    date_string, ', '.join(str(n) for n in sorted(failed[date_string])))
+                continue
+            if n_docs != expected[date_string]:
+                print ">>> %s: %d docs dumped, but %d in ES, no manifest written" % (
+                    date_string, n_docs, expected[date_string])
+                continue
+
+            write_manifest(directory, date_string, shards[date_string])
+            print 'Dumped %d docs into %d shards in %s' % (n_docs, n_slices, directory)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def main(args):
+    configure_es(timeout=args.es_timeout,
+                 max_retries=args.es_retries,
+                 http_compress=not args.es_no_compress)
+    if args.slices:
+        dump_sharded(args.recordtimes, args.target, args.slices, workers=args.workers,
+                     compatible=args.compatible_json, columnar=args.columnar,
+                     buffer_size=args.es_buffer_size)
+        return
+
     for date_string in args.recordtimes:
         timestamp = date_string_to_timestamp(date_string)
         print "Querying for %s, %d-%d" % (date_string, timestamp, timestamp+24*60*60)
 
         query = make_query(timestamp, timestamp+24*60*60)
         n_docs = get_total_hits(query)
-        data = get_es_scan(query)
+        data = get_es_scan(query, buffer_size=args.es_buffer_size)
 
-        dumpfile = os.path.join(args.target, 'es-cms-dump-%s.json' % date_string)
-        dump_to_file(data, n_docs, dumpfile)
+        dumpfile = os.path.join(args.target, 'es-cms-dump-%s%s' % (date_string,
+                                                                   dump_extension(args.columnar)))
+        dump_to_file(data, n_docs, dumpfile, compatible=args.compatible_json,
+                     columnar=args.columnar)
 
 
 if __name__ == '__main__':
@@ -194,6 +508,31 @@ if __name__ == '__main__':
     parser.add_argument("--target", default='/data/raw_index_data/',
                         type=str, dest="target",
                         help="Target destination [default: %(default)s]")
+    parser.add_argument("--compatible_json", action='store_true',
+                        dest="compatible_json",
+                        help="Write the docs exactly as the json module would")
+    parser.add_argument("--columnar", action='store_true',
+                        dest="columnar",
+                        help="Write columnar dumps (.col), see columnar.py")
+    parser.add_argument("--slices", default=0,
+                        type=int, dest="slices",
+                        help="Dump every day in this many slices, into a directory of shards "
+                             "with a manifest (0: into a single file) [default: %(default)s]")
+    parser.add_argument("--workers", default=4,
+                        type=int, dest="workers",
+                        help="With --slices, dump this many slices of any of the days at once [default: %(default)s]")
+    parser.add_argument("--es_buffer_size", default=5000,
+                        type=int, dest="es_buffer_size",
+                        help="Buffer size for elasticsearch scan [default: %(default)s]")
+    parser.add_argument("--es_timeout", default=20,
+                        type=float, dest="es_timeout",
+                        help="Timeout of ES requests in seconds [default: %(default)s]")
+    parser.add_argument("--es_retries", default=3,
+                        type=int, dest="es_retries",
+                        help="Retry failed ES requests this many times, waiting 1, 3, 7... s [default: %(default)s]")
+    parser.add_argument("--es_no_compress", action='store_true',
+                        dest="es_no_compress",
+                        help="Don't ask ES for gzipped responses")
     args = parser.parse_args()
 
     main(args)
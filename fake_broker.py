@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Minimal local STOMP broker for testing and benchmarking the AMQ upload.
+
+It accepts any login, answers receipts, and unpacks the documents of every
+SEND frame (plain or batched, see StompAMQ.unpack) to count them.
+"""
+import socket
+import threading
+import SocketServer
+
+from argparse import ArgumentParser
+
+from StompAMQ import StompAMQ
+
+
+_UNESCAPE = [('\\n', '\n'), ('\\c', ':'), ('\\r', '\r'), ('\\\\', '\\')]
+
+
+def parse_headers(lines):
+    headers = {}
+    for line in lines:
+        if ':' not in line:
+            continue
+        key, val = line.split(':', 1)
+        for escaped, char in _UNESCAPE:
+            val = val.replace(escaped, char)
+        # The first occurrence of a repeated header wins
+        headers.setdefault(key, val)
+    return headers
+
+
+def make_frame(command, headers=None):
+    lines = [command] + ['%s:%s' % kv for kv in (headers or {}).items()]
+    return '\n'.join(lines) + '\n\n\x00'
+
+
+class FrameReader(object):
+    """Split a stream of bytes into (command, headers, body) frames"""
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while True:
+            # Skip heart-beats
+            self.buffer = self.buffer.lstrip('\r\n')
+            head_end = self.buffer.find('\n\n')
+            if head_end < 0:
+                break
+
+            lines = self.buffer[:head_end].split('\n')
+            headers = parse_headers(l.rstrip('\r') for l in lines[1:])
+            body_start = head_end + 2
+            if 'content-length' in headers:
+                body_end = body_start + int(headers['content-length'])
+                if len(self.buffer) <= body_end:
+                    break
+            else:
+                body_end = self.buffer.find('\x00', body_start)
+                if body_end < 0:
+                    break
+
+            frames.append((lines[0].strip(), headers, self.buffer[body_start:body_end]))
+            self.buffer = self.buffer[body_end+1:]
+        return frames
+
+
+class StompHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        reader = FrameReader()
+        while True:
+            try:
+                data = self.request.recv(1 << 16)
+            except socket.error:
+                return
+            if not data:
+                return
+
+            for command, headers, body in reader.feed(data):
+                if command in ('CONNECT', 'STOMP'):
+                    self.request.sendall(make_frame('CONNECTED', {'version': '1.1',
+                                                                  'heart-beat': '0,0'}))
+                    continue
+
+                if command == 'SEND':
+                    broker.receive(headers, body)
+
+                if 'receipt' in headers:
+                    self.request.sendall(make_frame('RECEIPT',
+                                                    {'receipt-id': headers['receipt']}))
+
+                if command == 'DISCONNECT':
+                    return
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeBroker(object):
+    """
+    Local STOMP broker running in a background thread.
+
+    :param port: Port to listen on (0 picks a free one, see `port`)
+    :param keep_messages: Keep all received (headers, docs) for inspection
+    """
+    def __init__(self, host='127.0.0.1', port=0, keep_messages=False):
+        self.keep_messages = keep_messages
+        self.messages = []
+        self.n_frames = 0
+        self.n_docs = 0
+        self.n_bytes = 0
+        self._lock = threading.Lock()
+
+        self._server = ThreadingServer((host, port), StompHandler)
+        self._server.broker = self
+        self.host, self.port = self._server.server_address
+        self._thread = None
+
+    def host_and_ports(self):
+        return [(self.host, self.port)]
+
+    def receive(self, headers, body):
+        docs = StompAMQ.unpack(headers, body)
+        with self._lock:
+            self.n_frames += 1
+            self.n_docs += len(docs)
+            self.n_bytes += len(body)
+            if self.keep_messages:
+                self.messages.append((headers, docs))
+
+    def reset(self):
+        with self._lock:
+            self.messages = []
+            self.n_frames = self.n_docs = self.n_bytes = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main(args):
+    broker = FakeBroker(host=args.host, port=args.port)
+    print "Fake broker listening on %s:%d" % (broker.host, broker.port)
+    try:
+        broker._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print "Received %d docs in %d frames (%d bytes)" % (broker.n_docs, broker.n_frames, broker.n_bytes)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--host", default='127.0.0.1',
+                        type=str, dest="host",
+                        help="Listen on this address [default: %(default)s]")
+    parser.add_argument("--port", default=61613,
+                        type=int, dest="port",
+                        help="Listen on this port [default: %(default)s]")
+    args = parser.parse_args()
+
+    main(args)
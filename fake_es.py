@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""
+Minimal local Elasticsearch for testing and benchmarking the ES reads.
+
+It serves a fixed set of synthetic job ads (see bench_amq.synthetic_ad)
+to every search, scroll and count within a RecordTime range or with a
+RecordTime term (all other queries match everything), honouring slices
+and shard preferences, as one index with a number of equally large
+shards. Sorting by RecordTime and _id with search_after, and RecordTime
+histograms (by the mapping of RecordTime) with the _id hash sums of
+verify_dump.py are supported as well. Responses are
+gzip-compressed for clients that accept it. An optional latency per
+request and bandwidth limit mimic the network to the real cluster, and
+with a capacity, responses slow down when more requests than that are
+served at the same time.
+
+As all zlib calls of a python 2 process share a lock, processes forked
+from one that runs a FakeES can deadlock when it was compressing at that
+moment; tests that fork readers ask for uncompressed responses.
+"""
+import json
+import time
+import zlib
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from argparse import ArgumentParser
+
+import codec
+
+from bench_amq import synthetic_ad
+
+
+def java_hash(string):
+    """String.hashCode of an ASCII string"""
+    hash_ = 0
+    for char in string:
+        hash_ = (31*hash_ + ord(char)) & 0xffffffff
+    return hash_ - 2**32 if hash_ >= 2**31 else hash_
+
+
+class ESHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.es.connected(self.client_address)
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get('content-length') or 0))
+        if body and self.headers.get('content-encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return codec.loads(body) if body else {}
+
+    def respond(self, payload):
+        headers = [('Content-Type', 'application/json; charset=UTF-8')]
+        if 'gzip' in (self.headers.get('accept-encoding') or ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            payload = compressor.compress(payload) + compressor.flush()
+            headers.append(('Content-Encoding', 'gzip'))
+
+        self.server.es.throttle(len(payload))
+        self.send_response(200)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def handle_request(self):
+        es = self.server.es
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        body = self.read_body()
+        path = url.path.rstrip('/')
+
+        if '/_mapping/' in path:
+            payload = json.dumps(es.mapping())
+        elif path.endswith('/_search_shards'):
+            payload = json.dumps({'shards': [[{'index': es.index, 'shard': n, 'primary': True}]
+                                             for n in range(es.n_shards)]})
+        elif path.endswith('/_search/scroll') and self.command == 'DELETE':
+            payload = json.dumps({'succeeded': True, 'num_freed': 1})
+        elif path.endswith('/_search/scroll'):
+            payload = es.scroll(body.get('scroll_id') or params.get('scroll_id'))
+        elif path.endswith('/_search'):
+            size = int(params.get('size', body.get('size', 10)))
+            rows = es.matching(body, params.get('preference'))
+            payload = es.search(rows, size, scroll='scroll' in params, aggs=body.get('aggs'),
+                                sort=es.sort_fields(body))
+        elif path.endswith('/_count'):
+            payload = json.dumps({'count': len(es.matching(body, params.get('preference')))})
+        else:
+            payload = json.dumps({'version': {'number': '6.3.1'}})
+
+        es.busy(1)
+        try:
+            self.respond(payload)
+        finally:
+            es.busy(-1)
+
+    do_GET = do_POST = do_DELETE = do_HEAD = handle_request
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeES(object):
+    """
+    Local Elasticsearch running in a background thread.
+
+    :param n_docs: Number of synthetic docs every search returns
+    :param n_attributes: Number of attributes per doc
+    :param latency: Seconds to wait before every response
+    :param bandwidth: Bytes per second to send responses with (0: no limit)
+    :param capacity: Number of requests served at full speed at the same
+        time; beyond that, latency and bandwidth degrade proportionally
+        (0: no limit)
+    :param n_shards: Number of shards reported by search_shards
+    :param record_time_type: Mapping type of RecordTime, 'long' (seconds)
+        or 'date'
+    :param docs_per_second: Number of docs with the same RecordTime, one
+        second after the previous ones
+    """
+    def __init__(self, n_docs=10000, n_attributes=200, host='127.0.0.1', port=0,
+                 latency=0., bandwidth=0, capacity=0, n_shards=5, record_time_type='long',
+                 docs_per_second=1):
+        self.record_time_type = record_time_type
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.capacity = capacity
+        self.n_shards = n_shards
+        self.index = 'cms-2017-07-14'
+        self.n_busy = 0
+        ads = [synthetic_ad(i, n_attributes) for i in range(n_docs)]
+        for i, ad in enumerate(ads):
+            ad['RecordTime'] = ad['CompletionDate'] = 1500000000 + i // docs_per_second
+        self.record_times = [ad['RecordTime'] for ad in ads]
+        self.hits = [codec.dumps({'_index': self.index, '_type': 'job', '_id': str(i),
+                                  '_score': None, '_source': ad})
+                     for i, ad in enumerate(ads)]
+        self.scrolls = {}
+        self.connections = set()
+        self.n_requests = 0
+        self.n_bytes = 0
+        self._lock = threading.Lock()
+
+        self._server = ThreadingServer((host, port), ESHandler)
+        self._server.es = self
+        self.host, self.port = self._server.server_address
+        self._thread = None
+
+    def hosts(self):
+        return [{'host': self.host, 'port': self.port}]
+
+    def connected(self, client_address):
+        with self._lock:
+            self.connections.add(client_address)
+
+    def busy(self, change):
+        with self._lock:
+            self.n_busy += change
+
+    def throttle(self, n_bytes):
+        with self._lock:
+            self.n_requests += 1
+            self.n_bytes += n_bytes
+            load = max(float(self.n_busy) / self.capacity, 1.) if self.capacity else 1.
+        time.sleep(load * (self.latency + (float(n_bytes) / self.bandwidth if self.bandwidth else 0.)))
+
+    def mapping(self):
+        field = {'full_name': 'RecordTime', 'mapping': {'RecordTime': {'type': self.record_time_type}}}
+        return {self.index: {'mappings': {'job': {'RecordTime': field}}}}
+
+    @staticmethod
+    def sort_fields(body):
+        """The sort of a search, None for index order (as by a scan)"""
+        sort = body.get('sort')
+        if not sort or sort == '_doc' or sort == ['_doc']:
+            return None
+        return sort
+
+    def sort_values(self, row, sort):
+        """Sort values of a hit, for a sort on RecordTime and/or _id"""
+        return [self.record_times[row] if field.keys()[0] == 'RecordTime' else str(row)
+                for field in sort]
+
+    def matching(self, body, preference=None):
+        """
+        Return the rows of the hits matching the RecordTime range or term,
+        slice and shard, in sort order and after search_after
+        """
+        selected = range(len(self.hits))
+        time_range = body.get('query', {}).get('range', {}).get('RecordTime')
+        if time_range:
+            selected = [i for i in selected
+                        if time_range.get('gte', 0) <= self.record_times[i] < time_range.get('lt', 2**62)]
+        time_term = body.get('query', {}).get('term', {}).get('RecordTime')
+        if time_term is not None:
+            selected = [i for i in selected if self.record_times[i] == time_term]
+        if preference and preference.startswith('_shards:'):
+            shard = int(preference[len('_shards:'):])
+            selected = [i for i in selected if i % self.n_shards == shard]
+        if body.get('slice'):
+            selected = selected[body['slice']['id']::body['slice']['max']]
+        sort = self.sort_fields(body)
+        if sort:
+            selected.sort(key=lambda i: self.sort_values(i, sort))
+            if body.get('search_after'):
+                selected = [i for i in selected if self.sort_values(i, sort) > body['search_after']]
+        return selected
+
+    def select(self, body, preference=None):
+        """Return the hits matching the RecordTime range, slice and shard"""
+        return [self.hits[i] for i in self.matching(body, preference)]
+
+    def aggregate(self, rows, agg):
+        """Buckets of a terms aggregation on _index or a RecordTime histogram"""
+        if 'terms' in agg:
+            return [{'key': self.index, 'doc_count': len(rows)}] if rows else []
+
+        if 'date_histogram' in agg:
+            # Bucketed in milliseconds, whatever the interval says
+            factor, interval = 1000, 3600*1000
+        else:
+            factor, interval = 1, agg['histogram']['interval']
+        windows = {}
+        for row in rows:
+            key = self.record_times[row]*factor
+            windows.setdefault(key - key % interval, []).append(row)
+        buckets = [{'key': key, 'doc_count': len(windows[key])} for key in sorted(windows)]
+        for name, sub_agg in agg.get('aggs', {}).iteritems():
+            # The only script is the hash of the _ids of verify_dump
+            assert "doc['_id'].value.hashCode()" in sub_agg['sum']['script']['source']
+            for bucket in buckets:
+                bucket[name] = {'value': float(sum(java_hash(str(row)) for row in windows[bucket['key']]))}
+        return buckets
+
+    def page(self, hits, start, size, scroll_id=None, total=None):
+        head = {'took': 1, 'timed_out': False,
+                '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0}}
+        if scroll_id is not None:
+            head['_scroll_id'] = scroll_id
+        head = json.dumps(head)[:-1]
+        return '%s, "hits": {"total": %d, "max_score": null, "hits": [%s]}}' % (
+            head, len(hits) if total is None else total, ','.join(hits[start:start+size]))
+
+    def search(self, rows, size, scroll=False, aggs=None, sort=None):
+        if aggs:
+            name = aggs.keys()[0]
+            return json.dumps({'took': 1, 'timed_out': False,
+                               'hits': {'total': len(rows), 'max_score': 0, 'hits': []},
+                               'aggregations': {name: {'buckets': self.aggregate(rows, aggs[name])}}})
+        if sort:
+            # Only the first page of a sorted search, as search_after pages
+            hits = ['%s, "sort": %s}' % (self.hits[i][:-1], json.dumps(self.sort_values(i, sort)))
+                    for i in rows[:size]]
+            return self.page(hits, 0, size, total=len(rows))
+
+        hits = [self.hits[i] for i in rows]
+        if not scroll:
+            return self.page(hits, 0, size)
+
+        with self._lock:
+            scroll_id = str(len(self.scrolls))
+            self.scrolls[scroll_id] = (hits, size, size)
+        return self.page(hits, 0, size, scroll_id)
+
+    def scroll(self, scroll_id):
+        with self._lock:
+            hits, start, size = self.scrolls[scroll_id]
+            self.scrolls[scroll_id] = (hits, start + size, size)
+        return self.page(hits, start, size, scroll_id)
+
+    def reset(self):
+        with self._lock:
+            self.scrolls = {}
+            self.connections = set()
+            self.n_requests = self.n_bytes = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main(args):
+    es = FakeES(n_docs=args.n_docs, n_attributes=args.n_attributes,
+                host=args.host, port=args.port,
+                latency=args.latency, bandwidth=args.bandwidth,
+                capacity=args.capacity, n_shards=args.n_shards)
+    print "Fake ES listening on %s:%d" % (es.host, es.port)
+    try:
+        es._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print "Served %d requests (%d bytes) on %d connections" % (es.n_requests, es.n_bytes,
+                                                              len(es.connections))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--host", default='127.0.0.1',
+                        type=str, dest="host",
+                        help="Listen on this address [default: %(default)s]")
+    parser.add_argument("--port", default=9200,
+                        type=int, dest="port",
+                        help="Listen on this port [default: %(default)s]")
+    parser.add_argument("--n_docs", default=10000,
+                        type=int, dest="n_docs",
+                        help="Number of docs to serve [default: %(default)s]")
+    parser.add_argument("--n_attributes", default=200,
+                        type=int, dest="n_attributes",
+                        help="Number of attributes per doc [default: %(default)s]")
+    parser.add_argument("--latency", default=0.,
+                        type=float, dest="latency",
+                        help="Delay of every response in seconds [default: %(default)s]")
+    parser.add_argument("--bandwidth", default=0.,
+                        type=float, dest="bandwidth",
+                        help="Send responses at this many bytes per second (0: no limit) [default: %(default)s]")
+    parser.add_argument("--capacity", default=0,
+                        type=int, dest="capacity",
+                        help="Concurrent requests served at full speed (0: no limit) [default: %(default)s]")
+    parser.add_argument("--n_shards", default=5,
+                        type=int, dest="n_shards",
+                        help="Number of shards of the index [default: %(default)s]")
+    args = parser.parse_args()
+
+    main(args)
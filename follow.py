@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Follow ES continuously and transfer new docs as they come in.
+
+The state is a RecordTime high-water mark: all docs before it were sent.
+Every --interval seconds, the docs from the high-water mark up to now
+minus the --lateness margin (at most --max_window seconds at a time) are
+read in (RecordTime, _id) order and uploaded, after which the high-water
+mark moves to the end of that window. Within a window, the position of
+the last uploaded batch is saved as well (see resume.py). Delivery is at
+least once: a batch is uploaded before its position is saved, so after a
+crash or a failed window at most one batch (--amq_buffer_size docs) is
+sent again. The state file is written with fsync and an atomic rename.
+A window that fails is retried from the saved state after --interval.
+
+Docs that show up in ES later than the lateness margin are missed; fill
+such gaps with reconcile.py.
+"""
+import os
+import json
+import time
+import errno
+
+from argparse import ArgumentParser
+
+from amq import configure as configure_amq
+from sinks import make_sink
+from ledger import SendLedger
+from resume import SORT
+from resume import window_query
+from resume import make_position
+from dump_es_bytimestamp import configure_es
+from dump_es_bytimestamp import search_after_hits
+from dump_es_bytimestamp import date_string_to_timestamp
+from transfer_by_timestamp import upload_batch
+from transfer_helpers import set_up_logging
+
+
+class HighWaterMark(object):
+    """
+    RecordTime up to which all docs were sent, and the position of the
+    last doc sent after it, persisted in a json file
+    {'hwm': ts, 'position': ...}
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.hwm = None
+        self.position = None
+        self.load()
+
+    def load(self):
+        """Read the state, a missing file means starting fresh"""
+        try:
+            with open(self.filename, 'r') as sfile:
+                state = json.load(sfile)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.hwm, self.position = None, None
+            return
+        self.hwm, self.position = state['hwm'], state.get('position')
+
+    def save(self):
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'w') as sfile:
+            json.dump({'hwm': self.hwm, 'position': self.position}, sfile, sort_keys=True)
+            sfile.flush()
+            os.fsync(sfile.fileno())
+        os.rename(tmpfile, self.filename)
+
+        # Make the rename itself durable
+        dirfd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+    def ack(self, position):
+        self.position = position
+        self.save()
+
+    def advance(self, hwm):
+        self.hwm = hwm
+        self.position = None
+        self.save()
+
+
+def follow_window(state, ts_to, sink, index='cms-20*', buffer_size=5000, batch_size=5000):
+    """
+    Send the docs from the high-water mark (after its position) up to
+    ts_to, and move the high-water mark there. Return the number of docs
+    sent and the RecordTime of the oldest one.
+    """
+    count = 0
+    oldest = None
+    batch = []
+    last = None
+    after = state.position['sort'] if state.position else None
+    for hit in search_after_hits(window_query(state.hwm, ts_to, state.position), SORT,
+                                 after=after, index=index, buffer_size=buffer_size):
+        doc = hit['_source']
+        last = make_position(hit, doc) # before upload_batch changes the dates
+        if oldest is None:
+            oldest = doc['RecordTime']
+        batch.append(doc)
+        if len(batch) == batch_size:
+            count += upload_batch(batch, sink)
+            state.ack(last)
+            batch = []
+
+    if batch:
+        count += upload_batch(batch, sink)
+    state.advance(ts_to)
+    return count, oldest
+
+
+def follow(state, sink, args):
+    """Transfer windows of new docs until stopped (or caught up, with once)"""
+    while True:
+        now = int(time.time())
+        ts_to = min(now - args.lateness, state.hwm + args.max_window)
+        if ts_to <= state.hwm:
+            if args.once:
+                return
+            time.sleep(args.interval)
+            continue
+
+        starttime = time.time()
+        ts_from = state.hwm
+        try:
+            n_docs, oldest = follow_window(state, ts_to, sink, index=args.index,
+                                           buffer_size=args.es_buffer_size,
+                                           batch_size=args.amq_buffer_size)
+        except Exception, e:
+            if args.once:
+                raise
+            print ">>> %s - %s failed: %s, retrying in %.0f s" % (
+                time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts_from)),
+                time.strftime('%H:%M:%S', time.gmtime(ts_to)), e, args.interval)
+            state.load() # continue from what was acknowledged
+            time.sleep(args.interval)
+            continue
+        print ">>> %s - %s: %d docs in %.1f s, %s" % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts_from)),
+            time.strftime('%H:%M:%S', time.gmtime(ts_to)),
+            n_docs, time.time() - starttime,
+            "%.0f s after their RecordTime" % (time.time() - oldest) if n_docs else "nothing new")
+
+        if ts_to >= now - args.lateness and not args.once:
+            time.sleep(args.interval)
+
+
+def main(args):
+    configure_amq(spool_file=args.spool_file or None,
+                  batch_size=args.amq_batch_docs,
+                  batch_bytes=args.amq_batch_bytes,
+                  compression=args.amq_compression,
+                  fan_out=args.amq_fan_out,
+                  persistent=True)
+    configure_es(timeout=args.es_timeout,
+                 max_retries=args.es_retries,
+                 http_compress=not args.es_no_compress)
+
+    state = HighWaterMark(args.state_file)
+    if state.hwm is None:
+        if args.since:
+            state.advance(date_string_to_timestamp(args.since))
+        else:
+            state.advance(int(time.time()) - args.lateness)
+    print ">>> Following %s from %s" % (args.index,
+                                        time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(state.hwm)))
+
+    sink = make_sink(args.sink, frames_dir=args.frames_dir,
+                     ledger=SendLedger(args.ledger_file) if args.ledger_file else None)
+    try:
+        follow(state, sink, args)
+    except KeyboardInterrupt:
+        print ">>> Stopped"
+    finally:
+        sink.close()
+        print ">>> %s" % sink.summary()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--state_file", default='follow_state.json',
+                        type=str, dest="state_file",
+                        help="Keep the RecordTime high-water mark here [default: %(default)s]")
+    parser.add_argument("--since", default='',
+                        type=str, dest="since",
+                        help="Without a state file, start at this day (YYYY-MM-DD) instead of now "
+                             "[default: %(default)s]")
+    parser.add_argument("--lateness", default=300,
+                        type=int, dest="lateness",
+                        help="Wait this many seconds after a RecordTime for its docs to arrive in ES "
+                             "[default: %(default)s]")
+    parser.add_argument("--interval", default=30.,
+                        type=float, dest="interval",
+                        help="Seconds between looking for new docs once caught up, and before retrying a failed "
+                             "window [default: %(default)s]")
+    parser.add_argument("--max_window", default=15*60,
+                        type=int, dest="max_window",
+                        help="Send at most this many seconds of RecordTime at a time, and save the "
+                             "high-water mark after each [default: %(default)s]")
+    parser.add_argument("--once", action='store_true',
+                        dest="once",
+                        help="Stop when caught up instead of following")
+    parser.add_argument("--index", default='cms-20*',
+                        type=str, dest="index",
+                        help="Follow these indices [default: %(default)s]")
+    parser.add_argument("--es_buffer_size", default=5000,
+                        type=int, dest="es_buffer_size",
+                        help="Buffer size for elasticsearch scan [default: %(default)s]")
+    parser.add_argument("--es_timeout", default=20,
+                        type=float, dest="es_timeout",
+                        help="Timeout of ES requests in seconds [default: %(default)s]")
+    parser.add_argument("--es_retries", default=3,
+                        type=int, dest="es_retries",
+                        help="Retry failed ES requests this many times, waiting 1, 3, 7... s [default: %(default)s]")
+    parser.add_argument("--es_no_compress", action='store_true',
+                        dest="es_no_compress",
+                        help="Don't ask ES for gzipped responses")
+    parser.add_argument("--amq_buffer_size", default=5000,
+                        type=int, dest="amq_buffer_size",
+                        help="Buffer size for AMQ upload [default: %(default)s]")
+    parser.add_argument("--sink", default='amq',
+                        choices=['amq', 'frames', 'null'], dest="sink",
+                        help="Send to AMQ, write frames to --frames_dir, or only encode and count [default: %(default)s]")
+    parser.add_argument("--frames_dir", default='frames/',
+                        type=str, dest="frames_dir",
+                        help="Directory for the frames sink [default: %(default)s]")
+    parser.add_argument("--spool_file", default='amq_spool.json',
+                        type=str, dest="spool_file",
+                        help="Keep notifications that failed to send here for replay_spool.py [default: %(default)s]")
+    parser.add_argument("--ledger_file", default='ledger.json',
+                        type=str, dest="ledger_file",
+                        help="Count the docs sent to AMQ per hour of RecordTime here, for reconcile.py "
+                             "(empty to disable) [default: %(default)s]")
+    parser.add_argument("--amq_batch_docs", default=1,
+                        type=int, dest="amq_batch_docs",
+                        help="Pack up to this many docs into a single AMQ message [default: %(default)s]")
+    parser.add_argument("--amq_batch_bytes", default=512*1024,
+                        type=int, dest="amq_batch_bytes",
+                        help="Maximum size in bytes of a packed AMQ message [default: %(default)s]")
+    parser.add_argument("--amq_compression", default=None,
+                        choices=['gzip', 'zlib'], dest="amq_compression",
+                        help="Compress AMQ message bodies [default: %(default)s]")
+    parser.add_argument("--amq_fan_out", default=None,
+                        choices=['round_robin', 'least_loaded'], dest="amq_fan_out",
+                        help="Spread AMQ messages over all broker nodes [default: %(default)s]")
+    args = parser.parse_args()
+
+    set_up_logging()
+    main(args)
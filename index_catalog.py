@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Local catalog of ES indices with their sizes, cached in a json file.
+
+The cache has the same layout as the output of _cat/indices (one row per
+index, keyed by index name), with an additional 'fetched_at' timestamp per
+row. Only new indices and indices that can still change are refreshed.
+"""
+import os
+import json
+import time
+from datetime import datetime
+from argparse import ArgumentParser
+
+from dump_es_bytimestamp import get_es_handle
+from transfer_helpers import bin_pack
+
+
+_COLUMNS = 'index,health,status,pri,rep,docs.count,pri.store.size,store.size'
+
+
+_UNITS = {'b': 1, 'kb': 1024, 'mb': 1024**2, 'gb': 1024**3, 'tb': 1024**4, 'pb': 1024**5}
+
+
+def parse_size(size):
+    """Convert a _cat size like '12.3gb' (or plain bytes) to bytes"""
+    size = str(size or 0).strip().lower()
+    for unit in ('kb', 'mb', 'gb', 'tb', 'pb', 'b'):
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * _UNITS[unit])
+    return int(float(size))
+
+
+def index_date(index, prefix='cms-'):
+    """Return the date of a daily index like cms-2017-06-14, or None"""
+    try:
+        return datetime.strptime(index[len(prefix):len(prefix)+10], '%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def is_final(index, fetched_at, settle_days=3):
+    """Daily indices stop changing a few days after their date"""
+    date = index_date(index)
+    if date is None:
+        return False
+    settled = (date - datetime(1970, 1, 1)).total_seconds() + (settle_days+1)*24*60*60
+    return fetched_at > settled
+
+
+def fetch_index_names(pattern='cms-20'):
+    rows = get_es_handle().cat.indices(index='%s*' % pattern, h='index',
+                                       format='json', request_timeout=60)
+    return sorted(r['index'] for r in rows)
+
+
+def fetch_index_rows(indices, batch_size=100):
+    """Fetch the _cat/indices rows for a list of indices"""
+    rows = {}
+    fetched_at = int(time.time())
+    for start in range(0, len(indices), batch_size):
+        batch = indices[start:start+batch_size]
+        for row in get_es_handle().cat.indices(index=','.join(batch), h=_COLUMNS,
+                                               bytes='b', format='json',
+                                               request_timeout=60):
+            row['fetched_at'] = fetched_at
+            rows[row['index']] = row
+    return rows
+
+
+class IndexCatalog(object):
+    """
+    Cached catalog of indices matching a pattern.
+
+    :param pattern: Prefix of the index names to consider
+    :param cache_file: Location of the json cache
+    :param max_age: Refresh changing indices older than this (in seconds)
+    """
+    def __init__(self, pattern='cms-20', cache_file='indices.json', max_age=60*60):
+        self.pattern = pattern
+        self.cache_file = cache_file
+        self.max_age = max_age
+        self.indices = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_file, 'r') as cachefile:
+                self.indices = json.load(cachefile)
+        except IOError:
+            self.indices = {}
+
+    def save(self):
+        tmpfile = self.cache_file + '.tmp'
+        with open(tmpfile, 'w') as cachefile:
+            json.dump(self.indices, cachefile, indent=2, sort_keys=True)
+        os.rename(tmpfile, self.cache_file)
+
+    def is_stale(self, index, now=None):
+        now = now or time.time()
+        row = self.indices.get(index)
+        if row is None:
+            return True
+        fetched_at = row.get('fetched_at', 0)
+        if is_final(index, fetched_at):
+            return False
+        return now - fetched_at > self.max_age
+
+    def refresh(self, full=False):
+        """
+        Update the catalog from ES. Only new and stale indices are
+        fetched, unless full is set. Deleted indices are dropped.
+
+        :return: the number of refreshed indices
+        """
+        names = fetch_index_names(self.pattern)
+        for index in set(self.indices.keys()).difference(names):
+            del self.indices[index]
+
+        now = time.time()
+        to_fetch = [i for i in names if full or self.is_stale(i, now)]
+        self.indices.update(fetch_index_rows(to_fetch))
+        self.save()
+        return len(to_fetch)
+
+    def names(self):
+        return sorted(self.indices.keys())
+
+    def size(self, index):
+        return parse_size(self.indices[index].get('pri.store.size'))
+
+    def doc_count(self, index):
+        return int(self.indices[index].get('docs.count') or 0)
+
+    def largest_first(self, indices=None):
+        indices = self.names() if indices is None else indices
+        return sorted(indices, key=lambda i: (-self.size(i), i))
+
+    def bin_pack(self, n_workers, indices=None):
+        """
+        Distribute indices over n_workers such that the largest total
+        size of any worker is small (longest processing time first).
+
+        :return: a list of n_workers lists of index names
+        """
+        return bin_pack(self.largest_first(indices), n_workers, self.size)
+
+
+def main(args):
+    catalog = IndexCatalog(pattern=args.pattern, cache_file=args.cache_file)
+    n_refreshed = catalog.refresh(full=args.full)
+    print "Refreshed %d of %d indices for pattern '%s'" % (
+        n_refreshed, len(catalog.indices), args.pattern)
+    print "Wrote index information to '%s'" % args.cache_file
+
+    if args.workers > 1:
+        for n, indices in enumerate(catalog.bin_pack(args.workers)):
+            print "Worker %d: %d indices, %.1f GB" % (
+                n, len(indices), sum(catalog.size(i) for i in indices)/1e9)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--pattern", default='cms-20',
+                        type=str, dest="pattern",
+                        help="Prefix of the indices [default: %(default)s]")
+    parser.add_argument("--cache_file", default='indices.json',
+                        type=str, dest="cache_file",
+                        help="Local cache of the index information [default: %(default)s]")
+    parser.add_argument("--full", action='store_true',
+                        dest="full",
+                        help="Refresh all indices, not only new or changing ones")
+    parser.add_argument("--workers", default=1,
+                        type=int, dest="workers",
+                        help="Show the split of indices over this many workers [default: %(default)s]")
+    args = parser.parse_args()
+
+    main(args)
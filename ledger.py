@@ -0,0 +1,76 @@
+"""
+Ledger of the docs that were actually sent to AMQ.
+
+Docs are counted per hour of RecordTime (the windows of verify_dump) when
+the broker accepted them; docs that failed and were spooled or dropped
+are not counted. The counts are kept in a json file {bucket: n_docs} that
+several processes can add to at the same time. See reconcile.py for the
+comparison with ES.
+"""
+import os
+import json
+import fcntl
+
+
+BUCKET = 60*60
+
+
+def bucket_of(record_time):
+    return int(record_time) - int(record_time) % BUCKET
+
+
+class SendLedger(object):
+    """
+    Counts of sent docs per RecordTime bucket. `add` counts in memory,
+    `flush` adds the pending counts to the file.
+    """
+    def __init__(self, filename='ledger.json'):
+        self.filename = filename
+        self.pending = {}
+
+    def add(self, record_times):
+        for record_time in record_times:
+            bucket = bucket_of(record_time)
+            self.pending[bucket] = self.pending.get(bucket, 0) + 1
+
+    def _read(self):
+        try:
+            with open(self.filename, 'r') as lfile:
+                return {int(b): n for b, n in json.load(lfile).iteritems()}
+        except (IOError, ValueError):
+            return {}
+
+    def _update(self, update):
+        """Apply update to the counts in the file, holding a lock"""
+        with open(self.filename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            counts = self._read()
+            update(counts)
+            tmpfile = '%s.%d.tmp' % (self.filename, os.getpid())
+            with open(tmpfile, 'w') as lfile:
+                json.dump({str(b): n for b, n in counts.iteritems()}, lfile,
+                          indent=0, sort_keys=True)
+            os.rename(tmpfile, self.filename)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        def add_pending(counts):
+            for bucket, n_docs in self.pending.iteritems():
+                counts[bucket] = counts.get(bucket, 0) + n_docs
+        self._update(add_pending)
+        self.pending = {}
+
+    def reset(self, buckets):
+        """Forget the sent docs of buckets, before sending them again"""
+        def remove(counts):
+            for bucket in buckets:
+                counts.pop(bucket, None)
+        self._update(remove)
+
+    def counts(self, ts_from=None, ts_to=None):
+        """Return {bucket: n_docs} of the buckets in [ts_from, ts_to)"""
+        return {b: n for b, n in self._read().iteritems()
+                if (ts_from is None or b >= ts_from) and (ts_to is None or b < ts_to)}
@@ -0,0 +1,202 @@
+"""
+Memory accounting for the transfer pipelines.
+
+Queues between processes are limited in bytes rather than in documents,
+using the size of the raw json line of each document as estimate. An
+optional ceiling on the resident memory of the whole process tree makes
+readers wait until the uploader has drained what is in flight.
+"""
+import os
+import time
+import errno
+import resource
+import multiprocessing
+
+import codec
+
+
+_PAGESIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss_bytes(pid):
+    """Resident memory of a process (0 if it is gone)"""
+    try:
+        with open('/proc/%d/statm' % pid, 'r') as statm:
+            return int(statm.read().split()[1]) * _PAGESIZE
+    except (IOError, IndexError, ValueError):
+        return 0
+
+
+def child_pids(pid):
+    children = []
+    try:
+        for tid in os.listdir('/proc/%d/task' % pid):
+            with open('/proc/%d/task/%s/children' % (pid, tid), 'r') as cfile:
+                children.extend(int(c) for c in cfile.read().split())
+    except (IOError, OSError):
+        pass
+    return children
+
+
+def is_alive(pid):
+    """Whether a process exists and is not a zombie"""
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        if e.errno == errno.ESRCH:
+            return False
+    # A killed child that was not waited for yet still exists
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as stat:
+            return stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (IOError, IndexError):
+        return True
+
+
+def tree_rss(pid):
+    """Resident memory of a process and all its descendants"""
+    total = 0
+    todo = [pid]
+    while todo:
+        pid = todo.pop()
+        total += rss_bytes(pid)
+        todo.extend(child_pids(pid))
+    return total
+
+
+def peak_rss():
+    """
+    Largest peak resident memory of this process or of any single
+    waited-for child (not of several processes together)
+    """
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+_peak_tree_rss = 0
+def sample_tree_rss():
+    """Measure the process tree of this process, for peak_tree_rss"""
+    global _peak_tree_rss
+    _peak_tree_rss = max(_peak_tree_rss, tree_rss(os.getpid()))
+
+
+def peak_tree_rss():
+    """Largest resident memory of the whole process tree seen by sample_tree_rss"""
+    sample_tree_rss()
+    return _peak_tree_rss
+
+
+class SizeEstimator(object):
+    """
+    Estimate the json size of documents without serializing
+    all of them: every n-th document is measured.
+    """
+    def __init__(self, every=100):
+        self.every = every
+        self.count = 0
+        self.average = None
+
+    def __call__(self, doc):
+        if self.count % self.every == 0:
+            size = len(codec.dumps(doc))
+            n_measured = self.count // self.every
+            if self.average is None:
+                self.average = size
+            else:
+                self.average += (size - self.average) / float(n_measured + 1)
+        self.count += 1
+        return int(self.average)
+
+
+class ByteBudget(object):
+    """
+    Number of bytes in flight between processes, shared across a fork.
+
+    Producers `acquire` the size of each document before putting it into
+    a queue and block while the budget is exhausted, consumers `release`
+    it after taking it out. A single document larger than the budget is
+    always let through, so nothing can get stuck.
+
+    Waiting producers don't use a condition, which a process killed while
+    waiting on it (e.g. by the supervisor) leaves unusable for the others.
+    Instead they check again whenever a consumer signals a release on a
+    semaphore, or after poll_interval. The lock is only held to update
+    the count. Its holder is recorded, and a waiter that did not get it
+    within lock_timeout takes it over if the holder is dead, or was not
+    recorded for two such timeouts (one waiter at a time).
+
+    :param max_bytes: Maximum number of bytes in flight
+    :param max_rss: Optional ceiling on the resident memory of the
+        process tree started from root_pid
+    :param root_pid: Top process of the tree (default: the creating process)
+    """
+    def __init__(self, max_bytes, max_rss=None, root_pid=None, check_every=1000,
+                 poll_interval=0.1, lock_timeout=10.):
+        self.max_bytes = max_bytes
+        self.max_rss = max_rss
+        self.root_pid = root_pid or os.getpid()
+        self.check_every = check_every
+        self.poll_interval = poll_interval
+        self.lock_timeout = lock_timeout
+        self._used = multiprocessing.Value('l', 0, lock=False)
+        self._lock = multiprocessing.Lock()
+        self._holder = multiprocessing.Value('l', 0, lock=False)
+        self._takeover = multiprocessing.Lock()
+        self._released = multiprocessing.BoundedSemaphore(1)
+        self._n_acquired = 0
+
+    def _acquire_lock(self):
+        n_unknown = 0
+        while not self._lock.acquire(True, self.lock_timeout):
+            # Nothing holds the lock for that long but a killed process
+            with self._takeover:
+                holder = self._holder.value
+                # One killed right after taking it is not recorded
+                n_unknown = 0 if holder else n_unknown + 1
+                if (holder and not is_alive(holder)) or n_unknown > 1:
+                    # Still acquired: this process holds it from now on
+                    self._holder.value = os.getpid()
+                    return
+        self._holder.value = os.getpid()
+
+    def _release_lock(self):
+        self._holder.value = 0
+        self._lock.release()
+
+    def _update(self, nbytes, limit=None):
+        """Add nbytes to the count, unless that goes over limit"""
+        self._acquire_lock()
+        try:
+            used = self._used.value
+            if limit is not None and used > 0 and used + nbytes > limit:
+                return False
+            self._used.value = used + nbytes
+            return True
+        finally:
+            self._release_lock()
+
+    def acquire(self, nbytes):
+        while not self._update(nbytes, self.max_bytes):
+            self._released.acquire(True, self.poll_interval)
+
+        self._n_acquired += 1
+        if self.max_rss and self._n_acquired % self.check_every == 0:
+            self.wait_for_memory()
+
+    def release(self, nbytes):
+        self._update(-nbytes)
+        try:
+            self._released.release()
+        except ValueError: # a release is signalled already
+            pass
+
+    def in_flight(self):
+        return self._used.value
+
+    def wait_for_memory(self):
+        """
+        Wait while the process tree is above the RSS ceiling, as long as
+        there is something in flight that can still be drained.
+        """
+        while self.in_flight() > 0 and tree_rss(self.root_pid) > self.max_rss:
+            time.sleep(0.2)
@@ -0,0 +1,142 @@
+"""
+Per-process profiling of the pipeline workers.
+
+Worker targets are wrapped with `profile_target`, which writes one stats file per
+process, named by the role of the worker, into a common directory.
+`print_summary` merges them into one hot-function table at the end of a run.
+
+Two modes are available:
+  'cprofile'  deterministic profiling with cProfile (<role>-<pid>.prof)
+  'sample'    statistical sampling of the stack on SIGPROF, cheap enough
+              to leave on in production runs (<role>-<pid>.samples)
+"""
+import os
+import sys
+import json
+import glob
+import pstats
+import signal
+import cProfile
+from collections import defaultdict
+
+
+def _frame_key(frame):
+    code = frame.f_code
+    return '%s:%d(%s)' % (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class StackSampler(object):
+    """
+    Sample the Python stack every `interval` seconds of CPU time,
+    counting each function once per sample it is on the stack
+    (inclusive) and when it is the innermost frame (self).
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.n_samples = 0
+        self.inclusive = defaultdict(int)
+        self.self_ = defaultdict(int)
+
+    def _sample(self, signum, frame):
+        self.n_samples += 1
+        if frame is None:
+            return
+        self.self_[_frame_key(frame)] += 1
+        seen = set()
+        while frame is not None:
+            key = _frame_key(frame)
+            if key not in seen:
+                seen.add(key)
+                self.inclusive[key] += 1
+            frame = frame.f_back
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        # Restart interrupted system calls instead of failing with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def dump(self, filename):
+        with open(filename, 'w') as sfile:
+            json.dump({'interval': self.interval,
+                       'n_samples': self.n_samples,
+                       'inclusive': self.inclusive,
+                       'self': self.self_}, sfile)
+
+
+class ProfiledTarget(object):
+    """
+    Wrap a process target such that it runs under the profiler and
+    writes its stats to <outdir>/<role>-<pid>.<prof|samples>.
+    """
+    def __init__(self, target, role, mode='cprofile', outdir='profile'):
+        self.target = target
+        self.role = role
+        self.mode = mode
+        self.outdir = outdir
+
+    def __call__(self, *args, **kwargs):
+        basename = os.path.join(self.outdir, '%s-%d' % (self.role, os.getpid()))
+        if self.mode == 'sample':
+            sampler = StackSampler()
+            sampler.start()
+            try:
+                return self.target(*args, **kwargs)
+            finally:
+                sampler.stop()
+                sampler.dump(basename + '.samples')
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self.target, *args, **kwargs)
+        finally:
+            profiler.dump_stats(basename + '.prof')
+
+
+def profile_target(target, role, mode=None, outdir='profile'):
+    """Return target wrapped for profiling, or unchanged if mode is None"""
+    if not mode:
+        return target
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    return ProfiledTarget(target, role, mode=mode, outdir=outdir)
+
+
+def _recent(pattern, since):
+    return sorted(f for f in glob.glob(pattern) if os.path.getmtime(f) >= since)
+
+
+def print_summary(outdir='profile', since=0, n_functions=25, stream=sys.stdout):
+    """Merge all stats files in outdir written after `since` and print the hottest functions"""
+    prof_files = _recent(os.path.join(outdir, '*.prof'), since)
+    if prof_files:
+        stream.write('>>> Merged profile of %d processes:\n' % len(prof_files))
+        for prof_file in prof_files:
+            stream.write('      %s\n' % os.path.basename(prof_file))
+        stats = pstats.Stats(*prof_files, stream=stream)
+        stats.sort_stats('tottime').print_stats(n_functions)
+
+    sample_files = _recent(os.path.join(outdir, '*.samples'), since)
+    if sample_files:
+        n_samples = 0
+        inclusive = defaultdict(int)
+        self_ = defaultdict(int)
+        for sample_file in sample_files:
+            with open(sample_file, 'r') as sfile:
+                samples = json.load(sfile)
+            n_samples += samples['n_samples']
+            for key, count in samples['inclusive'].iteritems():
+                inclusive[key] += count
+            for key, count in samples['self'].iteritems():
+                self_[key] += count
+
+        stream.write('>>> Merged samples of %d processes (%d samples):\n' % (
+            len(sample_files), n_samples))
+        stream.write('%8s %8s  %s\n' % ('self %', 'incl %', 'function'))
+        for key, count in sorted(self_.iteritems(), key=lambda kv: -kv[1])[:n_functions]:
+            stream.write('%8.1f %8.1f  %s\n' % (100.*count/n_samples,
+                                                100.*inclusive[key]/n_samples, key))
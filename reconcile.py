@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Compare the docs sent to AMQ with ES and fill the gaps.
+
+For every hour of RecordTime of the given days, the number of docs in the
+send ledger (see ledger.py) is compared with the number of docs in ES.
+Hours with fewer docs sent than in ES are transferred again from ES, and
+their ledger counts replaced by what was sent now. The ledger only has
+counts, not _ids, so such an hour is resent completely: the docs of it
+that did arrive before are sent a second time, and consumers have to
+drop duplicates by their _id (GlobalJobId). Hours with more docs sent
+than in ES (duplicates from retries, or docs deleted since) are only
+reported. Docs that are still waiting in a spool file count as not sent;
+replay the spool files with replay_spool.py and the same --ledger_file
+first, so that they are not resent as well.
+"""
+import time
+
+from argparse import ArgumentParser
+
+from amq import configure as configure_amq
+from sinks import make_sink
+from ledger import BUCKET
+from ledger import SendLedger
+from verify_dump import get_es_window_counts
+from dump_es_bytimestamp import make_query
+from dump_es_bytimestamp import get_es_scan
+from dump_es_bytimestamp import date_string_to_timestamp
+from transfer_by_timestamp import upload_batch
+from transfer_helpers import set_up_logging
+
+
+def find_gaps(ledger, ts_from, ts_to, index='cms-20*'):
+    """
+    Return a sorted list of (bucket, n_sent, n_es) for all
+    buckets in [ts_from, ts_to) where the counts differ
+    """
+    es_counts = get_es_window_counts(make_query(ts_from, ts_to), index=index)
+    sent_counts = ledger.counts(ts_from, ts_to)
+    gaps = []
+    for bucket in sorted(set(es_counts.keys()) | set(sent_counts.keys())):
+        n_sent = sent_counts.get(bucket, 0)
+        n_es = es_counts.get(bucket, 0)
+        if n_sent != n_es:
+            gaps.append((bucket, n_sent, n_es))
+    return gaps
+
+
+def resend_bucket(bucket, sink, ledger, index='cms-20*', buffer_size=5000, batch_size=5000):
+    """
+    Transfer all docs of a bucket again, including those sent before,
+    and return their number
+    """
+    ledger.reset([bucket])
+    count = 0
+    batch = []
+    for hit in get_es_scan(make_query(bucket, bucket + BUCKET), index=index,
+                           buffer_size=buffer_size):
+        batch.append(hit['_source'])
+        if len(batch) == batch_size:
+            count += upload_batch(batch, sink)
+            batch = []
+
+    if batch:
+        count += upload_batch(batch, sink)
+    return count
+
+
+def reconcile(date_string, ledger, sink, args):
+    timestamp = date_string_to_timestamp(date_string)
+    if not timestamp:
+        print 'Invalid date "%s", skipping' % date_string
+        return
+
+    gaps = find_gaps(ledger, timestamp, timestamp + 24*60*60, index=args.index)
+    print ">>> %s: %d hours inconsistent with ES" % (date_string, len(gaps))
+    for bucket, n_sent, n_es in gaps:
+        hour = time.strftime('%Y-%m-%d %H:%M', time.gmtime(bucket))
+        if n_sent > n_es:
+            print "    %s: %d docs sent, only %d in ES" % (hour, n_sent, n_es)
+            continue
+
+        print "    %s: %d docs sent, %d in ES" % (hour, n_sent, n_es)
+        if args.report_only:
+            continue
+
+        starttime = time.time()
+        n_resent = resend_bucket(bucket, sink, ledger, index=args.index,
+                                 buffer_size=args.es_buffer_size,
+                                 batch_size=args.amq_buffer_size)
+        print "    %s: resent %d docs in %.1f s" % (hour, n_resent, time.time()-starttime)
+
+
+def main(args):
+    configure_amq(spool_file=args.spool_file or None,
+                  batch_size=args.amq_batch_docs,
+                  batch_bytes=args.amq_batch_bytes,
+                  compression=args.amq_compression,
+                  fan_out=args.amq_fan_out)
+    ledger = SendLedger(args.ledger_file)
+    sink = make_sink('amq', ledger=ledger)
+    for date_string in args.date_strings:
+        reconcile(date_string, ledger, sink, args)
+
+    sink.close()
+    print ">>> %s" % sink.summary()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('date_strings', metavar='date_strings', type=str, nargs='+',
+                        help='Reconcile these days')
+    parser.add_argument("--ledger_file", default='ledger.json',
+                        type=str, dest="ledger_file",
+                        help="Ledger of the docs sent to AMQ [default: %(default)s]")
+    parser.add_argument("--index", default='cms-20*',
+                        type=str, dest="index",
+                        help="Compare with and resend from these indices [default: %(default)s]")
+    parser.add_argument("--report_only", action='store_true',
+                        dest="report_only",
+                        help="Only list the inconsistent hours, don't resend them")
+    parser.add_argument("--es_buffer_size", default=5000,
+                        type=int, dest="es_buffer_size",
+                        help="Buffer size for elasticsearch scan [default: %(default)s]")
+    parser.add_argument("--amq_buffer_size", default=5000,
+                        type=int, dest="amq_buffer_size",
+                        help="Buffer size for AMQ upload [default: %(default)s]")
+    parser.add_argument("--spool_file", default='amq_spool.json',
+                        type=str, dest="spool_file",
+                        help="Keep notifications that failed to send here for replay_spool.py [default: %(default)s]")
+    parser.add_argument("--amq_batch_docs", default=1,
+                        type=int, dest="amq_batch_docs",
+                        help="Pack up to this many docs into a single AMQ message [default: %(default)s]")
+    parser.add_argument("--amq_batch_bytes", default=512*1024,
+                        type=int, dest="amq_batch_bytes",
+                        help="Maximum size in bytes of a packed AMQ message [default: %(default)s]")
+    parser.add_argument("--amq_compression", default=None,
+                        choices=['gzip', 'zlib'], dest="amq_compression",
+                        help="Compress AMQ message bodies [default: %(default)s]")
+    parser.add_argument("--amq_fan_out", default=None,
+                        choices=['round_robin', 'least_loaded'], dest="amq_fan_out",
+                        help="Spread AMQ messages over all broker nodes [default: %(default)s]")
+    args = parser.parse_args()
+
+    set_up_logging()
+    main(args)
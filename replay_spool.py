@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+import functools
+
+from argparse import ArgumentParser
+
+from amq import count_sent
+from amq import get_amq_interface
+from ledger import SendLedger
+from transfer_helpers import set_up_logging
+
+
+def main(args):
+    interface = get_amq_interface()
+    ledger = SendLedger(args.ledger_file) if args.ledger_file else None
+    for spool_file in args.spool_files:
+        on_sent = functools.partial(count_sent, ledger) if ledger else None
+        n_sent, n_failed = interface.replay(spool_file, on_sent=on_sent)
+        if ledger:
+            ledger.flush()
+        print ">>> %s: %d notifications sent, %d failed again" % (spool_file, n_sent, n_failed)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('spool_files', metavar='spool_files', type=str, nargs='+',
+                        help='Send the notifications in these spool files')
+    parser.add_argument("--ledger_file", default='ledger.json',
+                        type=str, dest="ledger_file",
+                        help="Count the docs sent to AMQ per hour of RecordTime here, for reconcile.py "
+                             "(empty to disable) [default: %(default)s]")
+    args = parser.parse_args()
+
+    set_up_logging()
+    main(args)
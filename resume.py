@@ -0,0 +1,146 @@
+"""
+Resumable positions for streaming transfers.
+
+A day is split into RecordTime windows, each read in (RecordTime, _id)
+order with search_after. After every successful upload batch the last
+acknowledged position of each window is saved, so that a restart
+continues each window from there instead of from the start of the day.
+"""
+import os
+import json
+import fcntl
+
+from dump_es_bytimestamp import make_query
+from dump_es_bytimestamp import get_total_hits
+from dump_es_bytimestamp import search_after_hits
+
+
+SORT = [{"RecordTime": "asc"}, {"_id": "asc"}]
+
+
+def make_windows(ts_from, ts_to, n_windows):
+    """Split [ts_from, ts_to) into n_windows (window_id, from, to) ranges"""
+    step = (ts_to - ts_from) // n_windows
+    bounds = [ts_from + n*step for n in range(n_windows)] + [ts_to]
+    return [(str(n), bounds[n], bounds[n+1]) for n in range(n_windows)]
+
+
+def window_query(ts_from, ts_to, position=None):
+    """Query for the docs of a window that come after position"""
+    if position:
+        ts_from = max(ts_from, position['record_time'])
+    return make_query(ts_from, ts_to)
+
+
+def count_remaining(ts_from, ts_to, position=None):
+    """Number of docs in a window that come after position"""
+    n_docs = get_total_hits(window_query(ts_from, ts_to, position))
+    if not position:
+        return n_docs
+
+    # Docs at the RecordTime of the position up to its _id are done
+    query = {"query": {"term": {"RecordTime": position['record_time']}},
+             "_source": False}
+    for hit in search_after_hits(query, sort=[{"_id": "asc"}]):
+        if hit['_id'] > position['id']:
+            break
+        n_docs -= 1
+    return n_docs
+
+
+def make_position(hit, doc):
+    """Position of a doc, to be passed to StreamPositions.ack"""
+    return {'sort': hit['sort'], 'record_time': doc['RecordTime'], 'id': hit['_id']}
+
+
+class StreamPositions(object):
+    """
+    Acknowledged positions per window of a day, persisted in a json file
+    as {date_string: {window_id: {'from': ts, 'to': ts,
+                                  'position': ..., 'done': bool}}}
+    Several processes can save the windows they changed at the same time.
+    With dry_run, the file is read but never written.
+    """
+    def __init__(self, filename, date_string, dry_run=False):
+        self.filename = filename
+        self.date_string = date_string
+        self.dry_run = dry_run
+        self.windows = {}
+        self._changed = set()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as pfile:
+                self.windows = json.load(pfile).get(self.date_string, {})
+        except (IOError, ValueError):
+            self.windows = {}
+
+    def _update(self, update):
+        """Apply update to the windows of the day in the file, holding a lock"""
+        with open(self.filename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.filename, 'r') as pfile:
+                    all_positions = json.load(pfile)
+            except (IOError, ValueError):
+                all_positions = {}
+
+            windows = all_positions.get(self.date_string, {})
+            update(windows)
+            if windows:
+                all_positions[self.date_string] = windows
+            else:
+                all_positions.pop(self.date_string, None)
+
+            tmpfile = '%s.%d.tmp' % (self.filename, os.getpid())
+            with open(tmpfile, 'w') as pfile:
+                json.dump(all_positions, pfile, indent=2, sort_keys=True)
+            os.rename(tmpfile, self.filename)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return windows
+
+    def save(self):
+        """Save the windows changed by this process"""
+        if self.dry_run:
+            return
+
+        def merge(windows):
+            for window_id in self._changed:
+                windows[window_id] = self.windows[window_id]
+        self.windows = self._update(merge)
+        self._changed = set()
+
+    def get_windows(self, ts_from, ts_to, n_windows):
+        """
+        Return the (window_id, from, to) of the day, as they were
+        defined by an earlier run, or else split into n_windows
+        """
+        if not self.windows:
+            for window_id, w_from, w_to in make_windows(ts_from, ts_to, n_windows):
+                self.windows[window_id] = {'from': w_from, 'to': w_to}
+                self._changed.add(window_id)
+            self.save()
+
+        return sorted((wid, w['from'], w['to']) for wid, w in self.windows.items())
+
+    def position(self, window_id):
+        return self.windows.get(window_id, {}).get('position')
+
+    def is_done(self, window_id):
+        return self.windows.get(window_id, {}).get('done', False)
+
+    def ack(self, window_id, position):
+        self.windows.setdefault(window_id, {})['position'] = position
+        self._changed.add(window_id)
+
+    def mark_done(self, window_id):
+        self.windows.setdefault(window_id, {})['done'] = True
+        self._changed.add(window_id)
+
+    def clear(self):
+        """Forget the day, once it is completely transferred"""
+        if self.dry_run:
+            return
+        self.windows = self._update(lambda windows: windows.clear())
+        self._changed = set()
@@ -0,0 +1,106 @@
+"""
+Output sinks for transformed job ads.
+
+Every sink takes (id, ad) pairs through `post` and returns the number of
+ads it handled, so the readers and transforms can be run and measured
+independently of the broker:
+
+  amq     send the ads to CERN AMQ (see amq.post_ads), counting the sent
+          ads in an optional ledger.SendLedger
+  frames  write ready-to-send frames to disk, in the spool format, to be
+          sent later in bulk with replay_spool.py
+  null    build and encode the frames like the AMQ sink, but only count
+          the documents and bytes
+"""
+import os
+
+import amq
+
+
+class AMQSink(object):
+    """Send ads to CERN AMQ"""
+    def __init__(self, ledger=None):
+        self.ledger = ledger
+        self.n_docs = 0
+
+    def post(self, ads):
+        n_sent = amq.post_ads(ads, ledger=self.ledger)
+        self.n_docs += n_sent
+        return n_sent
+
+    def close(self):
+        amq.close_amq_interface()
+
+    def summary(self):
+        return "%d docs sent to AMQ" % self.n_docs
+
+
+class FrameFileSink(object):
+    """
+    Write frames to <directory>/frames-<pid>.json, one file per process,
+    in the format of the AMQ spool. Nothing is sent, so the brokers of a
+    configured fan_out are not resolved.
+    """
+    def __init__(self, directory='frames/'):
+        self.directory = directory
+        self.n_docs = 0
+        self._interface = None
+
+    @property
+    def filename(self):
+        return os.path.join(self.directory, 'frames-%d.json' % os.getpid())
+
+    def post(self, ads):
+        if self._interface is None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self._interface = amq.make_amq_interface('', '', spool_file=self.filename,
+                                                     fan_out=None)
+
+        n_docs = self._interface.spool(amq.make_notifications(self._interface, ads))
+        self.n_docs += n_docs
+        return n_docs
+
+    def close(self):
+        pass
+
+    def summary(self):
+        return "%d docs written to %s" % (self.n_docs, self.directory)
+
+
+class NullSink(object):
+    """Encode frames and count them without sending"""
+    def __init__(self):
+        self.n_docs = 0
+        self.n_frames = 0
+        self.n_bytes = 0
+        self._interface = None
+
+    def post(self, ads):
+        if self._interface is None:
+            self._interface = amq.make_amq_interface('', '', fan_out=None)
+
+        n_docs = 0
+        data = amq.make_notifications(self._interface, ads)
+        for _, headers, body, payload in self._interface.frames(data):
+            n_docs += len(self._interface.documents(headers, body))
+            self.n_frames += 1
+            self.n_bytes += len(payload)
+
+        self.n_docs += n_docs
+        return n_docs
+
+    def close(self):
+        pass
+
+    def summary(self):
+        return "%d docs in %d frames, %.1f MB encoded (null sink)" % (
+            self.n_docs, self.n_frames, self.n_bytes/1e6)
+
+
+def make_sink(name, frames_dir='frames/', ledger=None):
+    if name == 'frames':
+        return FrameFileSink(frames_dir)
+    if name == 'null':
+        return NullSink()
+    return AMQSink(ledger=ledger)
@@ -0,0 +1,159 @@
+"""
+Supervision of the worker processes of a transfer.
+
+Every worker gets a heartbeat in shared memory, which it updates with
+`beat()` for every doc it handles (and while it waits for input). The
+supervisor polls the workers: a worker that exited with an error, or
+whose heartbeat is older than the stall timeout, is stopped together
+with its children. Restartable workers are then started again with
+fresh arguments (e.g. from their last saved position), up to a number
+of restarts. Any other failure stops all workers of the stage, so that
+nothing waits forever for a poison pill that never comes.
+"""
+import os
+import time
+import signal
+import multiprocessing
+
+from memory_budget import child_pids
+
+
+_heartbeat = None
+def beat():
+    """Tell the supervisor (if any) that this worker makes progress"""
+    if _heartbeat is not None:
+        _heartbeat.value = time.time()
+
+
+def _supervised(heartbeat, target, *args):
+    global _heartbeat
+    _heartbeat = heartbeat
+    beat()
+    target(*args)
+
+
+def terminate_tree(process):
+    """Stop a process and all of its descendants"""
+    pids = []
+    todo = [process.pid]
+    while todo:
+        pid = todo.pop()
+        pids.append(pid)
+        todo.extend(child_pids(pid))
+    for pid in reversed(pids):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    process.join(5)
+
+
+class Worker(object):
+    def __init__(self, name, target, args, restartable, restart_args):
+        self.name = name
+        self.target = target
+        self.args = tuple(args)
+        self.restartable = restartable
+        self.restart_args = restart_args
+        self.n_restarts = 0
+        self.process = None
+        self.heartbeat = multiprocessing.Value('d', 0., lock=False)
+
+    def start(self):
+        self.heartbeat.value = time.time()
+        self.process = multiprocessing.Process(target=_supervised,
+                                               args=(self.heartbeat, self.target) + self.args,
+                                               name=self.name)
+        self.process.start()
+
+    def restart(self):
+        self.n_restarts += 1
+        if self.restart_args is not None:
+            self.args = tuple(self.restart_args())
+        self.start()
+
+    def idle_seconds(self):
+        return time.time() - self.heartbeat.value
+
+
+class Supervisor(object):
+    """
+    Start workers and watch them until all of them are done.
+
+    :param stall_timeout: Stop a worker without a heartbeat for this many
+        seconds (0: never)
+    :param max_restarts: Restart a restartable worker at most this often
+    :param interval: Seconds between checks
+    """
+    def __init__(self, stall_timeout=600., max_restarts=3, interval=1.):
+        self.stall_timeout = stall_timeout
+        self.max_restarts = max_restarts
+        self.interval = interval
+        self.workers = []
+
+    def start(self, name, target, args, restartable=False, restart_args=None):
+        """
+        Start target(*args) in a new process. A restartable worker is
+        started again with the same args, or those returned by
+        restart_args().
+        """
+        worker = Worker(name, target, args, restartable, restart_args)
+        worker.start()
+        self.workers.append(worker)
+        return worker
+
+    def check(self, worker):
+        """Return why a worker failed, or None if it is fine"""
+        exitcode = worker.process.exitcode
+        if exitcode is None:
+            if self.stall_timeout and worker.idle_seconds() > self.stall_timeout:
+                terminate_tree(worker.process)
+                return "no progress for %.0f s" % self.stall_timeout
+            return None
+        if exitcode != 0:
+            return "exit code %d" % exitcode
+        return None
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.process.is_alive():
+                terminate_tree(worker.process)
+
+    def run(self, progress=None):
+        """
+        Watch the workers until they are all done, and return the names
+        of the ones that failed for good (then all others are stopped).
+        progress is called after every check.
+        """
+        while True:
+            # Only done after a pass that checked all workers once they
+            # had all exited, so that none can fail unnoticed in between
+            all_exited = all(w.process.exitcode is not None for w in self.workers)
+
+            # Check the least recently active workers first: when an
+            # uploader is stuck, the readers waiting for it stop later
+            for worker in sorted(self.workers, key=lambda w: w.heartbeat.value):
+                reason = self.check(worker)
+                if reason is None:
+                    continue
+
+                if worker.restartable and worker.n_restarts < self.max_restarts:
+                    print ">>> %s failed (%s), restarting (%d of %d)" % (
+                        worker.name, reason, worker.n_restarts+1, self.max_restarts)
+                    worker.restart()
+                    all_exited = False
+                    continue
+
+                print ">>> %s failed (%s), stopping all workers" % (worker.name, reason)
+                self.stop()
+                return [worker.name]
+
+            if progress is not None:
+                progress()
+            if all_exited:
+                break
+            time.sleep(self.interval)
+
+        for worker in self.workers:
+            worker.process.join()
+        return []
@@ -0,0 +1,47 @@
+"""Shared setup of the tests that run whole transfers against FakeES"""
+import os
+import glob
+import json
+
+from StompAMQ import StompAMQ
+
+
+class Args(object):
+    """Stands in for the parsed command line of transfer_by_timestamp.py"""
+    def __init__(self, **options):
+        self.streaming = True
+        self.resumable = False
+        self.auto_slices = False
+        self.scan_mode = 'sliced'
+        self.es_slices = 1
+        self.es_buffer_size = 500
+        self.max_slices = 4
+        self.slice_unit = 15*60
+        self.slice_interval = 10.
+        self.fused = False
+        self.positions_file = 'positions.json'
+        self.stall_timeout = 600.
+        self.max_restarts = 3
+        self.fields = ''
+        self.queue_bytes = 200e6
+        self.max_rss = 0
+        self.amq_buffer_size = 500
+        self.amq_buffer_bytes = 50e6
+        self.sink = 'null'
+        self.frames_dir = 'frames/'
+        self.ledger_file = ''
+        self.dry_run = False
+        self.profile = None
+        self.profile_dir = 'profile/'
+        self.__dict__.update(options)
+
+
+def read_frames(directory):
+    """All docs written by the frame file sinks of all processes"""
+    docs = []
+    for filename in glob.glob(os.path.join(directory, 'frames-*.json')):
+        with open(filename, 'r') as frames:
+            for line in frames:
+                frame = json.loads(line)
+                docs.extend(StompAMQ.documents(frame['headers'], frame['body']))
+    return docs
@@ -0,0 +1,105 @@
+"""Tests of the tuning of the number of ES readers (autoslice.py)"""
+import unittest
+import multiprocessing
+
+import transfer_by_timestamp
+from autoslice import SliceStats
+from autoslice import SliceTuner
+from autoslice import initial_slices
+from fake_es import FakeES
+from dump_es_bytimestamp import configure_es
+
+from tests.helpers import Args
+
+
+class TestInitialSlices(unittest.TestCase):
+    def test_initial_slices(self):
+        shards = [('cms-2017-07-14', n, 1000000) for n in range(5)]
+        self.assertEqual(initial_slices(shards, 16), 5)
+        self.assertEqual(initial_slices(shards, 3), 3)
+        # Small days get fewer slices than shards, but at least one
+        self.assertEqual(initial_slices(shards, 16, docs_per_slice=2000000), 2)
+        self.assertEqual(initial_slices([('i', 0, 10)], 16), 1)
+        self.assertEqual(initial_slices([], 16), 1)
+
+
+class TestSliceTuner(unittest.TestCase):
+    def test_adds_while_it_pays_off(self):
+        tuner = SliceTuner(2, 8)
+        self.assertEqual(tuner.update(1000, 1.0, 0.), 3)
+        self.assertEqual(tuner.update(1500, 1.0, 0.), 4)
+        self.assertEqual(tuner.update(2000, 1.1, 0.), 5)
+        # Less than min_gain more throughput: back, and not that high again
+        self.assertEqual(tuner.update(2050, 1.1, 0.), 4)
+        self.assertEqual(tuner.ceiling, 4)
+        self.assertEqual(tuner.update(2050, 1.1, 0.), 4)
+        self.assertEqual(tuner.update(2050, 1.1, 0.), 4)
+
+    def test_stops_at_max_slices(self):
+        tuner = SliceTuner(1, 3)
+        rate = 100.
+        for _ in range(10):
+            rate *= 2
+            tuner.update(rate, 1.0, 0.)
+        self.assertEqual(tuner.n_slices, 3)
+
+    def test_retires_when_es_slows_down(self):
+        tuner = SliceTuner(4, 8)
+        tuner.update(1000, 1.0, 0.)
+        self.assertEqual(tuner.update(2000, 2.5, 0.), 4)
+        self.assertEqual(tuner.ceiling, 4)
+        self.assertEqual(tuner.update(2000, 2.5, 0.), 3)
+
+    def test_waits_for_the_uploader(self):
+        tuner = SliceTuner(2, 8)
+        self.assertEqual(tuner.update(1000, 1.0, 0.8), 2)
+        self.assertEqual(tuner.update(1000, 1.0, 0.8), 2)
+        self.assertEqual(tuner.update(1000, 1.0, 0.1), 3)
+
+    def test_never_below_one(self):
+        tuner = SliceTuner(1, 8)
+        tuner.update(1000, 1.0, 0.)
+        for _ in range(3):
+            tuner.update(1000, 10.0, 0.)
+        self.assertEqual(tuner.n_slices, 1)
+
+
+def _add_stats(stats, slot):
+    stats.add(slot, 10, 1.5, 0.5)
+    stats.retire(slot)
+
+
+class TestSliceStats(unittest.TestCase):
+    def test_shared_with_readers(self):
+        stats = SliceStats(3)
+        readers = [multiprocessing.Process(target=_add_stats, args=(stats, slot))
+                   for slot in (0, 2)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(stats.totals(), (20, 3.0, 1.0))
+        self.assertTrue(stats.is_retired(2))
+        self.assertFalse(stats.is_retired(1))
+        stats.reuse(2)
+        self.assertFalse(stats.is_retired(2))
+
+
+class TestAutoSlices(unittest.TestCase):
+    def test_transfer(self):
+        # Slow enough for ES to be the bottleneck, so slices get added
+        es = FakeES(n_docs=4000, n_attributes=10, latency=0.02).start()
+        try:
+            # Uncompressed, see fake_es
+            configure_es(hosts=es.hosts(), http_compress=False)
+            args = Args(auto_slices=True, max_slices=4, slice_unit=1800, slice_interval=0.2,
+                        es_buffer_size=100)
+            self.assertTrue(transfer_by_timestamp.process_date_string('2017-07-14', args))
+            # Every reader process has its own connection
+            self.assertTrue(len(es.connections) > 3)
+        finally:
+            es.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+"""Tests of the json backend selection and fallback of codec"""
+import json
+import math
+import unittest
+
+import codec
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        self.assertEqual(codec.loads(codec.dumps(codec._SAMPLE)), codec._SAMPLE)
+        self.assertEqual(codec.dumps_compatible(codec._SAMPLE), json.dumps(codec._SAMPLE))
+
+    def test_selected_backend_works(self):
+        self.assertIn(codec.backend, [b[0] for b in codec.available_backends()])
+        self.assertEqual(codec.select_backend('json')[0], 'json')
+
+    def test_fallback(self):
+        self.assertEqual(codec.dumps(float('nan')), 'NaN')
+        self.assertEqual(codec.dumps({'a': float('inf')}).replace(' ', ''), '{"a":Infinity}')
+        self.assertTrue(math.isnan(codec.loads('[NaN]')[0]))
+        self.assertEqual(codec.loads(codec.dumps(2**70)), 2**70)
+        self.assertRaises(ValueError, codec.loads, '{bad')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+"""Tests of the columnar dump format"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import columnar
+from bench_amq import synthetic_ads
+
+
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.json_file = os.path.join(self.tmpdir, 'dump.json')
+        self.col_file = os.path.join(self.tmpdir, 'dump.col')
+        self.hits = []
+        for n, ad in enumerate(synthetic_ads(250, n_attributes=30)):
+            if n % 7 == 0:
+                del ad['Site'] # sparse column
+            self.hits.append({'_id': str(n), '_index': 'cms-2017-07-14', '_type': 'job',
+                              '_source': ad})
+        with open(self.json_file, 'w') as dumpfile:
+            for hit in self.hits:
+                dumpfile.write(json.dumps(hit) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        self.assertEqual(columnar.convert(self.json_file, self.col_file, batch_size=100), 250)
+        self.assertTrue(columnar.is_columnar(self.col_file))
+        self.assertFalse(columnar.is_columnar(self.json_file))
+        reader = columnar.ColumnarReader(self.col_file)
+        self.assertEqual(reader.count(), 250)
+        self.assertEqual([b['n_docs'] for b in reader.batches()], [100, 100, 50])
+        self.assertEqual(list(reader.read()), self.hits)
+
+    def test_projection(self):
+        columnar.convert(self.json_file, self.col_file, batch_size=100)
+        reader = columnar.ColumnarReader(self.col_file)
+        hits = list(reader.read(fields=['Site', 'RecordTime'], batches=[1]))
+        self.assertEqual([h['_id'] for h in hits], [h['_id'] for h in self.hits[100:200]])
+        for hit, orig in zip(hits, self.hits[100:200]):
+            source = orig['_source']
+            self.assertEqual(hit['_source'], {k: source[k] for k in ('Site', 'RecordTime')
+                                              if k in source})
+
+    def test_batch_times(self):
+        columnar.convert(self.json_file, self.col_file, batch_size=100)
+        batch = columnar.ColumnarReader(self.col_file).batches()[0]
+        record_times = [h['_source']['RecordTime'] for h in self.hits[:100]]
+        self.assertEqual((batch['min_time'], batch['max_time']),
+                         (min(record_times), max(record_times)))
+
+
+if __name__ == '__main__':
+    unittest.main()
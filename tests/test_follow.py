@@ -0,0 +1,117 @@
+"""
+Tests of the high-water mark and the windows of follow.py, against FakeES
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from follow import HighWaterMark
+from follow import follow_window
+from fake_es import FakeES
+from dump_es_bytimestamp import configure_es
+
+
+class ListSink(object):
+    """Keeps the docs posted, failing the post number fail_at"""
+    def __init__(self, fail_at=None):
+        self.docs = []
+        self.n_posts = 0
+        self.fail_at = fail_at
+
+    def post(self, ads):
+        self.n_posts += 1
+        if self.n_posts == self.fail_at:
+            raise IOError("post %d failed" % self.n_posts)
+        ads = list(ads)
+        self.docs.extend(ads)
+        return len(ads)
+
+
+class TestHighWaterMark(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'follow.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_missing_file(self):
+        state = HighWaterMark(self.filename)
+        self.assertEqual((state.hwm, state.position), (None, None))
+
+    def test_round_trip(self):
+        state = HighWaterMark(self.filename)
+        state.advance(1500000000)
+        state.ack({'sort': [1500000005, 'a'], 'id': 'a', 'record_time': 1500000005})
+        loaded = HighWaterMark(self.filename)
+        self.assertEqual(loaded.hwm, 1500000000)
+        self.assertEqual(loaded.position['sort'], [1500000005, 'a'])
+        self.assertFalse(os.path.exists(self.filename + '.tmp'))
+
+        state.advance(1500000010)
+        loaded.load()
+        self.assertEqual((loaded.hwm, loaded.position), (1500000010, None))
+
+    def test_corrupt_file(self):
+        with open(self.filename, 'w') as sfile:
+            sfile.write('{"hwm": 15000')
+        self.assertRaises(ValueError, HighWaterMark, self.filename)
+
+    def test_missing_hwm(self):
+        with open(self.filename, 'w') as sfile:
+            sfile.write('{"position": null}')
+        self.assertRaises(KeyError, HighWaterMark, self.filename)
+
+
+class TestFollowWindow(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.es = FakeES(n_docs=2000, n_attributes=5, docs_per_second=10).start()
+        configure_es(hosts=cls.es.hosts(), http_compress=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.es.stop()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state = HighWaterMark(os.path.join(self.tmpdir, 'follow.json'))
+        self.state.advance(1500000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def follow(self, sink, ts_to=1500000010):
+        return follow_window(self.state, ts_to, sink, index='cms-*',
+                             buffer_size=25, batch_size=30)
+
+    def test_window(self):
+        sink = ListSink()
+        n_docs, oldest = self.follow(sink)
+        self.assertEqual(n_docs, 100)
+        self.assertEqual(oldest, 1500000000)
+        self.assertEqual(len(set(doc_id for doc_id, _ in sink.docs)), 100)
+        self.assertEqual((self.state.hwm, self.state.position), (1500000010, None))
+
+        # The next window starts at the high-water mark
+        sink = ListSink()
+        self.assertEqual(self.follow(sink, ts_to=1500000015)[0], 50)
+
+    def test_resume_after_failure(self):
+        sink = ListSink(fail_at=3)
+        self.assertRaises(IOError, self.follow, sink)
+        self.assertEqual(len(sink.docs), 60)
+
+        # Continue from what was acknowledged, as follow() does
+        self.state.load()
+        self.assertEqual(self.state.hwm, 1500000000)
+        self.assertTrue(self.state.position)
+        n_docs, _ = self.follow(sink)
+        self.assertEqual(n_docs, 40)
+        self.assertEqual(len(set(doc_id for doc_id, _ in sink.docs)), 100)
+        self.assertEqual(self.state.hwm, 1500000010)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Tests of the uploader that a reader runs in its own process with --fused
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from resume import StreamPositions
+from memory_budget import ByteBudget
+from transfer_by_timestamp import FusedUploader
+
+
+class FileSink(object):
+    """Appends the ids of each post as a json line, so that forked readers can post too"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.closed = False
+
+    def post(self, ads):
+        ids = [doc_id for doc_id, _ in ads]
+        with open(self.filename, 'a') as pfile:
+            pfile.write(json.dumps(ids) + '\n')
+        return len(ids)
+
+    def close(self):
+        self.closed = True
+
+    def posts(self):
+        if not os.path.exists(self.filename):
+            return []
+        with open(self.filename, 'r') as pfile:
+            return [json.loads(line) for line in pfile]
+
+
+def _doc(n):
+    return {'GlobalJobId': 'job%d' % n, 'RecordTime': 1500000000 + n}
+
+
+def _read_and_die(uploader, budget, n_docs):
+    for n in range(1, n_docs + 1):
+        budget.acquire(100)
+        uploader.put((100, _doc(n), ('file_0', {'sort': [n]})))
+    os._exit(1) # killed before the poison pill, without flushing
+
+
+class TestFusedUploader(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sink = FileSink(os.path.join(self.tmpdir, 'posts.json'))
+        self.budget = ByteBudget(1e9)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def put(self, uploader, n, position=None, nbytes=100):
+        self.budget.acquire(nbytes)
+        if position:
+            uploader.put((nbytes, _doc(n), position))
+        else:
+            uploader.put((nbytes, _doc(n)))
+
+    def test_batches(self):
+        uploader = FusedUploader(self.sink, self.budget, batch_size=3)
+        for n in range(7):
+            self.put(uploader, n)
+        self.assertEqual([len(ids) for ids in self.sink.posts()], [3, 3])
+        self.assertEqual(uploader.n_sent.value, 6)
+        self.assertFalse(self.sink.closed)
+
+        uploader.put(None)
+        self.assertEqual([len(ids) for ids in self.sink.posts()], [3, 3, 1])
+        self.assertEqual(uploader.n_sent.value, 7)
+        self.assertEqual(self.budget.in_flight(), 0)
+        self.assertTrue(self.sink.closed)
+
+    def test_batch_bytes(self):
+        uploader = FusedUploader(self.sink, self.budget, batch_size=100, batch_bytes=250)
+        for n in range(4):
+            self.put(uploader, n)
+        self.assertEqual([len(ids) for ids in self.sink.posts()], [3])
+
+    def test_positions(self):
+        filename = os.path.join(self.tmpdir, 'positions.json')
+        positions = StreamPositions(filename, 'day')
+        positions.get_windows(1500000000, 1500000100, 2)
+        uploader = FusedUploader(self.sink, self.budget, batch_size=2, positions=positions)
+        for n in range(3):
+            self.put(uploader, n, ('0', {'sort': [1500000000 + n, 'job%d' % n]}))
+
+        # Saved after the batch that was sent, not the doc still in the next one
+        saved = StreamPositions(filename, 'day')
+        self.assertEqual(saved.position('0'), {'sort': [1500000001, 'job1']})
+        self.assertFalse(saved.is_done('0'))
+
+        uploader.put((None, '0'))
+        saved.load()
+        self.assertTrue(saved.is_done('0'))
+        self.assertFalse(saved.is_done('1'))
+        self.assertEqual(uploader.n_sent.value, 3)
+        self.assertTrue(self.sink.closed)
+
+    def test_replays(self):
+        uploader = FusedUploader(self.sink, self.budget, batch_size=2, replays=True)
+        reader = multiprocessing.Process(target=_read_and_die, args=(uploader, self.budget, 5))
+        reader.start()
+        reader.join()
+        self.assertEqual(uploader.sent_through.value, 4)
+        self.assertEqual(uploader.n_sent.value, 4)
+
+        # The restarted reader starts over, docs 1 to 4 are not sent again
+        for n in range(1, 7):
+            self.put(uploader, n, ('file_0', {'sort': [n]}))
+        uploader.put(None)
+        ids = sum(self.sink.posts(), [])
+        self.assertEqual(sorted(ids), sorted('job%d' % n for n in range(1, 7)))
+        self.assertEqual(uploader.n_sent.value, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+"""
+Tests of the resumable streaming transfers (resume.py), including a
+whole day transferred from FakeES with a reader that gets killed
+"""
+import os
+import json
+import shutil
+import signal
+import tempfile
+import unittest
+import multiprocessing
+
+import resume
+import transfer_by_timestamp
+from resume import StreamPositions
+from fake_es import FakeES
+from dump_es_bytimestamp import configure_es
+from dump_es_bytimestamp import date_string_to_timestamp
+
+from tests.helpers import Args
+from tests.helpers import read_frames
+
+
+class TestWindows(unittest.TestCase):
+    def test_make_windows(self):
+        self.assertEqual(resume.make_windows(0, 10, 3), [('0', 0, 3), ('1', 3, 6), ('2', 6, 10)])
+        self.assertEqual(resume.make_windows(100, 200, 1), [('0', 100, 200)])
+
+    def test_windows_cover_the_day(self):
+        windows = resume.make_windows(1499990400, 1499990400 + 86400, 7)
+        self.assertEqual(windows[0][1], 1499990400)
+        self.assertEqual(windows[-1][2], 1499990400 + 86400)
+        for (_, _, w_to), (_, w_from, _) in zip(windows, windows[1:]):
+            self.assertEqual(w_to, w_from)
+
+    def test_window_query(self):
+        position = {'record_time': 150, 'id': 'x', 'sort': [150, 'x']}
+        query = resume.window_query(100, 200, position)
+        self.assertEqual(query['query']['range']['RecordTime'], {'gte': 150, 'lt': 200})
+        self.assertEqual(resume.window_query(100, 200)['query']['range']['RecordTime']['gte'], 100)
+
+
+class TestCountRemaining(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Ten docs per second, so positions fall between docs of the same RecordTime
+        cls.es = FakeES(n_docs=2000, n_attributes=5, docs_per_second=10).start()
+        configure_es(hosts=cls.es.hosts())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.es.stop()
+
+    def hits(self, ts_from, ts_to, position=None):
+        after = position['sort'] if position else None
+        return list(resume.search_after_hits(resume.window_query(ts_from, ts_to, position),
+                                             resume.SORT, after=after, buffer_size=150))
+
+    def test_without_position(self):
+        self.assertEqual(resume.count_remaining(1500000000, 1500000100), 1000)
+
+    def test_after_position(self):
+        hits = self.hits(1500000000, 1500000100)
+        for n in (0, 5, 9, 10, 555, 999):
+            position = resume.make_position(hits[n], hits[n]['_source'])
+            self.assertEqual(resume.count_remaining(1500000000, 1500000100, position), 999 - n)
+            self.assertEqual(len(self.hits(1500000000, 1500000100, position)), 999 - n)
+
+
+class TestStreamPositions(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'positions.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_windows_are_kept(self):
+        positions = StreamPositions(self.filename, 'day')
+        windows = positions.get_windows(0, 100, 4)
+        self.assertEqual(len(windows), 4)
+        # A later run with another number of slices keeps the windows
+        self.assertEqual(StreamPositions(self.filename, 'day').get_windows(0, 100, 2), windows)
+
+    def test_merge(self):
+        first = StreamPositions(self.filename, 'day')
+        first.get_windows(0, 100, 3)
+        second = StreamPositions(self.filename, 'day')
+        other_day = StreamPositions(self.filename, 'other')
+        other_day.get_windows(0, 10, 1)
+
+        first.ack('0', {'sort': [10, 'a']})
+        second.ack('1', {'sort': [40, 'b']})
+        second.mark_done('2')
+        first.save()
+        second.save()
+
+        merged = StreamPositions(self.filename, 'day')
+        self.assertEqual(merged.position('0'), {'sort': [10, 'a']})
+        self.assertEqual(merged.position('1'), {'sort': [40, 'b']})
+        self.assertTrue(merged.is_done('2'))
+        self.assertFalse(merged.is_done('0'))
+
+        # Saving a window again keeps what others saved meanwhile
+        first.ack('0', {'sort': [20, 'c']})
+        first.save()
+        merged.load()
+        self.assertEqual(merged.position('1'), {'sort': [40, 'b']})
+        self.assertEqual(merged.position('0'), {'sort': [20, 'c']})
+
+        merged.clear()
+        with open(self.filename, 'r') as pfile:
+            self.assertEqual(json.load(pfile).keys(), ['other'])
+
+    def test_dry_run(self):
+        positions = StreamPositions(self.filename, 'day', dry_run=True)
+        positions.get_windows(0, 100, 3)
+        positions.ack('0', {'sort': [1, 'a']})
+        positions.save()
+        self.assertFalse(os.path.exists(self.filename))
+
+
+_killed = multiprocessing.Value('b', 0)
+_window_worker = transfer_by_timestamp.es_query_worker_window
+
+
+class DyingQueue(object):
+    """Queue that kills its process after n_puts docs"""
+    def __init__(self, queue, n_puts):
+        self.queue = queue
+        self.n_puts = n_puts
+
+    def put(self, item):
+        self.queue.put(item)
+        self.n_puts -= 1
+        if self.n_puts == 0:
+            _killed.value = 1
+            os.kill(os.getpid(), signal.SIGKILL)
+
+
+def dying_window_worker(window_id, ts_from, ts_to, position, query_queue, *args):
+    """The reader of window 3 is killed the first time it runs"""
+    if window_id == '3' and not _killed.value:
+        query_queue = DyingQueue(query_queue, 1000)
+    _window_worker(window_id, ts_from, ts_to, position, query_queue, *args)
+
+
+class TestResumableTransfer(unittest.TestCase):
+    # Hourly windows: 2017-07-14 02:00-03:00 holds docs 0-1199,
+    # 03:00-04:00 docs 1200-4799 and 04:00-05:00 docs 4800-5999
+    n_docs = 6000
+
+    @classmethod
+    def setUpClass(cls):
+        cls.es = FakeES(n_docs=cls.n_docs, n_attributes=10).start()
+        # Uncompressed: workers forked while FakeES gzips would inherit
+        # the global zlib lock of python 2 held
+        configure_es(hosts=cls.es.hosts(), http_compress=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.es.stop()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.args = Args(resumable=True, es_slices=24, amq_buffer_size=300, sink='frames',
+                         frames_dir=os.path.join(self.tmpdir, 'frames'),
+                         positions_file=os.path.join(self.tmpdir, 'positions.json'))
+        _killed.value = 0
+        transfer_by_timestamp.es_query_worker_window = dying_window_worker
+
+    def tearDown(self):
+        transfer_by_timestamp.es_query_worker_window = _window_worker
+        shutil.rmtree(self.tmpdir)
+
+    def check_transfer(self):
+        self.assertTrue(transfer_by_timestamp.process_date_string('2017-07-14', self.args))
+        self.assertTrue(_killed.value)
+        ids = [doc['_id'] for doc in read_frames(self.args.frames_dir)]
+        self.assertEqual(len(set(ids)), self.n_docs)
+        self.assertEqual(len(ids), self.n_docs)
+        # The day is done, its positions are gone
+        with open(self.args.positions_file, 'r') as pfile:
+            self.assertEqual(json.load(pfile), {})
+
+    def test_killed_reader(self):
+        self.check_transfer()
+
+    def test_killed_fused_reader(self):
+        self.args.fused = True
+        self.check_transfer()
+
+    def test_resume_day(self):
+        # Windows 2 and 3 got partly done by an earlier run
+        positions = StreamPositions(self.args.positions_file, '2017-07-14')
+        day = date_string_to_timestamp('2017-07-14')
+        windows = dict((wid, (w_from, w_to))
+                       for wid, w_from, w_to in positions.get_windows(day, day + 86400, 24))
+        hits = {}
+        for wid in ('2', '3'):
+            w_from, w_to = windows[wid]
+            hits[wid] = list(resume.search_after_hits(resume.window_query(w_from, w_to),
+                                                      resume.SORT, buffer_size=1000))[:700]
+            positions.ack(wid, resume.make_position(hits[wid][-1], hits[wid][-1]['_source']))
+        positions.mark_done('5')
+        positions.save()
+
+        _killed.value = 1
+        self.assertTrue(transfer_by_timestamp.process_date_string('2017-07-14', self.args))
+        ids = set(doc['_id'] for doc in read_frames(self.args.frames_dir))
+        done = set(hit['_source']['GlobalJobId'] for wid in hits for hit in hits[wid])
+        self.assertEqual(len(ids), self.n_docs - len(done))
+        self.assertFalse(ids & done)
+
+
+if __name__ == '__main__':
+    unittest.main()
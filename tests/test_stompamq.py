@@ -0,0 +1,160 @@
+"""
+Tests of the batching, compression, fan-out and spooling of StompAMQ
+against local fake brokers. Run from the top directory with
+
+    python -m unittest discover -s tests -t .
+"""
+import os
+import json
+import time
+import socket
+import shutil
+import logging
+import tempfile
+import unittest
+
+from StompAMQ import StompAMQ
+from StompAMQ import compress
+from StompAMQ import decompress
+from bench_amq import synthetic_ads
+from fake_broker import FakeBroker
+
+
+logging.getLogger('StompAMQ').setLevel(logging.CRITICAL)
+logging.getLogger('stomp.py').setLevel(logging.CRITICAL)
+
+
+def closed_port():
+    """A local port nobody listens on"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return ('127.0.0.1', port)
+
+
+def notifications(interface, ads):
+    return [interface.make_notification(payload=dict(ad), id_=ad['GlobalJobId'],
+                                        timestamp=ad['RecordTime']) for ad in ads]
+
+
+def read_spool(spool_file):
+    with open(spool_file, 'r') as spool:
+        frames = [json.loads(line) for line in spool if line.strip()]
+    return [doc for frame in frames for doc in StompAMQ.documents(frame['headers'], frame['body'])]
+
+
+class TestBatching(unittest.TestCase):
+    def setUp(self):
+        self.ads = synthetic_ads(50, n_attributes=30)
+
+    def round_trip(self, **options):
+        interface = StompAMQ('user', 'pass', **options)
+        docs = []
+        for _, headers, _, payload in interface.frames(notifications(interface, self.ads)):
+            docs.extend(StompAMQ.unpack(headers, payload))
+        return docs
+
+    def test_round_trip(self):
+        for batch_format in ('json', 'ndjson'):
+            for compression in (None, 'gzip', 'zlib'):
+                docs = self.round_trip(batch_size=7, batch_format=batch_format,
+                                       compression=compression)
+                self.assertEqual([d['_id'] for d in docs],
+                                 [ad['GlobalJobId'] for ad in self.ads])
+                self.assertEqual([d['Workflow'] for d in docs],
+                                 [ad['Workflow'] for ad in self.ads])
+
+    def test_batch_limits(self):
+        interface = StompAMQ('user', 'pass', batch_size=7)
+        batches = list(interface._make_batches(notifications(interface, self.ads)))
+        self.assertEqual([len(b['body']) for b in batches], [7]*7 + [1])
+        self.assertEqual(batches[0]['batch-size'], '7')
+
+        interface = StompAMQ('user', 'pass', batch_size=100, batch_bytes=5000)
+        for batch in interface._make_batches(notifications(interface, self.ads)):
+            self.assertTrue(len(batch['_serialized']) <= 5000 or len(batch['body']) == 1)
+
+    def test_unbatched(self):
+        docs = self.round_trip()
+        self.assertEqual([d['_id'] for d in docs], [ad['GlobalJobId'] for ad in self.ads])
+
+
+class TestCompression(unittest.TestCase):
+    def test_round_trip(self):
+        data = json.dumps(synthetic_ads(20, n_attributes=30))
+        for encoding in ('gzip', 'zlib'):
+            for level in (1, 6, 9):
+                compressed = compress(data, encoding, level)
+                self.assertTrue(len(compressed) < len(data))
+                self.assertEqual(decompress(compressed, encoding), data)
+
+    def test_gzip_header(self):
+        self.assertEqual(compress('x', 'gzip')[:2], '\x1f\x8b')
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, compress, 'x', 'lz4')
+        self.assertRaises(ValueError, decompress, 'x', 'lz4')
+
+
+class TestBrokerPool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool_file = os.path.join(self.tmpdir, 'spool.json')
+        self.broker = FakeBroker(keep_messages=True).start()
+        self.ads = synthetic_ads(40, n_attributes=20)
+
+    def tearDown(self):
+        self.broker.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def send(self, host_and_ports, **options):
+        interface = StompAMQ('user', 'pass', host_and_ports=host_and_ports,
+                             spool_file=self.spool_file, retry_after=600, **options)
+        sent = interface.send(notifications(interface, self.ads))
+        pool = interface._pool
+        interface.close()
+        return sent, pool
+
+    def wait_for(self, n_docs):
+        # The broker may still be unpacking the last frames
+        deadline = time.time() + 10
+        while self.broker.n_docs < n_docs and time.time() < deadline:
+            time.sleep(0.01)
+        return self.broker.n_docs
+
+    def test_eject_and_redistribute(self):
+        for policy in ('round_robin', 'least_loaded'):
+            self.broker.reset()
+            dead = closed_port()
+            sent, pool = self.send([dead] + self.broker.host_and_ports(),
+                                   fan_out=policy, batch_size=3)
+            self.assertEqual(sorted(d['_id'] for d in sent),
+                             sorted(ad['GlobalJobId'] for ad in self.ads))
+            self.assertFalse([b for b in pool.brokers if b.host_and_port == dead][0].is_healthy())
+            self.assertEqual(self.wait_for(len(self.ads)), len(self.ads))
+            self.assertFalse(os.path.exists(self.spool_file))
+
+    def test_spool_when_all_down(self):
+        sent, pool = self.send([closed_port(), closed_port()], fan_out='round_robin',
+                               batch_size=3)
+        self.assertEqual(sent, [])
+        self.assertFalse([b for b in pool.brokers if b.is_healthy()])
+        self.assertEqual(sorted(d['_id'] for d in read_spool(self.spool_file)),
+                         sorted(ad['GlobalJobId'] for ad in self.ads))
+
+    def test_replay_spool(self):
+        self.send([closed_port()])
+        self.assertEqual(len(read_spool(self.spool_file)), len(self.ads))
+
+        interface = StompAMQ('user', 'pass', host_and_ports=self.broker.host_and_ports())
+        replayed = []
+        self.assertEqual(interface.replay(self.spool_file, on_sent=replayed.extend),
+                         (len(self.ads), 0))
+        self.assertEqual(len(replayed), len(self.ads))
+        self.assertFalse(os.path.exists(self.spool_file))
+        self.assertEqual(self.wait_for(len(self.ads)), len(self.ads))
+
+
+if __name__ == '__main__':
+    unittest.main()
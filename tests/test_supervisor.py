@@ -0,0 +1,164 @@
+"""Tests of the worker supervision and of the shared byte budget"""
+import os
+import time
+import signal
+import unittest
+import multiprocessing
+
+from supervisor import Supervisor
+from supervisor import beat
+from memory_budget import ByteBudget
+from memory_budget import is_alive
+
+
+def _exit(code, delay=0.):
+    time.sleep(delay)
+    os._exit(code)
+
+
+def _fail_once(failed):
+    if not failed.value:
+        failed.value = 1
+        os._exit(1)
+
+
+def _stall():
+    beat()
+    time.sleep(60)
+
+
+class SlowSupervisor(Supervisor):
+    """Lets time pass between checking a running worker and the next one"""
+    def check(self, worker):
+        running = worker.process.exitcode is None
+        reason = Supervisor.check(self, worker)
+        if running:
+            time.sleep(0.5)
+        return reason
+
+
+class TestSupervisor(unittest.TestCase):
+    def test_success(self):
+        supervisor = Supervisor(interval=0.01)
+        for n in range(3):
+            supervisor.start('worker_%d' % n, _exit, (0, 0.1*n))
+        self.assertEqual(supervisor.run(), [])
+
+    def test_failure_stops_all(self):
+        supervisor = Supervisor(interval=0.01)
+        sleeper = supervisor.start('sleeper', _stall, ())
+        supervisor.start('failing', _exit, (1, 0.1))
+        self.assertEqual(supervisor.run(), ['failing'])
+        self.assertNotEqual(sleeper.process.exitcode, None)
+
+    def test_restart(self):
+        failed = multiprocessing.Value('b', 0)
+        supervisor = Supervisor(interval=0.01)
+        worker = supervisor.start('flaky', _fail_once, (failed,), restartable=True)
+        self.assertEqual(supervisor.run(), [])
+        self.assertEqual(worker.n_restarts, 1)
+
+    def test_stall(self):
+        supervisor = Supervisor(stall_timeout=0.3, max_restarts=1, interval=0.01)
+        worker = supervisor.start('stalled', _stall, (), restartable=True)
+        self.assertEqual(supervisor.run(), ['stalled'])
+        self.assertEqual(worker.n_restarts, 1)
+
+    def test_failure_after_its_check(self):
+        # The worker fails while the supervisor checks the others
+        supervisor = SlowSupervisor(interval=0.01)
+        supervisor.start('done', _exit, (0,))
+        supervisor.start('failing', _exit, (1, 0.2))
+        time.sleep(0.1)
+        self.assertEqual(supervisor.run(), ['failing'])
+
+
+def _hold_lock(budget, seconds):
+    budget._acquire_lock()
+    time.sleep(seconds)
+    budget._release_lock()
+
+
+def _hold_raw_lock(budget):
+    budget._lock.acquire()
+    time.sleep(60)
+
+
+def _acquire(budget, nbytes):
+    budget.acquire(nbytes)
+
+
+class TestByteBudget(unittest.TestCase):
+    def test_budget(self):
+        budget = ByteBudget(100)
+        budget.acquire(200) # more than the budget, but nothing else in flight
+        self.assertEqual(budget.in_flight(), 200)
+        budget.release(200)
+        budget.acquire(60)
+        budget.acquire(40)
+        self.assertEqual(budget.in_flight(), 100)
+        budget.release(100)
+        self.assertEqual(budget.in_flight(), 0)
+
+    def test_waits_for_release(self):
+        budget = ByteBudget(100, poll_interval=10.)
+        budget.acquire(80)
+        waiter = multiprocessing.Process(target=_acquire, args=(budget, 50))
+        waiter.start()
+        time.sleep(0.2)
+        self.assertTrue(waiter.is_alive())
+        starttime = time.time()
+        budget.release(80)
+        waiter.join()
+        self.assertTrue(time.time() - starttime < 1.)
+        self.assertEqual(budget.in_flight(), 50)
+
+    def test_slow_holder_keeps_the_lock(self):
+        budget = ByteBudget(100, lock_timeout=0.1)
+        holder = multiprocessing.Process(target=_hold_lock, args=(budget, 1.))
+        holder.start()
+        time.sleep(0.2)
+        starttime = time.time()
+        budget.acquire(10)
+        self.assertTrue(time.time() - starttime > 0.5)
+        holder.join()
+        budget.release(10)
+        self.assertEqual(budget.in_flight(), 0)
+        budget.acquire(10) # the lock is still usable
+        self.assertEqual(budget.in_flight(), 10)
+
+    def test_dead_holder(self):
+        budget = ByteBudget(1000, lock_timeout=0.2)
+        budget.acquire(10)
+        holder = multiprocessing.Process(target=_hold_lock, args=(budget, 60.))
+        holder.start()
+        time.sleep(0.2)
+        os.kill(holder.pid, signal.SIGKILL)
+        time.sleep(0.1)
+        self.assertFalse(is_alive(holder.pid)) # a zombie counts as dead
+
+        # Several waiters time out, only one takes the lock over
+        waiters = [multiprocessing.Process(target=_acquire, args=(budget, 20)) for _ in range(3)]
+        for waiter in waiters:
+            waiter.start()
+        for waiter in waiters:
+            waiter.join(10)
+            self.assertEqual(waiter.exitcode, 0)
+        holder.join()
+        self.assertEqual(budget.in_flight(), 70)
+        budget.release(70)
+        self.assertEqual(budget.in_flight(), 0)
+
+    def test_unrecorded_dead_holder(self):
+        budget = ByteBudget(1000, lock_timeout=0.2)
+        holder = multiprocessing.Process(target=_hold_raw_lock, args=(budget,))
+        holder.start()
+        time.sleep(0.2)
+        os.kill(holder.pid, signal.SIGKILL)
+        holder.join()
+        budget.acquire(10)
+        self.assertEqual(budget.in_flight(), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,62 +1,40 @@
 #!/usr/bin/env python
 import os
 import sys
-import csv
-import json
 import time
-import shlex
-import subprocess
 
 from argparse import ArgumentParser
 
+import codec
 import dump_es_index
-
-from amq import post_ads
+import verify_dump
+
+from amq import configure as configure_amq
+from sinks import make_sink
+from ledger import SendLedger
+from memory_budget import peak_rss
+from profiling import profile_target
+from profiling import print_summary
+from index_catalog import IndexCatalog
+from index_catalog import fetch_index_names
 from transfer_helpers import convert_dates_to_millisecs
-from transfer_helpers import read_es_config
 from transfer_helpers import free_diskspace
 from transfer_helpers import set_up_logging
 
 
 def get_index_names_quick(pattern='cms-20'):
     """Download and return a list of all index names"""
-    es_conf = read_es_config("es.conf")
-
-    cmd = "curl https://{user}:{pass}@{host}:{port}/_indices?v".format(**es_conf)
-    result = subprocess.Popen(shlex.split(cmd),
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE).communicate()[0]
-
-    result = json.loads(result)
-    indices = [k for k in result.keys() if k.startswith(pattern)]
-
-    return sorted(indices)
+    return fetch_index_names(pattern)
 
 
 def get_index_data(pattern='cms-20', outputfile='indices.json'):
-    """Download a list of all indices with more information"""
-    es_conf = read_es_config("es.conf")
-
-    cmd = "curl https://{user}:{pass}@{host}:{port}/_cat/_indices?v".format(**es_conf)
-    result = subprocess.Popen(shlex.split(cmd),
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE).communicate()[0]
-
-    lines = result.split('\n')
-    reader = csv.DictReader(lines, delimiter=' ', skipinitialspace=True)
+    """Download or refresh the list of all indices with more information"""
+    catalog = IndexCatalog(pattern=pattern, cache_file=outputfile)
+    n_refreshed = catalog.refresh()
 
-    indices = {}
-    for row in reader:
-        if not row['index'].startswith(pattern):
-            continue
-        indices[row['index']] = row
-
-    print "Found %d indices on %s:%d for pattern '%s'" % (len(indices.keys()), hostname, port, pattern)
-
-    with open(outputfile, 'w') as jsonfile:
-        json.dump(indices, jsonfile, indent=2, sort_keys=True)
-
-    print "Wrote index information to '%s'" % outputfile 
+    print "Found %d indices for pattern '%s', %d refreshed" % (
+        len(catalog.indices), pattern, n_refreshed)
+    print "Wrote index information to '%s'" % outputfile
 
 
 def remove_local_dump(index, target='/data/raw_index_data/'):
@@ -76,13 +54,33 @@ def dump_or_load(index, source):
     return location
 
 
+def read_dump(location, index):
+    """
+    Yield the (_source, size in bytes) of the docs in a local dump. This
+    reads every attribute of every doc, so the dumps are kept as json
+    lines: rebuilding full docs from a columnar dump is slower.
+    """
+    with open(location, 'r') as dumpfile:
+        for n_line, line in enumerate(dumpfile):
+            try:
+                raw = codec.loads(line)
+            except ValueError, e:
+                print "&&& ERROR: Failed to parse doc from line in raw data! index %s, line %d" % (index, n_line+1)
+                raise e
+            yield raw['_source'], len(line)
+
+
 class ESTransferByIndex(object):
     def __init__(self, args):
         self.args = args
         self.index_info_file = 'indices.json'
         self.dump_location = '/data/raw_index_data/'
-        self.buffer_size = 10000
+        self.buffer_bytes = self.args.buffer_bytes
+        self.sink = make_sink('null' if self.args.dry_run else self.args.sink,
+                              frames_dir=self.args.frames_dir,
+                              ledger=SendLedger(self.args.ledger_file) if self.args.ledger_file else None)
         self.buffer = []
+        self.n_buffer_bytes = 0
 
         self.checkpoint = []
 
@@ -96,8 +94,28 @@ class ESTransferByIndex(object):
 
 
     def load_index_info(self):
-        with open(self.index_info_file, 'r') as idxfile:
-            self.index_info = json.load(idxfile)
+        if not os.path.exists(self.index_info_file):
+            raise IOError("No index information in %s, run with --get_index_data %s first" %
+                          (self.index_info_file, self.index_info_file))
+        self.catalog = IndexCatalog(cache_file=self.index_info_file)
+        self.index_info = self.catalog.indices
+
+
+    def order_indices(self, indices):
+        """
+        Order the indices by name or by size, and select the share of
+        this worker if the work is split over several processes. With
+        --until_index, only the indices up to it (by name) are kept.
+        """
+        if self.args.until_index:
+            indices = [i for i in indices if i <= self.args.until_index]
+
+        if self.args.workers > 1:
+            indices = self.catalog.bin_pack(self.args.workers, indices)[self.args.worker_id]
+
+        if self.args.order == 'largest':
+            return self.catalog.largest_first(indices)
+        return sorted(indices)
 
 
     def load_checkpoint(self):
@@ -127,15 +145,18 @@ class ESTransferByIndex(object):
         Process indices that is not in checkpoint file (i.e. marked as done),
         and run elasticdump to download them to local disk.
 
-        If check is true, check whether the number of entries are consistent.
+        If check is true, compare the number of entries per hour (and with
+        --check_ids their _ids) with ES, and download the inconsistent
+        windows again. A dump that is still inconsistent after that is
+        deleted and the index left for the next run.
         """
         starttime = time.time()
 
-        indices_to_process = self.selected_indices or sorted(self.index_info.keys())
-        indices_to_process = set(indices_to_process).difference(set(self.checkpoint))
+        indices_to_process = self.order_indices(self.selected_indices or self.index_info.keys())
+        indices_to_process = [i for i in indices_to_process if i not in self.checkpoint]
 
         # Process first index that is not in checkpoint
-        for index in sorted(indices_to_process):
+        for index in indices_to_process:
 
             mystart = time.time()
             print (">>> Processing index %s (size: %s, ndocs: %d)" %
@@ -146,39 +167,38 @@ class ESTransferByIndex(object):
                 print (">>> Less than 20 GB free disk space, aborting.")
                 return
 
-            with open(dump_or_load(index, source=self.dump_location), 'r') as dumpfile:
-                if check:
-                    count = 0
-                    for line in dumpfile:
-                        count += 1
-
-                    # Check if length is what we expected from the index data
-                    assert(count == int(self.index_info[index]['docs.count']))
+            location = dump_or_load(index, source=self.dump_location)
+            if check:
+                bad_windows = verify_dump.verify_and_refetch(location, index=index,
+                                                             workers=self.args.verify_workers,
+                                                             check_ids=self.args.check_ids)
+                if bad_windows:
+                    print (">>> Dump of %s still inconsistent in %d windows, removing it" %
+                           (index, len(bad_windows)))
+                    remove_local_dump(index, self.dump_location)
+                    continue
 
-                print (">>> Index %s done, %d docs, %s size, %.2f mins, %.2f mins total" %
-                        (index,
-                         int(self.index_info[index]['docs.count']),
-                         self.index_info[index]['pri.store.size'],
-                         (time.time()-mystart)/60.,
-                         (time.time()-starttime)/60.))
+            print (">>> Index %s done, %d docs, %s size, %.2f mins, %.2f mins total" %
+                    (index,
+                     int(self.index_info[index]['docs.count']),
+                     self.index_info[index]['pri.store.size'],
+                     (time.time()-mystart)/60.,
+                     (time.time()-starttime)/60.))
 
 
     def clear_buffer(self):
         bunch = ((d['GlobalJobId'], convert_dates_to_millisecs(d)) for d in self.buffer)
-        if self.args.dry_run:
-            self.buffer = []
-            return
-
-        n_sent = post_ads(bunch)
+        n_sent = self.sink.post(bunch)
         assert(n_sent == len(self.buffer))
         self.buffer = []
+        self.n_buffer_bytes = 0
 
 
     def run(self):
         starttime = time.time()
 
         # Process first index that is not in checkpoint
-        for index in sorted(self.index_info.keys()):
+        for index in self.order_indices(self.index_info.keys()):
             if index in self.checkpoint:
                 continue
 
@@ -200,24 +220,18 @@ class ESTransferByIndex(object):
                          (index, self.index_info[index]['pri.store.size'], n_total))
 
             count = 0
-            with open(dump_or_load(index, source=self.dump_location), 'r') as dumpfile:
-                for line in dumpfile:
-                    try:
-                        raw = json.loads(line)
-                        doc = raw['_source']
-                    except ValueError, e:
-                        print "&&& ERROR: Failed to parse doc from line in raw data! index %s, line %d" % (index, count+1)
-                        raise e
-
-                    self.buffer.append(doc)
-                    count += 1
-
-                    if len(self.buffer) == self.buffer_size:
-                        self.clear_buffer()
-                        sys.stdout.write(">>> Sent {}/{} [{:.1%}]\r".format(
-                                    count, n_total,
-                                    count/float(n_total)))
-                        sys.stdout.flush()
+            location = dump_or_load(index, source=self.dump_location)
+            for doc, size in read_dump(location, index):
+                self.buffer.append(doc)
+                self.n_buffer_bytes += size
+                count += 1
+
+                if self.n_buffer_bytes >= self.buffer_bytes:
+                    self.clear_buffer()
+                    sys.stdout.write(">>> Sent {}/{} [{:.1%}]\r".format(
+                                count, n_total,
+                                count/float(n_total)))
+                    sys.stdout.flush()
 
             # Check if length is what we expected from the index data
             assert(count == n_total)
@@ -232,11 +246,16 @@ class ESTransferByIndex(object):
                     (time.time()-mystart)/60.,
                     (time.time()-starttime)/60.))
 
-            if index == self.args.until_index:
-                break
+        self.sink.close()
+        print ">>> %s" % self.sink.summary()
 
 
 def main(args):
+    configure_amq(spool_file=args.spool_file or None,
+                  batch_size=args.amq_batch_docs,
+                  batch_bytes=args.amq_batch_bytes,
+                  compression=args.amq_compression,
+                  fan_out=args.amq_fan_out)
 
     if args.get_index_data != '':
         outputfile = args.get_index_data
@@ -245,12 +264,18 @@ def main(args):
         get_index_data(outputfile=outputfile)
         return
 
+    starttime = time.time()
     est = ESTransferByIndex(args=args)
 
     if args.dump:
-        est.dump()
+        profile_target(est.dump, 'dump', args.profile, args.profile_dir)(check=args.check)
     else:
-        est.run()
+        profile_target(est.run, 'run', args.profile, args.profile_dir)()
+
+    print ">>> Peak memory: %.1f MB" % (peak_rss()/1e6)
+
+    if args.profile:
+        print_summary(args.profile_dir, since=starttime)
 
 
 if __name__ == '__main__':
@@ -264,16 +289,70 @@ if __name__ == '__main__':
     parser.add_argument("--dump", action='store_true',
                         dest="dump",
                         help="Just run elasticdump")
+    parser.add_argument("--check", action='store_true',
+                        dest="check",
+                        help="Verify the dumps against ES (with --dump)")
+    parser.add_argument("--check_ids", action='store_true',
+                        dest="check_ids",
+                        help="With --check, also compare a hash of the _ids of every hour (ES loads the _ids "
+                             "into memory for that)")
+    parser.add_argument("--verify_workers", default=4,
+                        type=int, dest="verify_workers",
+                        help="Number of parallel readers for --check [default: %(default)s]")
+    parser.add_argument("--sink", default='amq',
+                        choices=['amq', 'frames', 'null'], dest="sink",
+                        help="Send to AMQ, write frames to --frames_dir, or only encode and count [default: %(default)s]")
+    parser.add_argument("--frames_dir", default='frames/',
+                        type=str, dest="frames_dir",
+                        help="Directory for the frames sink [default: %(default)s]")
     parser.add_argument("--dry_run", action='store_true',
                         dest="dry_run",
-                        help="Don't do anything")
+                        help="Use the null sink and don't update the checkpoint")
+    parser.add_argument("--profile", default=None,
+                        choices=['cprofile', 'sample'], dest="profile",
+                        help="Profile the transfer [default: %(default)s]")
+    parser.add_argument("--profile_dir", default='profile/',
+                        type=str, dest="profile_dir",
+                        help="Write the profiles here [default: %(default)s]")
+    parser.add_argument("--spool_file", default='amq_spool.json',
+                        type=str, dest="spool_file",
+                        help="Keep notifications that failed to send here for replay_spool.py [default: %(default)s]")
+    parser.add_argument("--ledger_file", default='ledger.json',
+                        type=str, dest="ledger_file",
+                        help="Count the docs sent to AMQ per hour of RecordTime here, for reconcile.py "
+                             "(empty to disable) [default: %(default)s]")
+    parser.add_argument("--amq_batch_docs", default=1,
+                        type=int, dest="amq_batch_docs",
+                        help="Pack up to this many docs into a single AMQ message [default: %(default)s]")
+    parser.add_argument("--amq_batch_bytes", default=512*1024,
+                        type=int, dest="amq_batch_bytes",
+                        help="Maximum size in bytes of a packed AMQ message [default: %(default)s]")
+    parser.add_argument("--amq_compression", default=None,
+                        choices=['gzip', 'zlib'], dest="amq_compression",
+                        help="Compress AMQ message bodies [default: %(default)s]")
+    parser.add_argument("--amq_fan_out", default=None,
+                        choices=['round_robin', 'least_loaded'], dest="amq_fan_out",
+                        help="Spread AMQ messages over all broker nodes [default: %(default)s]")
+    parser.add_argument("--buffer_bytes", default=50e6,
+                        type=float, dest="buffer_bytes",
+                        help="Upload docs in batches of this many bytes of raw json [default: %(default)s]")
     parser.add_argument("--clean_after_upload", action='store_true',
                         dest="clean_after_upload",
                         help="Remove the local dump after uploading (to clear space)")
 
     parser.add_argument("--until_index", default='',
                         type=str, dest="until_index",
-                        help="Process everything up to and including this index [default: %(default)s]")
+                        help="Process everything up to and including this index by name, "
+                             "also with --order largest [default: %(default)s]")
+    parser.add_argument("--order", default='name',
+                        choices=['name', 'largest'], dest="order",
+                        help="Process the indices by name or largest first [default: %(default)s]")
+    parser.add_argument("--workers", default=1,
+                        type=int, dest="workers",
+                        help="Split the indices by size over this many processes [default: %(default)s]")
+    parser.add_argument("--worker_id", default=0,
+                        type=int, dest="worker_id",
+                        help="Process the share of this worker (0..workers-1) [default: %(default)s]")
     parser.add_argument("--process_these", default='',
                         type=str, dest="process_these",
                         help="Process these indices (comma-sep list) [default: %(default)s]")
@@ -1,30 +1,60 @@
 #!/usr/bin/env python
 import os
 import time
-import json
+import Queue
+import functools
 import multiprocessing
 
 from argparse import ArgumentParser
 
+import codec
+
 from dump_es_bytimestamp import make_query
+from dump_es_bytimestamp import configure_es
 from dump_es_bytimestamp import get_es_scan
 from dump_es_bytimestamp import get_total_hits
 from dump_es_bytimestamp import date_string_to_timestamp
 from dump_es_bytimestamp import get_es_scan_sliced
 from dump_es_bytimestamp import get_total_hits_sliced
-
-from amq import post_ads
+from dump_es_bytimestamp import get_target_shards
+from dump_es_bytimestamp import get_es_scan_shard
+from dump_es_bytimestamp import search_after_hits
+from dump_es_bytimestamp import sharded_dump_dir
+from dump_es_bytimestamp import read_manifest
+
+from amq import configure as configure_amq
+from sinks import make_sink
+from ledger import SendLedger
+from columnar import ColumnarReader
+from memory_budget import ByteBudget
+from memory_budget import SizeEstimator
+from memory_budget import peak_tree_rss, sample_tree_rss
+from supervisor import Supervisor
+from supervisor import beat
+from profiling import profile_target
+from profiling import print_summary
+from autoslice import SliceStats
+from autoslice import SliceTuner
+from autoslice import initial_slices
+from resume import SORT
+from resume import make_windows
+from resume import StreamPositions
+from resume import window_query
+from resume import count_remaining
+from resume import make_position
 from transfer_helpers import print_progress
 from transfer_helpers import convert_dates_to_millisecs
 from transfer_helpers import read_es_config
 from transfer_helpers import get_total_lines
+from transfer_helpers import bin_pack
 
 
-def es_query_worker(query, query_queue, buffer_size, n_total):
+def es_query_worker(query, query_queue, budget, buffer_size, n_total):
     """
     Do an ES scan for a given query and feed the
     resulting docs into the queue
     """
+    estimate_size = SizeEstimator()
     count = 0
     for raw_doc in get_es_scan(query, buffer_size=buffer_size):
         try:
@@ -34,19 +64,23 @@ def es_query_worker(query, query_queue, buffer_size, n_total):
             print str(doc[:200])
             raise e
 
-        query_queue.put(doc)
+        nbytes = estimate_size(doc)
+        budget.acquire(nbytes)
+        query_queue.put((nbytes, doc))
+        beat()
         count += 1
 
     query_queue.put(None) # send poison pill
     assert(count == n_total), "Inconsistent count (query worker)"
 
 
-def es_query_worker_sliced(query, slice_id, max_slices, query_queue, buffer_size):
+def es_query_worker_sliced(query, slice_id, max_slices, query_queue, budget, buffer_size):
     """
     Do an ES scan for a given query and feed the
     resulting docs into the queue
     """
     n_total_in_slice = get_total_hits_sliced(query, slice_id, max_slices)
+    estimate_size = SizeEstimator()
     count = 0
     for raw_doc in get_es_scan_sliced(query, slice_id,
                                       max_slices=max_slices,
@@ -58,19 +92,189 @@ def es_query_worker_sliced(query, slice_id, max_slices, query_queue, buffer_size
             print str(doc[:200])
             raise e
 
-        query_queue.put(doc)
+        nbytes = estimate_size(doc)
+        budget.acquire(nbytes)
+        query_queue.put((nbytes, doc))
+        beat()
         count += 1
 
     query_queue.put(None) # send poison pill
 
 
-def file_read_worker(filename, query_queue, n_total):
-    query_queue.put(n_total) # first put the total expected
+def es_query_worker_shards(query, shards, query_queue, budget, buffer_size):
+    """
+    Scan a list of (index, shard, n_docs) one after the other and feed
+    the resulting docs into the queue
+    """
+    estimate_size = SizeEstimator()
+    for index, shard, n_docs in shards:
+        count = 0
+        for raw_doc in get_es_scan_shard(query, index, shard, buffer_size=buffer_size):
+            doc = raw_doc['_source']
+            nbytes = estimate_size(doc)
+            budget.acquire(nbytes)
+            query_queue.put((nbytes, doc))
+            beat()
+            count += 1
+
+        assert(count == n_docs), "Inconsistent count (shard %s/%d)" % (index, shard)
+
+    query_queue.put(None) # send poison pill
+
+
+def es_query_worker_window(window_id, ts_from, ts_to, position, query_queue, budget, buffer_size):
+    """
+    Read the docs of a RecordTime window in (RecordTime, _id) order,
+    starting after position, and feed them into the queue together
+    with their position
+    """
+    estimate_size = SizeEstimator()
+    after = position['sort'] if position else None
+    for hit in search_after_hits(window_query(ts_from, ts_to, position), SORT,
+                                 after=after, buffer_size=buffer_size):
+        doc = hit['_source']
+        nbytes = estimate_size(doc)
+        budget.acquire(nbytes)
+        query_queue.put((nbytes, doc, (window_id, make_position(hit, doc))))
+        beat()
+
+    query_queue.put((None, window_id)) # send poison pill for this window
 
+
+def es_query_worker_units(slot, units, next_unit, stats, query_queue, budget, buffer_size):
+    """
+    Scan RecordTime units one after the other, always taking the next
+    one that no other reader took, until none is left or the slot is
+    retired, and feed the resulting docs into the queue
+    """
+    estimate_size = SizeEstimator()
+    while not stats.is_retired(slot):
+        with next_unit.get_lock():
+            n_unit = next_unit.value
+            next_unit.value += 1
+        if n_unit >= len(units):
+            break
+
+        _, ts_from, ts_to = units[n_unit]
+        n_docs, es_seconds, wait_seconds = 0, 0., 0.
+        starttime = time.time()
+        for raw_doc in get_es_scan(make_query(ts_from, ts_to), buffer_size=buffer_size):
+            readtime = time.time()
+            es_seconds += readtime - starttime
+            doc = raw_doc['_source']
+            nbytes = estimate_size(doc)
+            budget.acquire(nbytes)
+            query_queue.put((nbytes, doc))
+            beat()
+            n_docs += 1
+            starttime = time.time()
+            wait_seconds += starttime - readtime
+            if n_docs % 1000 == 0:
+                stats.add(slot, n_docs, es_seconds, wait_seconds)
+                n_docs, es_seconds, wait_seconds = 0, 0., 0.
+
+        stats.add(slot, n_docs, es_seconds, wait_seconds)
+
+
+def es_query_worker_auto(query, ts_from, ts_to, max_slices, query_queue, budget, buffer_size,
+                         unit_seconds=15*60, interval=10., profile=None, profile_dir='profile/'):
+    """
+    Read [ts_from, ts_to) in units of unit_seconds with a number of
+    parallel readers that is tuned while running (see autoslice), and
+    send a single poison pill when all of them are done
+    """
+    n_slices = initial_slices(get_target_shards(query), max_slices)
+    units = make_windows(ts_from, ts_to, max((ts_to - ts_from) // unit_seconds, 1))
+    next_unit = multiprocessing.Value('l', 0)
+    stats = SliceStats(max_slices)
+    tuner = SliceTuner(n_slices, max_slices)
+    readers = [None] * max_slices
+
+    def start_reader(slot):
+        stats.reuse(slot)
+        readers[slot] = multiprocessing.Process(target=profile_target(es_query_worker_units,
+                                                                      'es_query_worker_units_%d' % slot,
+                                                                      profile, profile_dir),
+                                                args=(slot, units, next_unit, stats,
+                                                      query_queue, budget, buffer_size),
+                                                name="es_query_worker_units_%d" % slot)
+        readers[slot].start()
+
+    print "    Reading %d units with %d slices (at most %d)" % (len(units), n_slices, max_slices)
+    for slot in range(n_slices):
+        start_reader(slot)
+
+    last_totals = stats.totals()
+    while any(r.is_alive() for r in readers if r is not None):
+        time.sleep(interval)
+        failed = [r.name for r in readers if r is not None and r.exitcode not in (None, 0)]
+        if failed:
+            for reader in readers:
+                if reader is not None and reader.is_alive():
+                    reader.terminate()
+            raise RuntimeError("Readers failed: %s" % ', '.join(failed))
+
+        totals = stats.totals()
+        n_docs, es_seconds, wait_seconds = [t - l for t, l in zip(totals, last_totals)]
+        last_totals = totals
+        active = [slot for slot, r in enumerate(readers)
+                  if r is not None and r.is_alive() and not stats.is_retired(slot)]
+        if next_unit.value >= len(units) or not active or not n_docs:
+            continue
+
+        n_target = tuner.update(n_docs / interval,
+                                es_seconds * buffer_size / n_docs,
+                                wait_seconds / (interval * len(active)))
+        free = [slot for slot, r in enumerate(readers) if r is None or not r.is_alive()]
+        n_slices = len(active)
+        if n_target > len(active) and free:
+            start_reader(free[0])
+            n_slices += 1
+        elif n_target < len(active):
+            stats.retire(active[-1])
+            n_slices -= 1
+        tuner.n_slices = n_slices
+        if n_slices != len(active):
+            print "    %.0f docs/s, %.2f s per page: %d slices" % (n_docs / interval,
+                                                                   es_seconds * buffer_size / n_docs,
+                                                                   n_slices)
+
+    for reader in readers:
+        if reader is not None:
+            reader.join()
+
+    query_queue.put(None) # send poison pill
+
+
+# Fields the upload always needs, whatever --fields selects
+REQUIRED_FIELDS = ['GlobalJobId', 'RecordTime']
+
+
+def file_read_worker(filename, query_queue, budget, n_total, fields=None, reader_id='file'):
+    """
+    Queue the docs of a json or columnar dump, with only the given fields
+    (all if None). Columnar dumps only decode the columns of the fields.
+    Docs come with their (reader_id, position) in the file, so that the
+    uploader can skip what it already got if the reader starts over.
+    """
     count = 0
+    if filename.endswith('.col'):
+        estimate = SizeEstimator()
+        for hit in ColumnarReader(filename).read(fields=fields):
+            doc = hit['_source']
+            size = estimate(doc)
+            budget.acquire(size)
+            query_queue.put((size, doc, (reader_id, {'sort': [count]})))
+            beat()
+            count += 1
+
+        assert(count == n_total), "Inconsistent count (query worker)"
+        query_queue.put(None) # send poison pill
+        return
+
     with open(filename, "r") as dumpfile:
         for line in dumpfile:
-            raw_doc = json.loads(line)
+            raw_doc = codec.loads(line)
             try:
                 doc = raw_doc['_source']
             except ValueError, e:
@@ -78,120 +282,355 @@ def file_read_worker(filename, query_queue, n_total):
                 print str(doc[:200])
                 raise e
 
-            query_queue.put(doc)
+            if fields is not None:
+                doc = {k: doc[k] for k in fields if k in doc}
+            budget.acquire(len(line))
+            query_queue.put((len(line), doc, (reader_id, {'sort': [count]})))
+            beat()
             count += 1
 
-    query_queue.put(None) # send poison pill
+    # Check before the poison pill, a restarted reader sends it again
     assert(count == n_total), "Inconsistent count (query worker)"
+    query_queue.put(None) # send poison pill
 
 
-def amq_upload_worker(query_queue, batch_size=5000, dry_run=False, max_slices=1):
+def amq_upload_worker(query_queue, budget, sink, batch_size=5000, batch_bytes=50e6,
+                      max_slices=1, positions=None):
+    """
+    Upload the docs from the queue in batches until all readers sent
+    their poison pill. With positions (a StreamPositions), docs come with
+    their (window_id, position), which is acknowledged and saved after
+    every uploaded batch; a window is marked done with its poison pill.
+    Docs at or before the last position seen from a window or file were
+    queued again by a restarted reader and are skipped.
+    """
     batch = []
+    n_batch_bytes = 0
+    acked = {}
+    last_sort = {}
+    finished = []
     count_in = 0
     count_out = 0
     n_pills_swallowed = 0
+    n_skipped = 0
     n_total = query_queue.get() # first get total expected
 
+    def get():
+        while True:
+            try:
+                return query_queue.get(timeout=1.)
+            except Queue.Empty:
+                beat() # waiting for the readers is no lack of progress
+
+    def flush():
+        n_sent = upload_batch(batch, sink) if batch else 0
+        if positions is not None:
+            for window_id, position in acked.items():
+                positions.ack(window_id, position)
+            for window_id in finished:
+                positions.mark_done(window_id)
+            positions.save()
+            acked.clear()
+            del finished[:]
+        return n_sent
+
     while True:
-        doc = query_queue.get()
-        if doc == None: # swallow poison pills
+        item = get()
+        beat()
+        if item is None or item[0] is None: # swallow poison pills
+            if item is not None:
+                finished.append(item[1])
             n_pills_swallowed += 1
             if n_pills_swallowed == max_slices:
                 break
 
             continue
 
+        nbytes, doc = item[:2]
+        budget.release(nbytes)
+        if len(item) == 3:
+            window_id, position = item[2]
+            if window_id in last_sort and position['sort'] <= last_sort[window_id]:
+                n_skipped += 1
+                continue
+            last_sort[window_id] = position['sort']
+            acked[window_id] = position
+
         batch.append(doc)
+        n_batch_bytes += nbytes
         count_in += 1
-        if len(batch) == batch_size:
-            count_out += upload_batch(batch, dry_run=dry_run)
+        if len(batch) == batch_size or n_batch_bytes >= batch_bytes:
+            count_out += flush()
             batch = []
+            n_batch_bytes = 0
 
             print_progress(count_in, n_total)
 
 
-    if batch:
-        count_out += upload_batch(batch, dry_run=dry_run)
-        batch = []
-    print ">>> Processed {}/{} [{:.1%}]".format(count_in, n_total, count_in/float(n_total))
+    count_out += flush()
+    sink.close()
+    print ">>> Processed {}/{} [{:.1%}]".format(count_in, n_total, count_in/float(n_total or 1))
+    print ">>> %s" % sink.summary()
+    if n_skipped:
+        print ">>> Skipped %d docs queued again by restarted readers" % n_skipped
 
     assert(count_in == count_out == n_total), "Inconsistent count (upload worker)"
 
 
-def upload_batch(batch, dry_run=False):
+class FusedUploader(object):
+    """
+    Stands in for the queue to amq_upload_worker in a reader process
+    (with --fused): docs put by the reader are uploaded in batches from
+    the same process, over its own sink. With positions, the position of
+    each window is saved after every batch, as amq_upload_worker does.
+
+    The number of docs sent is shared with the parent. With replays, a
+    restarted reader starts over from the beginning of its file, and the
+    docs up to the (shared) position of the last doc sent are skipped.
+    """
+    def __init__(self, sink, budget, batch_size=5000, batch_bytes=50e6,
+                 positions=None, replays=False):
+        self.sink = sink
+        self.budget = budget
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.positions = positions
+        self.replays = replays
+        self.n_sent = multiprocessing.Value('l', 0, lock=False)
+        self.sent_through = multiprocessing.Value('l', -1, lock=False)
+        self._batch = []
+        self._n_batch_bytes = 0
+        self._acked = {}
+        self._last_sort = None
+
+    def flush(self):
+        if self._batch:
+            n_sent = upload_batch(self._batch, self.sink)
+            if self.replays and self._last_sort is not None:
+                self.sent_through.value = self._last_sort[0]
+            self.n_sent.value += n_sent
+        if self.positions is not None and (self._batch or self._acked):
+            for window_id, position in self._acked.items():
+                self.positions.ack(window_id, position)
+            self.positions.save()
+        self._batch = []
+        self._n_batch_bytes = 0
+        self._acked = {}
+
+    def put(self, item):
+        if item is None or item[0] is None: # poison pill: the reader is done
+            self.flush()
+            if item is not None and self.positions is not None:
+                self.positions.mark_done(item[1])
+                self.positions.save()
+            self.sink.close()
+            return
+
+        nbytes, doc = item[:2]
+        self.budget.release(nbytes)
+        if len(item) == 3:
+            window_id, position = item[2]
+            if self.replays and position['sort'][0] <= self.sent_through.value:
+                return # sent before the reader was restarted
+            self._last_sort = position['sort']
+            self._acked[window_id] = position
+
+        self._batch.append(doc)
+        self._n_batch_bytes += nbytes
+        if len(self._batch) == self.batch_size or self._n_batch_bytes >= self.batch_bytes:
+            self.flush()
+
+
+def upload_batch(batch, sink):
     data = ((d['GlobalJobId'], convert_dates_to_millisecs(d)) for d in batch)
-    n_sent = post_ads(data, dry_run)
+    n_sent = sink.post(data)
     assert(n_sent == len(batch)), "Inconsistent count (batch uploader)"
     return n_sent
 
 
+def make_ledger(args):
+    if args.ledger_file:
+        return SendLedger(args.ledger_file)
+    return None
+
+
 def process_date_string(date_string, args):
     starttime = time.time()
 
-    mp_manager = multiprocessing.Manager()
-    query_queue = mp_manager.Queue(maxsize=10000)
+    query_queue = None
+    if not args.fused:
+        mp_manager = multiprocessing.Manager()
+        query_queue = mp_manager.Queue()
+    budget = ByteBudget(args.queue_bytes, max_rss=args.max_rss)
+    supervisor = Supervisor(stall_timeout=args.stall_timeout, max_restarts=args.max_restarts)
+
+    def start(name, target, target_args, restartable=False, restart_args=None):
+        supervisor.start(name, profile_target(target, name, args.profile, args.profile_dir),
+                         target_args, restartable=restartable, restart_args=restart_args)
 
 
     print ">>> Processing %s" % date_string
     timestamp = date_string_to_timestamp(date_string)
     if not timestamp:
         print 'Invalid date "%s", skipping' % date_string
-        return
+        return False
 
     query = make_query(timestamp, timestamp + 24*60*60)
 
 
-    processes = []
-    if args.streaming:
+    def put_total(n_total):
+        """First put the total expected, for the uploader (if any)"""
+        if query_queue is not None:
+            query_queue.put(n_total)
+
+    def make_day_sink():
+        return make_sink('null' if args.dry_run else args.sink,
+                         frames_dir=args.frames_dir,
+                         ledger=make_ledger(args))
+
+    uploaders = []
+    def output(replays=False):
+        """
+        Where a reader puts its docs: the queue to the uploader, or with
+        --fused, an uploader of its own
+        """
+        if not args.fused:
+            return query_queue
+        uploaders.append(FusedUploader(make_day_sink(), budget,
+                                       args.amq_buffer_size, args.amq_buffer_bytes,
+                                       None if args.dry_run else positions, replays))
+        return uploaders[-1]
+
+    n_readers = 1
+    positions = None
+    if args.streaming and args.resumable:
+        positions = StreamPositions(args.positions_file, date_string, dry_run=args.dry_run)
+        windows = [w for w in positions.get_windows(timestamp, timestamp + 24*60*60, args.es_slices)
+                   if not positions.is_done(w[0])]
+        n_total = sum(count_remaining(w_from, w_to, positions.position(wid))
+                      for wid, w_from, w_to in windows)
+        put_total(n_total)
+
+        n_readers = len(windows)
+        if not n_readers:
+            print "    All windows done already"
+            positions.clear()
+            return True
+
+        def window_args(window_id, w_from, w_to, out):
+            # Start (again) from the last position saved by the uploader
+            positions.load()
+            return (window_id, w_from, w_to, positions.position(window_id),
+                    out, budget, args.es_buffer_size)
+
+        print "    Streaming %d windows from ES, %d docs to go" % (n_readers, n_total)
+        for window_id, w_from, w_to in windows:
+            out = output()
+            start("es_query_worker_window_%s" % window_id, es_query_worker_window,
+                  window_args(window_id, w_from, w_to, out), restartable=True,
+                  restart_args=functools.partial(window_args, window_id, w_from, w_to, out))
+
+    elif args.streaming and args.auto_slices:
+        n_total = get_total_hits(query)
+        put_total(n_total)
+
+        print "    Streaming from ES with a tuned number of slices"
+        start("es_query_worker_auto", es_query_worker_auto,
+              (query, timestamp, timestamp + 24*60*60, args.max_slices,
+               output(), budget, args.es_buffer_size,
+               args.slice_unit, args.slice_interval,
+               args.profile, args.profile_dir))
+
+    elif args.streaming and args.scan_mode == 'shards':
+        shards = get_target_shards(query)
+        n_total = sum(n for _, _, n in shards)
+        put_total(n_total)
+
+        n_readers = max(min(args.es_slices, len(shards)), 1)
+        print "    Streaming %d shards from ES with %d workers" % (len(shards), n_readers)
+        for n, worker_shards in enumerate(bin_pack(shards, n_readers, lambda s: s[2])):
+            start("es_query_worker_shards_%d" % n, es_query_worker_shards,
+                  (query, worker_shards, output(), budget, args.es_buffer_size))
+
+    elif args.streaming:
         print "    Streaming from ES"    
         n_total = get_total_hits(query)
-        query_queue.put(n_total) # first put the total expected
+        put_total(n_total)
 
         if args.es_slices == 1:
-            qproc = multiprocessing.Process(target=es_query_worker,
-                                            args=(query, query_queue, args.es_buffer_size, n_total),
-                                            name="es_query_worker")
-            qproc.start()
-            processes.append(qproc)
+            start("es_query_worker", es_query_worker,
+                  (query, output(), budget, args.es_buffer_size, n_total))
 
         else:
             print "      processing %d slices in parallel" % args.es_slices
+            n_readers = args.es_slices
 
             for slice_id in range(args.es_slices):
-                qproc = multiprocessing.Process(target=es_query_worker_sliced,
-                                                args=(query, slice_id, args.es_slices,
-                                                      query_queue, args.es_buffer_size),
-                                                name="es_query_worker_sliced_%d" % slice_id)
-                qproc.start()
-                processes.append(qproc)
+                start("es_query_worker_sliced_%d" % slice_id, es_query_worker_sliced,
+                      (query, slice_id, args.es_slices, output(), budget, args.es_buffer_size))
 
 
     else:
         dumpfile = os.path.join(args.dump_location, 'es-cms-dump-%s.json' % date_string)
-        if not os.path.isfile(dumpfile):
+        col_dumpfile = os.path.splitext(dumpfile)[0] + '.col'
+        shard_dir = sharded_dump_dir(args.dump_location, date_string)
+        if os.path.isfile(col_dumpfile):
+            dumpfiles = [(col_dumpfile, ColumnarReader(col_dumpfile).count())]
+            print "    Reading from %s" % col_dumpfile
+        elif os.path.isfile(dumpfile):
+            dumpfiles = [(dumpfile, get_total_lines(dumpfile))]
+            print "    Reading from %s" % dumpfile
+        elif os.path.isfile(os.path.join(shard_dir, 'manifest.json')):
+            dumpfiles = read_manifest(shard_dir)
+            print "    Reading %d shards from %s in parallel" % (len(dumpfiles), shard_dir)
+        else:
             print 'Dumpfile not found: %s, skipping' % dumpfile
-            return
-        print "    Reading from %s" % dumpfile
-        n_total = get_total_lines(dumpfile)
-        read_proc =  multiprocessing.Process(target=file_read_worker,
-                                             args=(dumpfile, query_queue, n_total),
-                                             name="file_read_worker")
-        read_proc.start()
-        processes.append(read_proc)
-
-    upload_proc = multiprocessing.Process(target=amq_upload_worker,
-                                          args=(query_queue,
-                                                args.amq_buffer_size,
-                                                args.dry_run,
-                                                args.es_slices),
-                                          name='amq_upload_worker')
-    upload_proc.start()
-    processes.append(upload_proc)
-
-    for p in processes:
-        p.join()
+            return False
+
+        n_total = sum(n for _, n in dumpfiles)
+        put_total(n_total)
+
+        fields = None
+        if args.fields:
+            fields = sorted(set(f.strip() for f in args.fields.split(',')) | set(REQUIRED_FIELDS))
+
+        n_readers = len(dumpfiles)
+        for n, (filename, n_docs) in enumerate(dumpfiles):
+            # Files are read in the same order every time, the uploader
+            # skips what it already got when a reader starts over
+            start("file_read_worker_%d" % n, file_read_worker,
+                  (filename, output(replays=True), budget, n_docs, fields, 'file_%d' % n),
+                  restartable=True)
+
+    if args.fused:
+        # No uploader process: only add up what the readers sent
+        def progress():
+            sample_tree_rss()
+            print_progress(sum(u.n_sent.value for u in uploaders), n_total)
+        failed = supervisor.run(progress)
+        n_sent = sum(u.n_sent.value for u in uploaders)
+        print ">>> Sent {}/{} [{:.1%}] from {} workers".format(n_sent, n_total,
+                                                                n_sent/float(n_total or 1),
+                                                                len(uploaders))
+        if not failed and n_sent != n_total:
+            print ">>> Inconsistent count: %d docs sent, %d expected" % (n_sent, n_total)
+            failed = ['count']
+    else:
+        start('amq_upload_worker', amq_upload_worker,
+              (query_queue, budget, make_day_sink(), args.amq_buffer_size, args.amq_buffer_bytes,
+               n_readers, None if args.dry_run else positions))
+        failed = supervisor.run(sample_tree_rss)
+
+    if failed:
+        print ">>> %s failed after %.2f mins in %s" % (date_string, (time.time()-starttime)/60.,
+                                                     ', '.join(failed))
+        return False
+
+    if positions is not None and not args.dry_run:
+        positions.clear()
 
     print ">>> %s done in %.2f mins" % (date_string, (time.time()-starttime)/60.)
+    return True
 
 
 _checkpoint = None
@@ -216,17 +655,37 @@ def mark_as_done(date_string, checkpoint_file):
 
 
 def main(args):
+    starttime = time.time()
+    configure_amq(spool_file=args.spool_file or None,
+                  batch_size=args.amq_batch_docs,
+                  batch_bytes=args.amq_batch_bytes,
+                  compression=args.amq_compression,
+                  fan_out=args.amq_fan_out)
+    configure_es(timeout=args.es_timeout,
+                 max_retries=args.es_retries,
+                 http_compress=not args.es_no_compress)
     load_checkpoint(args.checkpoint_file)
     for date_string in args.date_strings:
         if date_string in _checkpoint:
             print "%s already done, skipping..." % date_string
             continue
 
-        process_date_string(date_string, args)
+        success = process_date_string(date_string, args)
+        n_retries = 0
+        while not success and args.streaming and args.resumable and n_retries < args.max_restarts:
+            n_retries += 1
+            print ">>> Resuming %s from the saved positions (%d of %d)" % (date_string, n_retries,
+                                                                           args.max_restarts)
+            success = process_date_string(date_string, args)
 
-        if not args.dry_run:
+        if success and not args.dry_run:
             mark_as_done(date_string, args.checkpoint_file)
 
+    print ">>> Peak memory of the process tree: %.1f MB" % (peak_tree_rss()/1e6)
+
+    if args.profile:
+        print_summary(args.profile_dir, since=starttime)
+
 
 if __name__ == '__main__':
     parser = ArgumentParser()
@@ -238,9 +697,50 @@ if __name__ == '__main__':
     parser.add_argument("--es_slices", default=1,
                         type=int, dest="es_slices",
                         help="Number of slices to be scanned in parallel [default: %(default)s]")
+    parser.add_argument("--scan_mode", default='sliced',
+                        choices=['sliced', 'shards'], dest="scan_mode",
+                        help="With --streaming, scan sliced over all indices, or shard by shard "
+                             "with the shards balanced over --es_slices workers [default: %(default)s]")
+    parser.add_argument("--auto_slices", action='store_true',
+                        dest="auto_slices",
+                        help="With --streaming, read the day in units of --slice_unit with a number of "
+                             "parallel readers tuned by throughput and ES response times")
+    parser.add_argument("--max_slices", default=16,
+                        type=int, dest="max_slices",
+                        help="Maximum number of parallel readers for --auto_slices [default: %(default)s]")
+    parser.add_argument("--slice_unit", default=15*60,
+                        type=int, dest="slice_unit",
+                        help="Length in seconds of RecordTime units for --auto_slices [default: %(default)s]")
+    parser.add_argument("--slice_interval", default=10.,
+                        type=float, dest="slice_interval",
+                        help="Seconds between adjustments of the number of slices [default: %(default)s]")
+    parser.add_argument("--fused", action='store_true',
+                        dest="fused",
+                        help="Upload from every reader process over its own broker connection, "
+                             "instead of through a queue to a single uploader")
+    parser.add_argument("--resumable", action='store_true',
+                        dest="resumable",
+                        help="With --streaming, read --es_slices RecordTime windows in order and "
+                             "save the position after every batch to resume from after a failure")
+    parser.add_argument("--positions_file", default='positions.json',
+                        type=str, dest="positions_file",
+                        help="Positions of unfinished days for --resumable [default: %(default)s]")
+    parser.add_argument("--stall_timeout", default=600.,
+                        type=float, dest="stall_timeout",
+                        help="Stop a worker that made no progress for this many seconds "
+                             "(0: never) [default: %(default)s]")
+    parser.add_argument("--max_restarts", default=3,
+                        type=int, dest="max_restarts",
+                        help="Restart a failed file reader or --resumable window this often, "
+                             "and resume a failed --resumable day this often [default: %(default)s]")
     parser.add_argument("--dump_location", default='/data/raw_index_data/',
                         type=str, dest="dump_location",
-                        help="Directory to look for file dumps [default: %(default)s]")
+                        help="Directory to look for file dumps, or sharded dumps with a manifest "
+                             "(see dump_es_bytimestamp.py --slices) [default: %(default)s]")
+    parser.add_argument("--fields", default='',
+                        type=str, dest="fields",
+                        help="Only send these fields (comma-sep list) of docs read from file dumps, "
+                             "%s are always sent (default: all)" % ' and '.join(REQUIRED_FIELDS))
     parser.add_argument("--checkpoint_file", default='checkpoint.dat',
                         type=str, dest="checkpoint_file",
                         help="Processed the date_strings from this file [default: %(default)s]")
@@ -248,17 +748,65 @@ if __name__ == '__main__':
     parser.add_argument("--es_buffer_size", default=5000,
                         type=int, dest="es_buffer_size",
                         help="Buffer size for elasticsearch scan [default: %(default)s]")
+    parser.add_argument("--es_timeout", default=20,
+                        type=float, dest="es_timeout",
+                        help="Timeout of ES requests in seconds [default: %(default)s]")
+    parser.add_argument("--es_retries", default=3,
+                        type=int, dest="es_retries",
+                        help="Retry failed ES requests this many times, waiting 1, 3, 7... s [default: %(default)s]")
+    parser.add_argument("--es_no_compress", action='store_true',
+                        dest="es_no_compress",
+                        help="Don't ask ES for gzipped responses")
     parser.add_argument("--amq_buffer_size", default=5000,
                         type=int, dest="amq_buffer_size",
                         help="Buffer size for AMQ upload [default: %(default)s]")
-    parser.add_argument("--queue_size", default=10000,
-                        type=int, dest="queue_size",
-                        help="Size of internal queue [default: %(default)s]")
-
+    parser.add_argument("--amq_buffer_bytes", default=50e6,
+                        type=float, dest="amq_buffer_bytes",
+                        help="Maximum size in bytes of a batch for AMQ upload [default: %(default)s]")
+    parser.add_argument("--queue_bytes", default=200e6,
+                        type=float, dest="queue_bytes",
+                        help="Maximum size in bytes of docs in the internal queue [default: %(default)s]")
+    parser.add_argument("--max_rss", default=0,
+                        type=float, dest="max_rss",
+                        help="Hold back readers while all processes use more memory than this (bytes) [default: %(default)s]")
+
+    parser.add_argument("--sink", default='amq',
+                        choices=['amq', 'frames', 'null'], dest="sink",
+                        help="Send to AMQ, write frames to --frames_dir, or only encode and count [default: %(default)s]")
+    parser.add_argument("--frames_dir", default='frames/',
+                        type=str, dest="frames_dir",
+                        help="Directory for the frames sink [default: %(default)s]")
     parser.add_argument("--dry_run", action='store_true',
                         dest="dry_run",
-                        help="Don't do anything")
+                        help="Use the null sink and don't update the checkpoint")
+    parser.add_argument("--profile", default=None,
+                        choices=['cprofile', 'sample'], dest="profile",
+                        help="Profile every worker process [default: %(default)s]")
+    parser.add_argument("--profile_dir", default='profile/',
+                        type=str, dest="profile_dir",
+                        help="Write the per-process profiles here [default: %(default)s]")
+    parser.add_argument("--spool_file", default='amq_spool.json',
+                        type=str, dest="spool_file",
+                        help="Keep notifications that failed to send here for replay_spool.py [default: %(default)s]")
+    parser.add_argument("--ledger_file", default='ledger.json',
+                        type=str, dest="ledger_file",
+                        help="Count the docs sent to AMQ per hour of RecordTime here, for reconcile.py "
+                             "(empty to disable) [default: %(default)s]")
+    parser.add_argument("--amq_batch_docs", default=1,
+                        type=int, dest="amq_batch_docs",
+                        help="Pack up to this many docs into a single AMQ message [default: %(default)s]")
+    parser.add_argument("--amq_batch_bytes", default=512*1024,
+                        type=int, dest="amq_batch_bytes",
+                        help="Maximum size in bytes of a packed AMQ message [default: %(default)s]")
+    parser.add_argument("--amq_compression", default=None,
+                        choices=['gzip', 'zlib'], dest="amq_compression",
+                        help="Compress AMQ message bodies [default: %(default)s]")
+    parser.add_argument("--amq_fan_out", default=None,
+                        choices=['round_robin', 'least_loaded'], dest="amq_fan_out",
+                        help="Spread AMQ messages over all broker nodes [default: %(default)s]")
 
     args = parser.parse_args()
+    if args.fused and args.streaming and args.auto_slices and not args.resumable:
+        parser.error("--fused does not work with --auto_slices")
 
     main(args)
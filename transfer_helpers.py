@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import os
 import sys
+import heapq
 import shlex
 import logging
 import subprocess
@@ -97,3 +98,18 @@ def get_total_lines(filename):
         count = None
     return count
 
+
+def bin_pack(items, n_bins, size):
+    """
+    Distribute items over n_bins such that the largest total size of any
+    bin is small, placing the largest items first into the least loaded bin
+
+    :return: a list of n_bins lists of items
+    """
+    bins = [[] for _ in range(n_bins)]
+    heap = [(0, n) for n in range(n_bins)]
+    for item in sorted(items, key=size, reverse=True):
+        load, n = heapq.heappop(heap)
+        bins[n].append(item)
+        heapq.heappush(heap, (load + size(item), n))
+    return bins
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+Parallel verification of local dump files against ES.
+
+Each dump file is split into byte ranges (or batches, for columnar dumps,
+of which only the _id and RecordTime columns are read) which are read in
+parallel. For every hour of RecordTime the number of docs is compared to
+a histogram aggregation over the same index or RecordTime range in ES (a
+date_histogram if RecordTime is mapped as a date, else a numeric one over
+its seconds). With --check_ids, the sum of the Java hashCode of the _ids
+of every hour is compared as well, computed in the same aggregation by a
+script. That needs no scan of the _ids, but makes ES load the _ids of the
+matching docs into memory.
+"""
+import os
+import re
+import time
+import struct
+import multiprocessing
+
+from argparse import ArgumentParser
+
+import codec
+
+from columnar import ColumnarReader
+from columnar import ColumnarWriter
+from columnar import is_columnar
+from dump_es_bytimestamp import make_query
+from dump_es_bytimestamp import get_es_handle
+from dump_es_bytimestamp import get_es_scan
+from dump_es_bytimestamp import date_string_to_timestamp
+
+
+_ID_RE = re.compile(r'"_id":\s*"([^"]*)"')
+_RECORDTIME_RE = re.compile(r'"RecordTime":\s*(\d+)')
+
+_WINDOW = 60*60
+
+# Sum of the hashes of the _ids in a bucket. Each hash is within 2**31, so
+# the sum (a double in ES) stays exact for millions of docs per hour.
+_ID_HASH_SUM = {"sum": {"script": {"lang": "painless",
+                                   "source": "doc['_id'].value.hashCode()"}}}
+
+
+def id_hash(id_):
+    """Java String.hashCode of a document _id, as the ES script computes it"""
+    if isinstance(id_, str):
+        id_ = id_.decode('utf-8')
+    data = id_.encode('utf-16-be')
+    hash_ = 0
+    for unit in struct.unpack('>%dH' % (len(data)//2), data):
+        hash_ = (31*hash_ + unit) & 0xffffffff
+    return hash_ - 2**32 if hash_ >= 2**31 else hash_
+
+
+def parse_line(line):
+    """Return (_id, RecordTime) of a raw dump line"""
+    id_match = _ID_RE.search(line)
+    rt_match = _RECORDTIME_RE.search(line)
+    if id_match and rt_match:
+        return id_match.group(1), int(rt_match.group(1))
+
+    # Fall back to a full parse for unusual formatting
+    raw = codec.loads(line)
+    return raw['_id'], int(raw['_source']['RecordTime'])
+
+
+def add_to_summary(summary, window, count, hash_):
+    n, h = summary.get(window, (0, 0))
+    summary[window] = (n + count, h + hash_)
+
+
+def merge_summaries(summaries):
+    merged = {}
+    for summary in summaries:
+        for window, (count, hash_) in summary.iteritems():
+            add_to_summary(merged, window, count, hash_)
+    return merged
+
+
+def get_chunks(filename, n_chunks):
+    """Split a file into n_chunks byte ranges"""
+    size = os.path.getsize(filename)
+    step = max(size // n_chunks, 1)
+    bounds = range(0, size, step) + [size]
+    bounds[-1] = size
+    return [(filename, start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+def summarize_chunk(chunk):
+    """
+    Count docs and hash _ids per hour for all lines starting
+    in the byte range [start, end) of a file.
+    """
+    filename, start, end = chunk
+    summary = {}
+    with open(filename, 'r') as dumpfile:
+        if start > 0:
+            # The line running across start belongs to the previous chunk
+            dumpfile.seek(start - 1)
+            dumpfile.readline()
+
+        while dumpfile.tell() < end:
+            line = dumpfile.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+
+            id_, record_time = parse_line(line)
+            window = record_time - record_time % _WINDOW
+            add_to_summary(summary, window, 1, id_hash(id_))
+
+    return summary
+
+
+def get_batch_chunks(filename, n_chunks):
+    """Split the batches of a columnar dump into n_chunks sets"""
+    n_batches = len(ColumnarReader(filename).batches())
+    return [(filename, set(range(n, n_batches, n_chunks)))
+            for n in range(min(n_chunks, n_batches))]
+
+
+def summarize_batches(chunk):
+    """Count docs and hash _ids per hour for some batches of a columnar dump"""
+    filename, batches = chunk
+    summary = {}
+    for hit in ColumnarReader(filename).read(fields=['RecordTime'], batches=batches):
+        record_time = int(hit['_source']['RecordTime'])
+        window = record_time - record_time % _WINDOW
+        add_to_summary(summary, window, 1, id_hash(hit['_id']))
+    return summary
+
+
+def summarize_dump(filename, workers=4):
+    """Return {window: (count, id_hash)} for a dump file, read in parallel"""
+    if is_columnar(filename):
+        chunks, summarize = get_batch_chunks(filename, 4*workers), summarize_batches
+    else:
+        chunks, summarize = get_chunks(filename, 4*workers), summarize_chunk
+    if workers == 1:
+        return merge_summaries(map(summarize, chunks))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        summaries = pool.map(summarize, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    return merge_summaries(summaries)
+
+
+_record_time_types = {}
+def get_record_time_type(index='cms-20*'):
+    """
+    Return how RecordTime is mapped in the indices ('date', or a numeric
+    type holding seconds), asking ES once per index pattern
+    """
+    if index not in _record_time_types:
+        mappings = get_es_handle().indices.get_field_mapping(fields='RecordTime', index=index,
+                                                            doc_type='job', request_timeout=60)
+        types = set()
+        for mapping in mappings.itervalues():
+            for fields in mapping.get('mappings', {}).itervalues():
+                if 'RecordTime' in fields:
+                    types.update(m['type'] for m in fields['RecordTime']['mapping'].itervalues())
+        if len(types) > 1:
+            raise ValueError("RecordTime is mapped as %s in %s" % (', '.join(sorted(types)), index))
+        _record_time_types[index] = types.pop() if types else 'long'
+    return _record_time_types[index]
+
+
+def make_window_histogram(index='cms-20*'):
+    """
+    Return a histogram aggregation of RecordTime with one bucket per
+    window, and the factor from its keys to seconds
+    """
+    if get_record_time_type(index) == 'date':
+        # Dates are bucketed (and keyed) in milliseconds
+        return {"date_histogram": {"field": "RecordTime",
+                                   "interval": "1h",
+                                   "min_doc_count": 1}}, 1000
+    return {"histogram": {"field": "RecordTime",
+                          "interval": _WINDOW,
+                          "min_doc_count": 1}}, 1
+
+
+def get_es_window_summary(query=None, index='cms-20*', check_ids=False):
+    """
+    Return {window: (count, id_hash)} from a histogram in ES, with the
+    id_hash only if check_ids (else None)
+    """
+    histogram, key_factor = make_window_histogram(index)
+    if check_ids:
+        histogram['aggs'] = {"id_hash": _ID_HASH_SUM}
+    body = {"size": 0, "aggs": {"per_window": histogram}}
+    body.update(query or {"query": {"match_all": {}}})
+
+    res = get_es_handle().search(index=index, doc_type='job',
+                                 request_timeout=60, body=body)
+
+    buckets = res['aggregations']['per_window']['buckets']
+    return {int(b['key'])//key_factor: (b['doc_count'],
+                                        int(b['id_hash']['value']) if check_ids else None)
+            for b in buckets}
+
+
+def get_es_window_counts(query=None, index='cms-20*'):
+    """Return {window: count} from a histogram in ES"""
+    return {window: count for window, (count, _) in
+            get_es_window_summary(query=query, index=index).iteritems()}
+
+
+def compare(summary, es_summary, check_ids=False):
+    """Return a sorted list of windows inconsistent with ES"""
+    bad_windows = []
+    for window in sorted(set(summary.keys()) | set(es_summary.keys())):
+        count, hash_ = summary.get(window, (0, 0))
+        es_count, es_hash = es_summary.get(window, (0, 0))
+        if count != es_count:
+            print ">>> %s: %d docs in dump, %d in ES" % (
+                time.strftime('%Y-%m-%d %H:%M', time.gmtime(window)), count, es_count)
+            bad_windows.append(window)
+        elif check_ids and hash_ != es_hash:
+            print ">>> %s: %d docs, but inconsistent _ids" % (
+                time.strftime('%Y-%m-%d %H:%M', time.gmtime(window)), count)
+            bad_windows.append(window)
+
+    return bad_windows
+
+
+def verify(filename, query=None, index='cms-20*', workers=4, check_ids=False):
+    """
+    Compare a dump file with ES and return the list of bad windows
+    (start timestamps of one hour RecordTime windows).
+    """
+    starttime = time.time()
+    summary = summarize_dump(filename, workers=workers)
+    n_docs = sum(c for c, _ in summary.itervalues())
+    print ">>> Read %d docs from %s in %.2f mins" % (n_docs, filename, (time.time()-starttime)/60.)
+
+    es_summary = get_es_window_summary(query=query, index=index, check_ids=check_ids)
+    bad_windows = compare(summary, es_summary, check_ids=check_ids)
+    print ">>> %d of %d windows inconsistent with ES" % (len(bad_windows), len(summary))
+    return bad_windows
+
+
+def verify_and_refetch(filename, query=None, index='cms-20*', workers=4, check_ids=False):
+    """
+    Verify a dump file, download its inconsistent windows again and
+    verify it once more. Return the windows that are still inconsistent.
+    """
+    bad_windows = verify(filename, query=query, index=index,
+                         workers=workers, check_ids=check_ids)
+    if not bad_windows:
+        return []
+
+    refetch_windows(filename, bad_windows, index=index)
+    return verify(filename, query=query, index=index,
+                  workers=workers, check_ids=check_ids)
+
+
+def refetch_windows(filename, windows, index='cms-20*', buffer_size=5000):
+    """
+    Replace the docs of the given windows in a dump file by a fresh
+    download from ES. All other lines are kept as they are.
+    """
+    if is_columnar(filename):
+        return refetch_windows_columnar(filename, windows, index=index,
+                                        buffer_size=buffer_size)
+
+    windows = set(windows)
+    tmpfile = filename + '.tmp'
+    count = 0
+    with open(tmpfile, 'w') as outfile:
+        with open(filename, 'r') as dumpfile:
+            for line in dumpfile:
+                if not line.strip():
+                    continue
+                _, record_time = parse_line(line)
+                if record_time - record_time % _WINDOW in windows:
+                    continue
+                outfile.write(line)
+
+        for window in sorted(windows):
+            query = make_query(window, window + _WINDOW)
+            for doc in get_es_scan(query, index=index, buffer_size=buffer_size):
+                outfile.write(codec.dumps(doc))
+                outfile.write('\n')
+                count += 1
+
+    os.rename(tmpfile, filename)
+    print ">>> Refetched %d docs in %d windows into %s" % (count, len(windows), filename)
+
+
+def refetch_windows_columnar(filename, windows, index='cms-20*', buffer_size=5000):
+    """Like refetch_windows, rewriting a columnar dump"""
+    windows = set(windows)
+    tmpfile = filename + '.tmp'
+    count = 0
+    with ColumnarWriter(tmpfile) as writer:
+        for hit in ColumnarReader(filename).read():
+            record_time = int(hit['_source']['RecordTime'])
+            if record_time - record_time % _WINDOW in windows:
+                continue
+            writer.write(hit)
+
+        for window in sorted(windows):
+            query = make_query(window, window + _WINDOW)
+            for doc in get_es_scan(query, index=index, buffer_size=buffer_size):
+                writer.write(doc)
+                count += 1
+
+    os.rename(tmpfile, filename)
+    print ">>> Refetched %d docs in %d windows into %s" % (count, len(windows), filename)
+
+
+def query_for_dumpfile(filename):
+    """Guess the index and query from a dump file name"""
+    basename = os.path.splitext(os.path.basename(filename))[0]
+    if basename.startswith('es-cms-dump-'):
+        timestamp = date_string_to_timestamp(basename[len('es-cms-dump-'):])
+        return 'cms-20*', make_query(timestamp, timestamp + 24*60*60)
+
+    return basename, None
+
+
+def main(args):
+    for dumpfile in args.dumpfiles:
+        index, query = query_for_dumpfile(dumpfile)
+        if args.refetch:
+            bad_windows = verify_and_refetch(dumpfile, query=query, index=index,
+                                             workers=args.workers, check_ids=args.check_ids)
+            if bad_windows:
+                print ">>> %d windows still inconsistent after refetching" % len(bad_windows)
+        else:
+            verify(dumpfile, query=query, index=index,
+                   workers=args.workers, check_ids=args.check_ids)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('dumpfiles', metavar='dumpfiles', type=str, nargs='+',
+                        help='Verify these dump files')
+    parser.add_argument("--workers", default=multiprocessing.cpu_count(),
+                        type=int, dest="workers",
+                        help="Number of parallel readers [default: %(default)s]")
+    parser.add_argument("--check_ids", action='store_true',
+                        dest="check_ids",
+                        help="Also compare the _ids of windows with matching counts")
+    parser.add_argument("--refetch", action='store_true',
+                        dest="refetch",
+                        help="Download the inconsistent windows again, and verify once more")
+    args = parser.parse_args()
+
+    main(args)